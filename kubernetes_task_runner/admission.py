@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Admission of queued batch jobs to the cluster.
+
+New batch jobs wait in the `queued` status until the dispatcher admits them,
+which it only does while the active (created or running) jobs stay under the
+limits in `ADMISSION_SETTINGS`, both overall and per owner:
+
+    {'max_running_jobs': 100, 'max_cpu': '64', 'max_memory': '256Gi',
+     'max_running_jobs_per_owner': 20, 'max_cpu_per_owner': '16',
+     'max_memory_per_owner': '64Gi'}
+
+Missing limits don't apply. CPU and memory are counted from the jobs'
+resource requests. When the capacity of the nodes of the job's cluster is
+known (see `ClusterManager.node_capacity`), jobs are also deferred until
+some node has room for their requests. Nodes come and go, so jobs fitting on
+none of them stay queued too rather than failing.
+
+Failed jobs being retried (see `BatchJobParameters.max_attempts`) are queued
+again, but aren't admitted before their `retry_at`. Jobs of clusters whose
+API server is unavailable stay queued until it's back.
+
+Jobs are admitted highest priority first. Among jobs of the same priority,
+owners take turns in fair-share order: the next job admitted is the oldest
+one of the owner with the smallest dominant share, i.e. whose active jobs use
+the smallest fraction of any overall limit.
+"""
+import heapq
+import itertools
+import logging
+from collections import namedtuple
+from datetime import datetime
+from functools import reduce
+
+from kubernetes_task_runner.exceptions import InvalidTransitionError
+from kubernetes_task_runner.metrics import (ADMISSION_OLDEST_QUEUED,
+                                            ADMISSION_WAIT)
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus, Lease
+from kubernetes_task_runner.util import parse_quantity
+from kubernetes_task_runner.webhooks import notify_batch_job_finished
+
+# statuses of the jobs using cluster resources
+ACTIVE_STATUSES = (BatchJobStatus.CREATED.value,
+                   BatchJobStatus.RUNNING.value)
+
+ADMISSION_LEASE = 'admission'
+# seconds an admission pass holds its lease for at most, should it die
+ADMISSION_LEASE_SECONDS = 60
+
+Usage = namedtuple('Usage', ['jobs', 'cpu', 'memory'])
+NO_USAGE = Usage(0, 0, 0)
+
+# None means unlimited
+Limits = namedtuple('Limits', ['jobs', 'cpu', 'memory'])
+NO_LIMITS = Limits(None, None, None)
+
+
+def add_usage(usage, other):
+    return Usage(*(used + more for used, more in zip(usage, other)))
+
+
+def job_usage(batch_job):
+    return Usage(1, batch_job.requested_cpu or 0,
+                 batch_job.requested_memory or 0)
+
+
+def within_limits(usage, limits):
+    return all(limit is None or used <= limit
+               for used, limit in zip(usage, limits))
+
+
+def dominant_share(usage, limits):
+    """ Largest fraction of any of `limits` used by `usage`. """
+    shares = [used / limit for used, limit in zip(usage, limits) if limit]
+    # without overall limits, share the number of jobs
+    return max(shares) if shares else usage.jobs
+
+
+def exceeds_limits(batch_job, limits=NO_LIMITS, owner_limits=NO_LIMITS,
+                   node_capacity=None):
+    """
+    Whether `batch_job` alone exceeds the limits or any node's capacity, so
+    it never fits.
+    """
+    demand = job_usage(batch_job)
+    if (node_capacity is not None
+            and not node_capacity.fits_any_node(demand.cpu, demand.memory)):
+        return True
+    return not (within_limits(demand, limits)
+                and within_limits(demand, owner_limits))
+
+
+def parse_limits(settings):
+    """
+    Return the overall and per owner `Limits` in `settings` (see
+    `ADMISSION_SETTINGS`).
+
+    Raises `ValueError` if a CPU or memory limit isn't a valid quantity.
+    """
+    def limits(suffix):
+        cpu = settings.get(f'max_cpu{suffix}')
+        memory = settings.get(f'max_memory{suffix}')
+        return Limits(settings.get(f'max_running_jobs{suffix}'),
+                      parse_quantity(cpu) if cpu is not None else None,
+                      parse_quantity(memory) if memory is not None else None)
+    return limits(''), limits('_per_owner')
+
+
+def active_usage():
+    """ Resources used by the active jobs of each owner. """
+    pipeline = [
+        {'$match': {'status': {'$in': list(ACTIVE_STATUSES)}}},
+        {'$group': {
+            '_id': '$owner',
+            'jobs': {'$sum': 1},
+            'cpu': {'$sum': '$requested_cpu'},
+            'memory': {'$sum': '$requested_memory'},
+        }},
+    ]
+    return {row['_id']: Usage(row['jobs'], row['cpu'], row['memory'])
+            for row in BatchJob.objects.aggregate(*pipeline)}
+
+
+def queued_by_owner():
+    """ Number of queued jobs and the oldest one's creation, per owner. """
+    pipeline = [
+        {'$match': {'status': BatchJobStatus.QUEUED.value}},
+        {'$group': {
+            '_id': '$owner',
+            'jobs': {'$sum': 1},
+            'oldest': {'$min': '$created'},
+        }},
+    ]
+    return {row['_id']: row for row in BatchJob.objects.aggregate(*pipeline)}
+
+
+def next_queued_job(owner, now, unavailable_clusters=()):
+    """
+    The queued job of `owner` admitted next, but for retries still backing
+    off at `now` and jobs of `unavailable_clusters`. None if there's none.
+
+    Read from the head of the queue index, without scanning the owner's
+    queue.
+    """
+    jobs = BatchJob.objects(status=BatchJobStatus.QUEUED.value, owner=owner,
+                            retry_at__lte=now)
+    if unavailable_clusters:
+        jobs = jobs.filter(cluster__nin=list(unavailable_clusters))
+    return jobs.order_by('-job_parameters.priority', 'created').first()
+
+
+def oldest_queued_job():
+    """ The queued job waiting the longest, None if there's none. """
+    return BatchJob.objects(
+        status=BatchJobStatus.QUEUED.value,
+    ).order_by('created').only('created').first()
+
+
+def backfill_retry_at():
+    """
+    Set the `retry_at` of the jobs queued before every queued job had one,
+    so they're admitted too.
+    """
+    BatchJob.objects(status=BatchJobStatus.QUEUED.value, retry_at=None).update(
+        set__retry_at=datetime.utcnow(),
+    )
+
+
+def admit_queued_jobs(limits=NO_LIMITS, owner_limits=NO_LIMITS,
+                      node_capacities=None, unavailable_clusters=()):
+    """
+    Move the queued jobs fitting within `limits` and `owner_limits`, and on
+    a node of their cluster's capacity in `node_capacities` (cluster names to
+    `NodeCapacity`) if known, to `created`, in fair-share order, and return
+    them to be deployed. Jobs of `unavailable_clusters` stay queued.
+
+    Concurrent passes would count the same active jobs and could exceed the
+    limits together, so passes hold the `ADMISSION_LEASE`. None are admitted
+    while another pass holds it.
+    """
+    holder = Lease.acquire(ADMISSION_LEASE, ADMISSION_LEASE_SECONDS)
+    if holder is None:
+        logging.info('Another admission pass is running. Skipping.')
+        return []
+    try:
+        return _admit_queued_jobs(limits, owner_limits, node_capacities or {},
+                                  unavailable_clusters)
+    finally:
+        Lease.release(ADMISSION_LEASE, holder)
+
+
+def _admit_queued_jobs(limits, owner_limits, node_capacities,
+                       unavailable_clusters):
+    usage = active_usage()
+    total = reduce(add_usage, usage.values(), NO_USAGE)
+    now = datetime.utcnow()
+    oldest = oldest_queued_job()
+    ADMISSION_OLDEST_QUEUED.set(
+        (now - oldest.created).total_seconds() if oldest else 0,
+    )
+
+    # the next job of every owner, as (-job's priority, owner's share, job's
+    # creation, tie breaker, owner, job)
+    candidates = []
+    order = itertools.count()
+
+    def push_next(owner):
+        # the owner's previous job left the queue (or never will), so the
+        # head of the queue is the next one
+        batch_job = next_queued_job(owner, now, unavailable_clusters)
+        if batch_job is not None:
+            share = dominant_share(usage.get(owner, NO_USAGE), limits)
+            heapq.heappush(candidates, (
+                -(batch_job.job_parameters.priority or 0), share,
+                batch_job.created, next(order), owner, batch_job,
+            ))
+
+    for owner in BatchJob.objects(
+            status=BatchJobStatus.QUEUED.value).distinct('owner'):
+        push_next(owner)
+
+    admitted = []
+    while candidates:
+        *_, owner, batch_job = heapq.heappop(candidates)
+        if exceeds_limits(batch_job, limits, owner_limits):
+            # e.g. the limits were lowered since it was queued
+            logging.error(f'Batch job {batch_job.name} exceeds the admission '
+                          'limits. Considering it as failed.')
+            try:
+                batch_job.set_failed(stop_time=datetime.utcnow())
+                notify_batch_job_finished(batch_job)
+            except InvalidTransitionError:
+                pass
+            push_next(owner)
+            continue
+        demand = job_usage(batch_job)
+        owner_usage = add_usage(usage.get(owner, NO_USAGE), demand)
+        if not (within_limits(add_usage(total, demand), limits)
+                and within_limits(owner_usage, owner_limits)):
+            # the owner's next job waits until enough capacity frees up
+            continue
+        node_name = None
+        node_capacity = node_capacities.get(batch_job.cluster)
+        if node_capacity is not None:
+            node_name = node_capacity.find_node(demand.cpu, demand.memory)
+            if node_name is None:
+                # no room on any node right now, or the nodes it fits on are
+                # cordoned or still being added
+                continue
+        try:
+            batch_job.transition(BatchJobStatus.CREATED.value,
+                                 expected=[BatchJobStatus.QUEUED.value])
+        except InvalidTransitionError:
+            # killed while queued
+            push_next(owner)
+            continue
+        if node_name is not None:
+            node_capacity.reserve(node_name, demand.cpu, demand.memory)
+        ADMISSION_WAIT.observe((now - batch_job.created).total_seconds())
+        usage[owner] = owner_usage
+        total = add_usage(total, demand)
+        admitted.append(batch_job)
+        push_next(owner)
+    return admitted
+
+
+def queue_stats(limits=NO_LIMITS):
+    """
+    Queued jobs and the usage of the active ones, overall and per owner:
+
+      {'queued': 12, 'oldest_wait_seconds': 340.2, 'active': {...},
+       'owners': [{'owner': 'reports', 'queued': 10, 'share': 0.25, ...}]}
+    """
+    usage = active_usage()
+    queued = queued_by_owner()
+    now = datetime.utcnow()
+
+    def wait_seconds(row):
+        return (now - row['oldest']).total_seconds() if row else None
+
+    owners = []
+    for owner in set(usage) | set(queued):
+        owner_usage = usage.get(owner, NO_USAGE)
+        owners.append({
+            'owner': owner,
+            'queued': queued[owner]['jobs'] if owner in queued else 0,
+            'oldest_wait_seconds': wait_seconds(queued.get(owner)),
+            'active': owner_usage._asdict(),
+            'share': dominant_share(owner_usage, limits),
+        })
+    owners.sort(key=lambda row: (row['share'], row['owner'] or ''))
+    oldest = min(queued.values(), key=lambda row: row['oldest'],
+                 default=None)
+    return {
+        'queued': sum(row['jobs'] for row in queued.values()),
+        'oldest_wait_seconds': wait_seconds(oldest),
+        'active': reduce(add_usage, usage.values(), NO_USAGE)._asdict(),
+        'owners': owners,
+    }
@@ -6,12 +6,15 @@ def create_app(config=None):
     from .views import api_views
     from .models import db
     from .tasks import celery
+    from . import metrics
 
     app = Flask(__name__)
 
     app.config.from_mapping(config or {})
 
     celery.conf.update(app.config)
+    # tasks run within the app's context (see `tasks.AppContextTask`)
+    celery.flask_app = app
 
     # initialize flask-mongoengine
     db.init_app(app)
@@ -19,4 +22,7 @@ def create_app(config=None):
     # register views
     app.register_blueprint(api_views)
 
+    # time every request
+    metrics.init_app(app)
+
     return app
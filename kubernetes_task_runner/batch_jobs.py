@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
+import gzip
 import os
 import json
 import logging
-from datetime import datetime
+import math
+import tempfile
+from datetime import datetime, timedelta
 from enum import Enum
 import time
 
@@ -11,9 +14,20 @@ from kubernetes.client.rest import ApiException
 from jinja2 import Template
 import yaml
 
-from kubernetes_task_runner.exceptions import JobStartException, ClusterError
+from kubernetes_task_runner.exceptions import (BackendUnavailable,
+                                               JobStartException,
+                                               ClusterError, StorageException)
 from kubernetes_task_runner.extensions import (get_cluster_manager_instance,
                                                get_gcloud_client)
+from kubernetes_task_runner.models import BatchJobStatus
+from kubernetes_task_runner.webhooks import notify_batch_job_finished
+
+
+# seconds for a new job and its pod to start
+JOB_START_TIMEOUT = 100
+# seconds a retry waits in the queue for the objects of the failed attempt to
+# be deleted, before trying to deploy it again
+PREVIOUS_ATTEMPT_WAIT = 10
 
 
 class PodPhase(Enum):
@@ -39,6 +53,16 @@ def build_config_from_template(template_name, context):
     return yaml.safe_load(template.render(**context))
 
 
+def priority_class_name(priority, priority_classes):
+    """
+    Name of the PriorityClass with the highest value not above `priority`, out
+    of `priority_classes` (name to value), if there's one.
+    """
+    eligible = [(value, name) for name, value in priority_classes.items()
+                if value <= priority]
+    return max(eligible)[1] if eligible else None
+
+
 def parse_cluster_exception(exception):
     try:
         return json.loads(exception.body)
@@ -46,77 +70,192 @@ def parse_cluster_exception(exception):
         return exception.body
 
 
-def poll_job_until_start(cluster_manager, job_name, n_retries=3,
-                         retry_wait=10):
-    """
-    Poll the cluster until the job is ready.
-    """
-    countdown = n_retries
-    while countdown:
-
-        job = cluster_manager.get_job(job_name)
-
-        # job has started
-        if job.status.active:
-            return ClusterJobStatus.Active, job
+def remaining_seconds(deadline):
+    """ Whole seconds left until `deadline` (a `time.monotonic` value). """
+    return max(math.ceil(deadline - time.monotonic()), 0)
 
-        # job has finished successfully
-        if job.status.succeeded:
-            return ClusterJobStatus.Succeeded, job
 
-        # job has failed to start
-        if job.status.failed:
-            raise JobStartException('Job failed to start', context={
-                'last_job_response': job,
-            })
+def job_start_status(job):
+    """
+    Return the status of a started `job`, None if it hasn't started yet.
+    """
+    # job has started
+    if job.status.active:
+        return ClusterJobStatus.Active
+
+    # job has finished successfully
+    if job.status.succeeded:
+        return ClusterJobStatus.Succeeded
+
+    # job has failed to start
+    if job.status.failed:
+        raise JobStartException('Job failed to start', context={
+            'last_job_response': job,
+        })
 
-        time.sleep(retry_wait)
-        countdown -= 1
 
+def wait_for_job_start(cluster_manager, job_name, deadline, namespace=None):
+    """
+    Wait until the job has started, following it in the cluster's cache if
+    synced or watching it for changes otherwise, until `deadline`.
+    """
+    if cluster_manager.cache.synced:
+        return follow_cached_job_start(cluster_manager.cache, job_name,
+                                       deadline, namespace)
+    job = cluster_manager.get_job(job_name, namespace=namespace)
+    while True:
+        status = job_start_status(job)
+        if status:
+            return status, job
+
+        timeout = remaining_seconds(deadline)
+        if not timeout:
+            raise JobStartException(
+                'Job failed to start before the deadline.',
+                context={'last_job_response': job.to_dict()}
+            )
+
+        events = cluster_manager.watch_job(
+            job_name, timeout_seconds=timeout,
+            resource_version=job.metadata.resource_version,
+            namespace=namespace,
+        )
+        for event in events:
+            if event['type'] == 'DELETED':
+                raise JobStartException(
+                    'Job was deleted before starting.',
+                    context={'last_job_response': job.to_dict()}
+                )
+            if event['type'] == 'ERROR':
+                break
+            job = event['object']
+            status = job_start_status(job)
+            if status:
+                return status, job
+        # the watch expired or failed, start over from the current state
+        job = cluster_manager.get_job(job_name, namespace=namespace)
+
+
+def follow_cached_job_start(cache, job_name, deadline, namespace=None):
+    """ Like `wait_for_job_start`, following the job in `cache`. """
+    job = None
+    for cached_job in cache.jobs.follow(
+            lambda: cache.get_job(job_name, namespace), deadline):
+        if cached_job is None:
+            if job is not None:
+                raise JobStartException(
+                    'Job was deleted before starting.',
+                    context={'last_job_response': job.to_dict()}
+                )
+            # not seen by the watch yet
+            continue
+        job = cached_job
+        status = job_start_status(job)
+        if status:
+            return status, job
     raise JobStartException(
-        f'Job failed to start after {n_retries * retry_wait} seconds.',
-        context={'last_job_response': job.to_dict()}
+        'Job failed to start before the deadline.',
+        context={'last_job_response': job.to_dict() if job else None}
     )
 
 
-def poll_pod_until_start(cluster_manager, job_name, n_retries=7,
-                         retry_wait=10):
+def pod_start_phase(job_name, pod_list):
     """
-    Poll the cluster until the pod related to `job_name` is ready.
+    Return the phase of the started pod in `pod_list`, None if it hasn't
+    started yet.
     """
-    started_phases = (PodPhase.Running.value, PodPhase.Succeeded.value)
-    countdown = n_retries
-    while countdown:
-        pods = cluster_manager.list_pods(label_selector=f'job-name={job_name}')
-        if len(pods.items) == 1:
-            pod = pods.items[0]
-            if pod.status.phase in started_phases:
-                return PodPhase[pod.status.phase], pod
-
-        if len(pods.items) > 1:
-            raise JobStartException(f'Expected one pod for job {job_name}, '
-                                    f'instead found {len(pods.items)}.',
-                                    context={'last_pod_response': pods})
-
-        time.sleep(retry_wait)
-        countdown -= 1
-
+    if len(pod_list.items) > 1:
+        raise JobStartException(f'Expected one pod for job {job_name}, '
+                                f'instead found {len(pod_list.items)}.',
+                                context={'last_pod_response': pod_list})
+    if len(pod_list.items) == 1:
+        phase = pod_list.items[0].status.phase
+        if phase in (PodPhase.Running.value, PodPhase.Succeeded.value):
+            return PodPhase[phase]
+        if phase == PodPhase.Failed.value:
+            raise JobStartException(
+                'Pod failed to start.',
+                context={'last_pod_response': pod_list.to_dict()}
+            )
+
+
+def wait_for_pod_start(cluster_manager, job_name, deadline, namespace=None):
+    """
+    Wait until the pod related to `job_name` has started, following the
+    job's pods in the cluster's cache if synced or watching them for changes
+    otherwise, until `deadline`.
+    """
+    if cluster_manager.cache.synced:
+        return follow_cached_pod_start(cluster_manager.cache, job_name,
+                                       deadline, namespace)
+    label_selector = f'job-name={job_name}'
+    pod_list = cluster_manager.list_pods(label_selector=label_selector,
+                                         namespace=namespace)
+    while True:
+        phase = pod_start_phase(job_name, pod_list)
+        if phase:
+            return phase, pod_list.items[0]
+
+        timeout = remaining_seconds(deadline)
+        if not timeout:
+            raise JobStartException(
+                'Pod failed to start before the deadline.',
+                context={'last_pod_response': pod_list.to_dict()}
+            )
+
+        pods = {pod.metadata.name: pod for pod in pod_list.items}
+        events = cluster_manager.watch_pods(
+            label_selector, timeout_seconds=timeout,
+            resource_version=pod_list.metadata.resource_version,
+            namespace=namespace,
+        )
+        for event in events:
+            if event['type'] == 'ERROR':
+                break
+            pod = event['object']
+            if event['type'] == 'DELETED':
+                pods.pop(pod.metadata.name, None)
+            else:
+                pods[pod.metadata.name] = pod
+            pod_list.items = list(pods.values())
+            phase = pod_start_phase(job_name, pod_list)
+            if phase:
+                return phase, pod_list.items[0]
+        # the watch expired or failed, start over from the current state
+        pod_list = cluster_manager.list_pods(label_selector=label_selector,
+                                             namespace=namespace)
+
+
+def follow_cached_pod_start(cache, job_name, deadline, namespace=None):
+    """ Like `wait_for_pod_start`, following the pods in `cache`. """
+    for pod_list in cache.pods.follow(
+            lambda: cache.list_pods(job_name, namespace), deadline):
+        phase = pod_start_phase(job_name, pod_list)
+        if phase:
+            return phase, pod_list.items[0]
     raise JobStartException(
-        f'Pod failed to start after {n_retries * retry_wait} seconds.',
-        context={'last_pod_response': pods.to_dict()}
+        'Pod failed to start before the deadline.',
+        context={'last_pod_response': pod_list.to_dict()}
     )
 
 
-def setup_job_dependencies(batch_job, cluster_manager, gcloud_settings):
-    """ Create batch job's dependencies in the cluster. """
-    # create secret with gcloud credentials
+def create_gcs_secret(batch_job, cluster_manager, gcloud_settings):
+    """ Create the secret with gcloud credentials, unless it exists. """
     cluster_manager.create_secrets_file(
         name='gcs-api-key',
         filename='gcs-api-key.json',
         file_path=gcloud_settings['credentials_file_path'],
         # wont raise an exception if it already exists
         ignore_existing=True,
+        namespace=batch_job.namespace,
     )
+
+
+def setup_job_dependencies(batch_job, cluster_manager, owner):
+    """
+    Create batch job's PVCs in the cluster, owned by its `owner` Job so the
+    cluster deletes them along with it. The Job's pod waits for them.
+    """
     # create input PVC
     if batch_job.has_input_file:
         # TODO: create PVC with required size only
@@ -124,75 +263,190 @@ def setup_job_dependencies(batch_job, cluster_manager, gcloud_settings):
             build_config_from_template('pvc.yaml.j2', {
                 'name': batch_job.input_pvc_claim_name,
                 'storage_size': '100Gi',
-            })
+                'batch_job_name': batch_job.name,
+                'owner': owner.metadata,
+            }),
+            namespace=batch_job.namespace,
         )
     # create output PVC
     cluster_manager.create_pvc(
         build_config_from_template('pvc.yaml.j2', {
             'name': batch_job.output_pvc_claim_name,
-            'storage_size': '100Gi'
-        })
+            'storage_size': '100Gi',
+            'batch_job_name': batch_job.name,
+            'owner': owner.metadata,
+        }),
+        namespace=batch_job.namespace,
     )
+    batch_job.modify(set__dependencies_owned=True)
+
 
+def previous_attempt_exists(batch_job, cluster_manager):
+    """
+    Whether the Job or PVCs of `batch_job`'s failed attempt, which a retry
+    reuses the names of, are still being deleted.
+    """
+    namespace = batch_job.namespace
+    if cluster_manager.get_job(batch_job.name, ignore_404=True,
+                               namespace=namespace) is not None:
+        return True
+    pvc_names = [batch_job.output_pvc_claim_name]
+    if batch_job.has_input_file:
+        pvc_names.append(batch_job.input_pvc_claim_name)
+    return any(cluster_manager.get_pvc(pvc_name, ignore_404=True,
+                                       namespace=namespace) is not None
+               for pvc_name in pvc_names)
 
-def cluster_create_batch_job(batch_job, backoff_limit=0):
+
+def delete_created_job(cluster_manager, batch_job):
+    """
+    Delete `batch_job`'s Job, created before its deployment failed, along
+    with its pods.
+
+    Failures are only logged: the job's failed either way.
+    """
+    try:
+        cluster_manager.delete_job(batch_job.name, ignore_404=True,
+                                   namespace=batch_job.namespace)
+    except (ApiException, BackendUnavailable) as e:
+        logging.error(f'Failed to delete job {batch_job.name} after its '
+                      f'deployment failed: {e}')
+
+
+def purge_input_file(batch_job):
+    """
+    Remove `batch_job`'s input file from GridFS once it's uploaded to GCS,
+    where the job's pod downloads it from.
+
+    Failures are only logged: the file gets removed along with the job when
+    it expires (see `retention`).
+    """
+    input_file = batch_job.input_file
+    if input_file.grid_id is None:
+        return
+    batch_job.modify(set__input_uploaded=True,
+                     unset__job_parameters__input_zip=True)
+    try:
+        input_file.delete()
+    except Exception as e:
+        logging.error(f'Failed to remove the input file of job '
+                      f'{batch_job.name}: {e}')
+
+
+def cluster_create_batch_job(batch_job, backoff_limit=0,
+                             start_timeout=JOB_START_TIMEOUT):
     """
     - Create a new job with the configuration of `batch_job`.
-    - Polls the cluster until the job and its underlying pod have started.
+    - Watches the cluster until the job and its underlying pod have started,
+      for up to `start_timeout` seconds.
     - If successful returns the last job status.
     - Otherwise returns the reason for failure.
+
+    If the cluster or GCS are unavailable before the Job is created, the
+    job is queued again until they're back and `BackendUnavailable` raised.
+    Retries are queued again too while their failed attempt's Job or PVCs
+    are still being deleted.
     """
     job_name = batch_job.name
-    logging.info(f'Creating new job {job_name}')
-    cluster_manager = get_cluster_manager_instance()
+    logging.info(f'Creating new job {job_name} on cluster {batch_job.cluster}')
+    try:
+        cluster_manager = get_cluster_manager_instance(batch_job.cluster)
+    except ClusterError:
+        # e.g. the cluster was removed from the settings since
+        batch_job.set_failed()
+        raise
     context = {'cluster_response': None,
                'last_job_response': None,
                'last_pod_response': None}
 
     gcloud_settings = current_app.config['GOOGLE_CLOUD_SETTINGS']
 
-    # Deploy dependencies (PVCs, input file) and Job
+    # Deploy the Job and its dependencies (secret, input file, PVCs)
     try:
-        # make sure the required secrets and PVCs exist on the cluster
-        setup_job_dependencies(batch_job, cluster_manager, gcloud_settings)
-        # upload input file
-        if batch_job.has_input_file:
+        if batch_job.attempts and previous_attempt_exists(batch_job,
+                                                          cluster_manager):
+            logging.info(f'Job {job_name}\'s failed attempt is still being '
+                         'deleted. Queueing it again.')
+            batch_job.transition(BatchJobStatus.QUEUED.value,
+                                 retry_at=datetime.utcnow() + timedelta(
+                                     seconds=PREVIOUS_ATTEMPT_WAIT,
+                                 ))
+            return None, f'Job {batch_job.id} queued again'
+        # make sure the required secret exists on the cluster
+        create_gcs_secret(batch_job, cluster_manager, gcloud_settings)
+        # upload input file, unless a previous attempt did
+        if batch_job.has_input_file and not batch_job.input_uploaded:
             gcs_client = get_gcloud_client()
             gcs_client.upload_input_file(batch_job.input_file,
                                          f'{batch_job.name}-input.zip')
+            purge_input_file(batch_job)
         # actually launch job
         context['last_job_response'] = cluster_manager.create_job(
             build_config_from_template('job.yaml.j2', {
                 'backoff_limit': backoff_limit,
                 'bucket_name': gcloud_settings['bucket_name'],
                 'job': batch_job,
-            })
+                'priority_class_name': priority_class_name(
+                    batch_job.job_parameters.priority or 0,
+                    current_app.config.get('PRIORITY_CLASSES', {}),
+                ),
+                'ttl_seconds_after_finished': current_app.config.get(
+                    'JOB_TTL_SECONDS',
+                ),
+            }),
+            namespace=batch_job.namespace,
         )
+        # PVCs owned by the Job
+        setup_job_dependencies(batch_job, cluster_manager,
+                               context['last_job_response'])
+    except BackendUnavailable as e:
+        if context['last_job_response'] is not None:
+            # the Job can't be created again, fail as on other errors
+            error_message = (f'Backend unavailable while creating job '
+                             f'{job_name}')
+            logging.error(f'{error_message}: {e}')
+            delete_created_job(cluster_manager, batch_job)
+            batch_job.set_failed()
+            raise ClusterError(error_message)
+        logging.warning(f'Queueing job {job_name} again: {e}')
+        batch_job.transition(BatchJobStatus.QUEUED.value,
+                             retry_at=datetime.utcnow() + timedelta(
+                                 seconds=e.retry_after or 0,
+                             ))
+        raise
     except ApiException as e:
         error_message = f'API request failed while creating job {job_name}'
         logging.error(f'{error_message}: {e.body}')
+        if context['last_job_response'] is not None:
+            # the job is failed, don't leave its Job running
+            delete_created_job(cluster_manager, batch_job)
         batch_job.set_failed()
         raise ClusterError(error_message, context={
             'cluster_response': parse_cluster_exception(e),
         })
 
-    # Poll Job until it's started and then poll Pod until it's started.
+    # Wait until the Job has started and then until its Pod has started.
     # We need to do both because a Job may be active even if their underlying
     # Pods fail to start, e.g. when specifying an invalid Docker image.
+    deadline = time.monotonic() + start_timeout
     try:
         logging.debug(f'Waiting for job {job_name} to start.')
-        job_status, job_response = poll_job_until_start(cluster_manager,
-                                                        job_name)
+        job_status, job_response = wait_for_job_start(
+            cluster_manager, job_name, deadline, batch_job.namespace,
+        )
         context['last_job_response'] = job_response.to_dict()
         if job_status == ClusterJobStatus.Succeeded:
             # job finished successfully earlier than we could look
             logging.info(f'Job {job_name} completed successfully')
-            batch_job.update(start_time=job_response.status.start_time)
-            batch_job.set_cleaning()
+            batch_job.set_cleaning(
+                cluster_timestamp=job_response.status.completion_time,
+                start_time=job_response.status.start_time,
+            )
             return job_response, f'Job {batch_job.id} finished instantly'
         logging.debug(f'Waiting for job {job_name}\'s pod to start.')
-        pod_status, pod_response = poll_pod_until_start(cluster_manager,
-                                                        job_name)
+        pod_status, pod_response = wait_for_pod_start(
+            cluster_manager, job_name, deadline, batch_job.namespace,
+        )
         context['last_pod_response'] = pod_response.to_dict()
     except ApiException as e:
         batch_job.set_failed()
@@ -203,6 +457,11 @@ def cluster_create_batch_job(batch_job, backoff_limit=0):
             str(e),
             context={'cluster_response': parse_cluster_exception(e)},
         )
+    except BackendUnavailable as e:
+        batch_job.set_failed()
+        logging.error(f'Failed while waiting for job {job_name} to start: '
+                      f'{e}')
+        raise ClusterError(str(e), context=context)
     except JobStartException as e:
         batch_job.set_failed()
         error_message = ('Got unexpected response while waiting for job '
@@ -211,12 +470,14 @@ def cluster_create_batch_job(batch_job, backoff_limit=0):
         raise ClusterError(error_message, context=e.context)
 
     if pod_status == PodPhase.Succeeded:
-        batch_job.update(start_time=job_response.status.start_time)
-        batch_job.set_cleaning()
+        batch_job.set_cleaning(
+            cluster_timestamp=job_response.status.completion_time,
+            start_time=job_response.status.start_time,
+        )
         return job_response, f'Job {batch_job.id} finished instantly'
 
-    batch_job.set_running()
-    batch_job.update(set__start_time=job_response.status.start_time)
+    batch_job.set_running(cluster_timestamp=job_response.status.start_time,
+                          start_time=job_response.status.start_time)
     logging.info(f'Job {job_name} started successfully')
     return (
         job_response,
@@ -225,12 +486,39 @@ def cluster_create_batch_job(batch_job, backoff_limit=0):
 
 
 def cluster_stop_batch_job(batch_job):
-    """ Prematurely stop a running Job. """
-    cluster_manager = get_cluster_manager_instance()
-    batch_job.set_killed()
+    """
+    Prematurely stop a queued, created (whose Job may not exist yet) or
+    running Job.
+
+    The job is marked as killed first, atomically, so a concurrent
+    synchronization (or admission) can't move it forward in the meantime.
+    Raises `InvalidTransitionError` if its status changed, or
+    `BackendUnavailable` if its cluster is.
+    """
+    if batch_job.status == BatchJobStatus.QUEUED.value:
+        # nothing was deployed yet
+        batch_job.transition(BatchJobStatus.KILLED.value,
+                             stop_time=datetime.utcnow())
+        notify_batch_job_finished(batch_job)
+        return None
+
+    cluster_manager = get_cluster_manager_instance(batch_job.cluster)
+    # don't kill jobs which can't be deleted
+    cluster_manager.circuit_breaker.check()
+    deploying = batch_job.status == BatchJobStatus.CREATED.value
+    batch_job.transition(BatchJobStatus.KILLED.value,
+                         expected=(BatchJobStatus.CREATED.value,
+                                   BatchJobStatus.RUNNING.value,
+                                   BatchJobStatus.CLEANING.value),
+                         stop_time=datetime.utcnow())
+    notify_batch_job_finished(batch_job)
     try:
-        response = cluster_manager.delete_job(batch_job.name)
-        cleanup_job_dependencies(cluster_manager, batch_job)
+        # a Job created after this is deleted by the synchronization
+        response = cluster_manager.delete_job(batch_job.name,
+                                              ignore_404=deploying,
+                                              namespace=batch_job.namespace)
+        if not batch_job.dependencies_owned:
+            cleanup_job_dependencies(cluster_manager, batch_job)
     except ApiException as e:
         error_message = ('API request failed when deleting job '
                          f'{batch_job.name}')
@@ -239,26 +527,92 @@ def cluster_stop_batch_job(batch_job):
             error_message,
             context={'cluster_response': parse_cluster_exception(e)},
         )
-    batch_job.update(set__stop_time=datetime.utcnow())
     return response
 
 
-def launch_cleaner_job(batch_job, backoff_limit=0):
-    """ Deploy cleaning job for `batch_job`. """
+def launch_cleaner_job(batch_job, backoff_limit=0, owner=None):
+    """
+    Deploy cleaning job for `batch_job`, owned by its `owner` Job if given so
+    the cluster deletes it along with it.
+
+    Jobs deleted by the cluster after `JOB_TTL_SECONDS` don't own it, as they
+    could take it along while it's still uploading the output.
+    """
+    if current_app.config.get('JOB_TTL_SECONDS') is not None:
+        owner = None
     gcloud_settings = current_app.config['GOOGLE_CLOUD_SETTINGS']
-    cluster_manager = get_cluster_manager_instance()
+    cluster_manager = get_cluster_manager_instance(batch_job.cluster)
     cleanup_job_config = build_config_from_template('cleanup_job.yaml.j2', {
         'job': batch_job,
         'bucket_name': gcloud_settings['bucket_name'],
         'backoff_limit': backoff_limit,
+        'owner': owner.metadata if owner is not None else None,
     })
-    cluster_manager.create_job(cleanup_job_config)
+    cluster_manager.create_job(cleanup_job_config,
+                               namespace=batch_job.namespace)
 
 
 def cleanup_job_dependencies(cluster_manager, job):
-    """ Delete """
+    """
+    Delete the PVCs of `job`, for jobs whose PVCs aren't owned by their Job
+    (deployed before owner references were set).
+    """
     cluster_manager.delete_pvc(job.output_pvc_claim_name,
-                               ignore_404=True)
+                               ignore_404=True, namespace=job.namespace)
     if job.has_input_file:
         cluster_manager.delete_pvc(job.input_pvc_claim_name,
-                                   ignore_404=True)
+                                   ignore_404=True, namespace=job.namespace)
+
+
+def find_job_pod(cluster_manager, job_name, namespace=None):
+    """
+    Return the latest pod of `job_name`, None if there's none, from the
+    cluster's cache once it's synced.
+
+    Pods the cache doesn't have, e.g. of Jobs created before the runner
+    labelled them, are looked up on the cluster.
+    """
+    pods = None
+    if cluster_manager.cache.synced:
+        pods = cluster_manager.cache.list_pods(job_name, namespace)
+    if pods is None or not pods.items:
+        pods = cluster_manager.list_pods(
+            label_selector=f'job-name={job_name}', namespace=namespace,
+        )
+    if not pods.items:
+        return None
+    if len(pods.items) == 1:
+        return pods.items[0]
+    return max(pods.items, key=lambda pod: pod.metadata.creation_timestamp)
+
+
+def log_archive_name(job_name):
+    return f'{job_name}-logs.txt.gz'
+
+
+def archive_job_logs(cluster_manager, job_name, namespace=None):
+    """
+    Upload the logs of `job_name`'s pod to GCS, gzipped, before the job gets
+    deleted along with its pods.
+
+    Logs are compressed to a temporary file as they're read, so they're never
+    held in memory whole. Failures are only logged: missing logs shouldn't
+    keep the job from being deleted.
+    """
+    try:
+        pod = find_job_pod(cluster_manager, job_name, namespace)
+        if pod is None:
+            return
+        chunks = cluster_manager.stream_pod_log(pod.metadata.name,
+                                                namespace=namespace)
+        with tempfile.TemporaryFile() as archive:
+            with gzip.GzipFile(fileobj=archive, mode='wb') as compressed:
+                for chunk in chunks:
+                    compressed.write(chunk)
+            archive.seek(0)
+            get_gcloud_client().upload_file(archive,
+                                            log_archive_name(job_name),
+                                            content_type='text/plain',
+                                            content_encoding='gzip')
+    except (ApiException, StorageException, BackendUnavailable) as e:
+        logging.error(f'Failed to archive the logs of job {job_name}: {e}')
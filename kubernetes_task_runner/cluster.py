@@ -1,10 +1,127 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import time
 
-from kubernetes import client
+from kubernetes import client, watch
 from kubernetes.client.rest import ApiException
 from kubernetes.client import Configuration, ApiClient
+from urllib3.exceptions import ConnectTimeoutError, HTTPError
+
+from kubernetes_task_runner.informer import ClusterCache
+from kubernetes_task_runner.metrics import (BACKEND_RETRIES,
+                                            CLUSTER_API_CALL_LATENCY,
+                                            CLUSTER_API_RATE_LIMIT_WAIT,
+                                            CLUSTER_API_THROTTLED,
+                                            observe_latency)
+from kubernetes_task_runner.ratelimit import (RateLimiter, endpoint_lane,
+                                              retry_after)
+from kubernetes_task_runner.resilience import (MAX_RETRIES, CircuitBreaker,
+                                               backoff_delays)
+from kubernetes_task_runner.util import parse_quantity
+
+
+# bytes read at a time when streaming pod logs
+LOG_CHUNK_SIZE = 64 * 1024
+# seconds the cached node capacity is used for before being refreshed
+NODE_CAPACITY_MAX_AGE = 30
+# times a call throttled by the API server (429) is retried
+MAX_THROTTLED_RETRIES = 5
+# calls to these endpoints can be repeated, whatever became of the first one
+IDEMPOTENT_ENDPOINT_PREFIXES = ('read_', 'list_', 'delete_', 'replace_')
+
+# label of every object the task runner creates (see the templates)
+MANAGED_BY_LABEL = 'app.kubernetes.io/managed-by'
+MANAGED_BY = 'kubernetes-task-runner'
+RUNNER_LABEL_SELECTOR = f'{MANAGED_BY_LABEL}={MANAGED_BY}'
+# label with the name of the batch job an object belongs to
+BATCH_JOB_LABEL = 'kubernetes-task-runner/batch-job'
+
+
+def pod_requests(pod):
+    """ CPU cores and bytes of memory requested by `pod`. """
+    def requests(containers):
+        cpu = memory = 0
+        for container in containers or []:
+            container_requests = (container.resources
+                                  and container.resources.requests) or {}
+            cpu += parse_quantity(container_requests.get('cpu', 0))
+            memory += parse_quantity(container_requests.get('memory', 0))
+        return cpu, memory
+
+    cpu, memory = requests(pod.spec.containers)
+    # init containers run one at a time, before the others
+    for container in pod.spec.init_containers or []:
+        init_cpu, init_memory = requests([container])
+        cpu, memory = max(cpu, init_cpu), max(memory, init_memory)
+    return cpu, memory
+
+
+def is_server_failure(error):
+    """
+    Whether the API server failed to handle a call (connection errors and
+    5xx responses), as opposed to refusing it.
+    """
+    if isinstance(error, ApiException):
+        return (error.status or 0) >= 500
+    return True
+
+
+def was_sent(error):
+    """ Whether the failed call may have reached the API server. """
+    # urllib3 gives up with a `MaxRetryError` on connection errors
+    return not isinstance(getattr(error, 'reason', error),
+                          ConnectTimeoutError)
+
+
+class NodeCapacity:
+    """
+    CPU cores and bytes of memory of every schedulable node: `allocatable`
+    and `free` after the requests of the pods scheduled on it.
+    """
+
+    def __init__(self, allocatable, free):
+        self.allocatable = allocatable
+        self.free = free
+        self.refreshed_at = time.monotonic()
+
+    @classmethod
+    def from_cluster(cls, nodes, pods):
+        """ Compute the capacity of `nodes` with the active `pods`. """
+        allocatable = {}
+        for node in nodes:
+            if node.spec.unschedulable:
+                continue
+            resources = node.status.allocatable or {}
+            allocatable[node.metadata.name] = (
+                parse_quantity(resources.get('cpu', 0)),
+                parse_quantity(resources.get('memory', 0)),
+            )
+        free = dict(allocatable)
+        for pod in pods:
+            if pod.spec.node_name not in free:
+                continue
+            cpu, memory = pod_requests(pod)
+            free_cpu, free_memory = free[pod.spec.node_name]
+            free[pod.spec.node_name] = (free_cpu - cpu, free_memory - memory)
+        return cls(allocatable, free)
+
+    def fits_any_node(self, cpu, memory):
+        """ Whether the requests fit on some node when it's empty. """
+        return any(cpu <= node_cpu and memory <= node_memory
+                   for node_cpu, node_memory in self.allocatable.values())
+
+    def find_node(self, cpu, memory):
+        """ The node with the least room left that fits the requests now. """
+        fitting = [(free_cpu, free_memory, name)
+                   for name, (free_cpu, free_memory) in self.free.items()
+                   if cpu <= free_cpu and memory <= free_memory]
+        return min(fitting)[2] if fitting else None
+
+    def reserve(self, node_name, cpu, memory):
+        """ Account for requests placed on `node_name` until the refresh. """
+        free_cpu, free_memory = self.free[node_name]
+        self.free[node_name] = (free_cpu - cpu, free_memory - memory)
 
 
 class ClusterManager:
@@ -12,30 +129,158 @@ class ClusterManager:
     Manage interface to Kubernetes cluster.
     """
 
-    def __init__(self, host, api_key=None, namespace='default'):
+    def __init__(self, host, api_key=None, namespace='default', labels=None,
+                 namespaces=None, connection_pool_size=None, qps=None,
+                 burst=None):
         self._config = Configuration()
         self._config.host = host
         if api_key:
             self._config.api_key['authorization'] = api_key
+        if connection_pool_size is not None:
+            # the default is sized for threads, not for the greenlets
+            # serving the API, beyond which connections are thrown away
+            self._config.connection_pool_maxsize = connection_pool_size
         self._api_client = ApiClient(self._config)
+        # calls wait for a token of the limiter, if any
+        self._rate_limiter = (RateLimiter(qps, burst) if (qps or 0) > 0
+                              else None)
+        self.circuit_breaker = CircuitBreaker(
+            f'Kubernetes API {host}',
+            probe=client.VersionApi(api_client=self._api_client).get_code,
+        )
 
         self.apps_v1_beta2 = client.AppsV1beta2Api(api_client=self._api_client)
         self.core_v1 = client.CoreV1Api(api_client=self._api_client)
         self.batch_v1 = client.BatchV1Api(api_client=self._api_client)
+        # namespace of the jobs without one
         self.namespace = namespace
+        # every namespace jobs may run in
+        self.namespaces = [namespace] + [other for other in namespaces or []
+                                         if other != namespace]
+        # matched by the jobs' cluster selectors, see `placement`
+        self.labels = labels or {}
+        self._node_capacity = None
+        # the task runner's Jobs and Pods, once started
+        self.cache = ClusterCache(self)
+
+    def api_call(self, client, endpoint, ignore_404=False, namespaced=True,
+                 lane=None, **kwargs):
+        """
+        Call `endpoint` of `client`, waiting for the rate limiter in `lane`
+        (default by endpoint, see `endpoint_lane`).
+
+        Calls throttled by the API server are retried after the time it asks
+        for. Calls failing with connection errors or 5xx responses are
+        retried after `backoff_delays` if they're idempotent or didn't reach
+        the API server. Raises `BackendUnavailable` without calling while the
+        `circuit_breaker` is open.
+
+        Deletions retried after a try that may have gone through return None
+        if the object is gone by then.
+        """
+        if namespaced:
+            kwargs['namespace'] = kwargs.get('namespace') or self.namespace
+        kwargs['async'] = False
+        lane = endpoint_lane(endpoint) if lane is None else lane
+        idempotent = endpoint.startswith(IDEMPOTENT_ENDPOINT_PREFIXES)
+        delays = backoff_delays()
+        throttled = retries = 0
+        sent = False
+        while True:
+            self.circuit_breaker.check()
+            self.wait_for_rate_limit(lane)
+            try:
+                response = self._call(client, endpoint, ignore_404, kwargs)
+            except (ApiException, HTTPError) as e:
+                error = e
+            else:
+                self.circuit_breaker.record_success()
+                return response
+
+            if not is_server_failure(error):
+                self.circuit_breaker.record_success()
+                if (sent and error.status == 404
+                        and endpoint.startswith('delete_')):
+                    # deleted by a previous try
+                    return None
+                if error.status != 429 or throttled == MAX_THROTTLED_RETRIES:
+                    logging.error(str(error))
+                    raise error
+                # throttled calls weren't processed, retry them all
+                throttled += 1
+                delay = retry_after(error.headers)
+                CLUSTER_API_THROTTLED.labels(endpoint=endpoint).inc()
+            else:
+                self.circuit_breaker.record_failure()
+                if (retries == MAX_RETRIES
+                        or (was_sent(error) and not idempotent)):
+                    logging.error(str(error))
+                    raise error
+                retries += 1
+                sent = sent or was_sent(error)
+                delay = next(delays)
+                BACKEND_RETRIES.labels(
+                    backend=self.circuit_breaker.backend,
+                ).inc()
+            logging.warning(f'Call to {endpoint} failed ({error}), retrying '
+                            f'in {delay:.1f} seconds.')
+            time.sleep(delay)
 
-    def api_call(self, client, endpoint, ignore_404=False, **kwargs):
-        kwargs.update({
-            'namespace': kwargs.get('namespace', self.namespace),
-            'async': False,
-        })
+    @staticmethod
+    def _call(client, endpoint, ignore_404, kwargs):
+        with observe_latency(CLUSTER_API_CALL_LATENCY,
+                             outcome_label='status_code',
+                             endpoint=endpoint) as labels:
+            try:
+                response = getattr(client, endpoint)(**kwargs)
+            except ApiException as e:
+                labels['status_code'] = str(e.status)
+                if ignore_404 and e.status == 404:
+                    return None
+                raise
+            labels['status_code'] = '2xx'
+            return response
+
+    def wait_for_rate_limit(self, lane):
+        if self._rate_limiter is None:
+            return
+        waited = self._rate_limiter.acquire(lane)
+        CLUSTER_API_RATE_LIMIT_WAIT.labels(
+            lane=lane.name.lower(),
+        ).observe(waited)
+
+    def watch_call(self, client, endpoint, timeout_seconds,
+                   resource_version=None, namespaced=True, **kwargs):
+        """
+        Yield the watch events of the list `endpoint` for up to
+        `timeout_seconds`, starting after `resource_version` if given.
+
+        Events are dicts with the event `type` (ADDED, MODIFIED, DELETED or
+        ERROR) and the changed `object`.
+
+        Watches failing to connect or dropped by the API server count as
+        failures of the `circuit_breaker`, like failed calls, and watches
+        running until `timeout_seconds` as successes.
+        """
+        if namespaced:
+            kwargs['namespace'] = kwargs.get('namespace') or self.namespace
+        self.circuit_breaker.check()
+        self.wait_for_rate_limit(endpoint_lane(endpoint))
+        if resource_version is not None:
+            kwargs['resource_version'] = resource_version
+        stream = watch.Watch().stream(getattr(client, endpoint),
+                                      timeout_seconds=timeout_seconds,
+                                      **kwargs)
         try:
-            return getattr(client, endpoint)(**kwargs)
-        except ApiException as e:
-            if ignore_404 and e.status == 404:
-                return
-            logging.error(str(e))
+            yield from stream
+        except (ApiException, HTTPError) as e:
+            if is_server_failure(e):
+                self.circuit_breaker.record_failure()
             raise
+        else:
+            self.circuit_breaker.record_success()
+        finally:
+            stream.close()
 
     def restart_statefulset_pod(self, statefulset_name, pod_index):
         pod_name = f'{statefulset_name}-{pod_index}'
@@ -60,32 +305,194 @@ class ClusterManager:
                              endpoint='create_namespaced_pod',
                              body=pod_configuration)
 
-    def get_job(self, job_name):
+    def get_job(self, job_name, ignore_404=False, namespace=None):
         return self.api_call(client=self.batch_v1,
                              name=job_name,
-                             endpoint='read_namespaced_job')
+                             endpoint='read_namespaced_job',
+                             ignore_404=ignore_404,
+                             namespace=namespace)
 
-    def create_job(self, job_configuration):
+    def watch_job(self, job_name, timeout_seconds, resource_version=None,
+                  namespace=None):
+        return self.watch_call(client=self.batch_v1,
+                               endpoint='list_namespaced_job',
+                               field_selector=f'metadata.name={job_name}',
+                               timeout_seconds=timeout_seconds,
+                               resource_version=resource_version,
+                               namespace=namespace)
+
+    def create_job(self, job_configuration, namespace=None):
         job_name = job_configuration['metadata']['name']
         logging.info(f'Creating job {job_name} on the cluster.')
         return self.api_call(client=self.batch_v1,
                              endpoint='create_namespaced_job',
-                             body=job_configuration)
+                             body=job_configuration,
+                             namespace=namespace)
 
-    def list_pods(self, label_selector=None):
+    def list_pods(self, label_selector=None, namespace=None):
         api_arguments = {
             'client': self.core_v1,
             'endpoint': 'list_namespaced_pod',
+            'namespace': namespace,
         }
         if label_selector is not None:
             api_arguments['label_selector'] = label_selector
         return self.api_call(**api_arguments)
 
-    def list_jobs(self):
-        return self.api_call(client=self.batch_v1,
-                             endpoint='list_namespaced_job')
+    def watch_pods(self, label_selector, timeout_seconds,
+                   resource_version=None, namespace=None):
+        return self.watch_call(client=self.core_v1,
+                               endpoint='list_namespaced_pod',
+                               label_selector=label_selector,
+                               timeout_seconds=timeout_seconds,
+                               resource_version=resource_version,
+                               namespace=namespace)
 
-    def delete_job(self, job_name):
+    def stream_pod_log(self, pod_name, follow=False,
+                       chunk_size=LOG_CHUNK_SIZE, namespace=None):
+        """
+        Request the log of `pod_name` and return a generator of its chunks
+        (bytes), read as they're consumed. With `follow` the generator keeps
+        going as the pod writes more until it terminates.
+        """
+        response = self.api_call(client=self.core_v1,
+                                 endpoint='read_namespaced_pod_log',
+                                 name=pod_name, follow=follow,
+                                 _preload_content=False,
+                                 namespace=namespace)
+        return self._stream_response(response, chunk_size)
+
+    @staticmethod
+    def _stream_response(response, chunk_size):
+        try:
+            yield from response.stream(chunk_size)
+        finally:
+            response.close()
+            response.release_conn()
+
+    def refresh_node_capacity(self):
+        """
+        Recompute the nodes' capacity from every node and the active pods
+        scheduled on them, skipping pending and finished pods server side.
+        Leaves no capacity cached if there are no schedulable nodes.
+        """
+        nodes = self.api_call(client=self.core_v1, endpoint='list_node',
+                              namespaced=False)
+        pods = self.api_call(
+            client=self.core_v1, endpoint='list_pod_for_all_namespaces',
+            namespaced=False,
+            field_selector=('spec.nodeName!=,status.phase!=Succeeded,'
+                            'status.phase!=Failed'),
+        )
+        node_capacity = NodeCapacity.from_cluster(nodes.items, pods.items)
+        self._node_capacity = (node_capacity if node_capacity.allocatable
+                               else None)
+        return self._node_capacity
+
+    def node_capacity(self, max_age=NODE_CAPACITY_MAX_AGE, refresh=True):
+        """
+        Return the cached `NodeCapacity`, refreshing it first if it's older
+        than `max_age` seconds unless `refresh` is False. None if unknown.
+        """
+        cached = self._node_capacity
+        if refresh and (cached is None
+                        or time.monotonic() - cached.refreshed_at > max_age):
+            return self.refresh_node_capacity()
+        return cached
+
+    def refresh_node_capacity_forever(self, interval=NODE_CAPACITY_MAX_AGE):
+        """ Refresh the node capacity every `interval` seconds. """
+        while True:
+            try:
+                self.refresh_node_capacity()
+            except Exception as e:
+                logging.error(f'Failed to refresh the nodes\' capacity: {e}')
+            time.sleep(interval)
+
+    def list_jobs(self, label_selector=None, namespace=None):
+        api_arguments = {
+            'client': self.batch_v1,
+            'endpoint': 'list_namespaced_job',
+            'namespace': namespace,
+        }
+        if label_selector is not None:
+            api_arguments['label_selector'] = label_selector
+        return self.api_call(**api_arguments)
+
+    def list_managed(self, client, kind):
+        """
+        List the task runner's objects of `kind` (e.g. 'job') with a single
+        call, of all namespaces when there's more than one managed namespace.
+        """
+        if len(self.namespaces) == 1:
+            return self.api_call(client=client,
+                                 endpoint=f'list_namespaced_{kind}',
+                                 label_selector=RUNNER_LABEL_SELECTOR)
+        return self.api_call(client=client,
+                             endpoint=f'list_{kind}_for_all_namespaces',
+                             namespaced=False,
+                             label_selector=RUNNER_LABEL_SELECTOR)
+
+    def watch_managed(self, client, kind, timeout_seconds,
+                      resource_version=None):
+        """ Watch the objects `list_managed` lists. """
+        if len(self.namespaces) == 1:
+            return self.watch_call(client=client,
+                                   endpoint=f'list_namespaced_{kind}',
+                                   timeout_seconds=timeout_seconds,
+                                   resource_version=resource_version,
+                                   label_selector=RUNNER_LABEL_SELECTOR)
+        return self.watch_call(client=client,
+                               endpoint=f'list_{kind}_for_all_namespaces',
+                               timeout_seconds=timeout_seconds,
+                               resource_version=resource_version,
+                               namespaced=False,
+                               label_selector=RUNNER_LABEL_SELECTOR)
+
+    def list_managed_jobs(self):
+        """
+        The task runner's Jobs in every managed namespace, by namespace, from
+        the cache once it's synced.
+        """
+        if self.cache.synced:
+            return self.group_by_namespace(self.cache.jobs.list())
+        jobs = self.list_managed(self.batch_v1, 'job')
+        return self.group_by_namespace(jobs.items)
+
+    def list_managed_pvcs(self):
+        """ Like `list_managed_jobs`, for the task runner's PVCs. """
+        pvcs = self.list_managed(self.core_v1, 'persistent_volume_claim')
+        return self.group_by_namespace(pvcs.items)
+
+    def group_by_namespace(self, objects):
+        """ Group `objects` in the managed namespaces by namespace. """
+        grouped = {namespace: [] for namespace in self.namespaces}
+        for obj in objects:
+            # other namespaces may have objects of other copies of the runner
+            if obj.metadata.namespace in grouped:
+                grouped[obj.metadata.namespace].append(obj)
+        return grouped
+
+    def delete_collections(self, label_selector, namespace=None):
+        """
+        Delete the Jobs, pods and PVCs matching `label_selector` with a
+        single call per kind.
+
+        Collection deletes of this API version don't take a propagation
+        policy, so pods are deleted along with the Jobs rather than left to
+        the garbage collector.
+        """
+        logging.info(f'Deleting Jobs, pods and PVCs matching {label_selector} '
+                     'from the cluster.')
+        for api_client, endpoint in (
+                (self.batch_v1, 'delete_collection_namespaced_job'),
+                (self.core_v1, 'delete_collection_namespaced_pod'),
+                (self.core_v1,
+                 'delete_collection_namespaced_persistent_volume_claim')):
+            self.api_call(client=api_client, endpoint=endpoint,
+                          label_selector=label_selector, namespace=namespace)
+
+    def delete_job(self, job_name, ignore_404=False, namespace=None):
         delete_options = client.V1DeleteOptions(
             propagation_policy='Background',  # delete associated pods
             grace_period_seconds=0,  # delete right away
@@ -96,18 +503,30 @@ class ClusterManager:
         return self.api_call(client=self.batch_v1,
                              endpoint='delete_namespaced_job',
                              name=job_name,
-                             body=delete_options)
+                             body=delete_options,
+                             ignore_404=ignore_404,
+                             namespace=namespace)
 
-    def create_pvc(self, pvc_configuration):
+    def create_pvc(self, pvc_configuration, namespace=None):
         pvc_name = pvc_configuration['metadata']['name']
         logging.info(f'Creating PVC {pvc_name} on the cluster.')
         return self.api_call(
             client=self.core_v1,
             endpoint='create_namespaced_persistent_volume_claim',
             body=pvc_configuration,
+            namespace=namespace,
         )
 
-    def delete_pvc(self, pvc_name, ignore_404=False):
+    def get_pvc(self, pvc_name, ignore_404=False, namespace=None):
+        return self.api_call(
+            client=self.core_v1,
+            endpoint='read_namespaced_persistent_volume_claim',
+            name=pvc_name,
+            ignore_404=ignore_404,
+            namespace=namespace,
+        )
+
+    def delete_pvc(self, pvc_name, ignore_404=False, namespace=None):
         delete_options = client.V1DeleteOptions(
             propagation_policy='Background',
             grace_period_seconds=0,  # delete right away
@@ -120,11 +539,12 @@ class ClusterManager:
             endpoint='delete_namespaced_persistent_volume_claim',
             body=delete_options,
             name=pvc_name,
-            ignore_404=ignore_404
+            ignore_404=ignore_404,
+            namespace=namespace,
         )
 
     def create_secrets_file(self, name, file_path, ignore_existing=False,
-                            filename=None):
+                            filename=None, namespace=None):
         """
         Read `file_path` and create a secret with `name`.
 
@@ -136,7 +556,7 @@ class ClusterManager:
         """
         if ignore_existing:
             try:
-                existing = self.read_secret(name)
+                existing = self.read_secret(name, namespace=namespace)
                 if existing:
                     return
             except ApiException as e:
@@ -154,14 +574,16 @@ class ClusterManager:
         )
         return self.api_call(client=self.core_v1,
                              endpoint='create_namespaced_secret',
-                             body=secret_body)
+                             body=secret_body,
+                             namespace=namespace)
 
-    def read_secret(self, name):
+    def read_secret(self, name, namespace=None):
         return self.api_call(client=self.core_v1,
                              endpoint='read_namespaced_secret',
-                             name=name)
+                             name=name,
+                             namespace=namespace)
 
-    def delete_secret(self, name):
+    def delete_secret(self, name, namespace=None):
         logging.info(f'Deleting secret {name} from the cluster.')
         delete_options = client.V1DeleteOptions(
             grace_period_seconds=0,
@@ -171,4 +593,5 @@ class ClusterManager:
         return self.api_call(client=self.core_v1,
                              endpoint='delete_namespaced_secret',
                              name=name,
-                             body=delete_options)
+                             body=delete_options,
+                             namespace=namespace)
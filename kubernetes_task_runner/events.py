@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Batch job status change events, streamed to clients as server-sent events.
+
+Events are read from a MongoDB change stream on the `batch_jobs` collection
+when the server supports them (replica sets and sharded clusters). Otherwise
+they're broadcast in-process as status transitions are recorded, which only
+covers the status changes made by the current process.
+
+Every event has an `id` clients can resume from: the change stream's resume
+token, or a sequence number for the in-process broadcast.
+"""
+import itertools
+from collections import deque
+
+from bson import json_util
+from gevent.queue import Empty, Queue
+from pymongo.errors import OperationFailure
+
+# seconds without events after which streams yield a heartbeat (None)
+HEARTBEAT_INTERVAL = 15
+# events the in-process broadcast keeps around for resuming
+HISTORY_SIZE = 1000
+
+
+def build_event(event_id, job_id, status, timestamp=None,
+                cluster_timestamp=None):
+    return {
+        'id': event_id,
+        'job_id': job_id,
+        'status': status,
+        'timestamp': timestamp,
+        'cluster_timestamp': cluster_timestamp,
+    }
+
+
+def event_matches(event, job_id=None, statuses=None):
+    if job_id is not None and event['job_id'] != job_id:
+        return False
+    return not statuses or event['status'] in statuses
+
+
+class Broadcaster:
+    """
+    In-process fan-out of status change events to the open streams.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        self._subscribers = set()
+        self._history = deque(maxlen=history_size)
+        self._sequence = itertools.count(1)
+
+    @property
+    def last_event_id(self):
+        return self._history[-1]['id'] if self._history else '0'
+
+    def publish(self, job_id, status, timestamp=None,
+                cluster_timestamp=None):
+        event = build_event(str(next(self._sequence)), job_id, status,
+                            timestamp, cluster_timestamp)
+        self._history.append(event)
+        for queue in self._subscribers:
+            queue.put(event)
+
+    def subscribe(self, job_id=None, statuses=None, last_event_id=None,
+                  heartbeat=HEARTBEAT_INTERVAL):
+        """
+        Return a generator of the events matching `job_id` and `statuses`,
+        starting with the ones published after `last_event_id` that are
+        still in the history. Yields None after `heartbeat` seconds without
+        events.
+
+        Raises `ValueError` if `last_event_id` isn't a valid event id.
+        """
+        last_sequence = (int(last_event_id) if last_event_id is not None
+                         else None)
+        return self._stream(job_id, statuses, last_sequence, heartbeat)
+
+    def _stream(self, job_id, statuses, last_sequence, heartbeat):
+        queue = Queue()
+        if last_sequence is not None:
+            for event in self._history:
+                if int(event['id']) > last_sequence:
+                    queue.put(event)
+        self._subscribers.add(queue)
+        try:
+            while True:
+                try:
+                    event = queue.get(timeout=heartbeat)
+                except Empty:
+                    yield None
+                    continue
+                if event_matches(event, job_id, statuses):
+                    yield event
+        finally:
+            self._subscribers.discard(queue)
+
+
+broadcaster = Broadcaster()
+
+
+def pushed_transition(updated_fields):
+    """ Find the status transition pushed by an update. """
+    for field, value in updated_fields.items():
+        if field.startswith('status_transitions.'):
+            return value
+    transitions = updated_fields.get('status_transitions')
+    if transitions:
+        return transitions[-1]
+    return {}
+
+
+def watch_collection(collection, job_id=None, statuses=None,
+                     last_event_id=None, heartbeat=HEARTBEAT_INTERVAL):
+    """
+    Open a change stream on `collection` for the status changes matching
+    `job_id` and `statuses`, resuming after `last_event_id` if given, and
+    return a generator of its events. Yields None after `heartbeat` seconds
+    without events.
+
+    Raises `ValueError` if `last_event_id` isn't a valid event id and
+    `OperationFailure` if the stream can't be opened or resumed.
+    """
+    match = {
+        'operationType': 'update',
+        'updateDescription.updatedFields.status': (
+            {'$in': list(statuses)} if statuses else {'$exists': True}
+        ),
+    }
+    if job_id is not None:
+        match['documentKey._id'] = job_id
+    resume_after = (json_util.loads(last_event_id)
+                    if last_event_id is not None else None)
+    stream = collection.watch([{'$match': match}], resume_after=resume_after,
+                              max_await_time_ms=heartbeat * 1000)
+    return _change_stream_events(stream)
+
+
+def _change_stream_events(stream):
+    with stream:
+        while stream.alive:
+            change = stream.try_next()
+            if change is None:
+                yield None
+                continue
+            updated_fields = change['updateDescription']['updatedFields']
+            transition = pushed_transition(updated_fields)
+            yield build_event(json_util.dumps(change['_id']),
+                              change['documentKey']['_id'],
+                              updated_fields['status'],
+                              transition.get('timestamp'),
+                              transition.get('cluster_timestamp'))
+
+
+_change_streams_supported = {}
+
+
+def supports_change_streams(collection):
+    """ Whether the database behind `collection` supports change streams. """
+    name = collection.full_name
+    if name not in _change_streams_supported:
+        try:
+            collection.watch().close()
+        except (AttributeError, NotImplementedError, OperationFailure,
+                TypeError):
+            # mongomock (where `watch` is a subcollection) or a standalone
+            # server
+            _change_streams_supported[name] = False
+        else:
+            _change_streams_supported[name] = True
+    return _change_streams_supported[name]
+
+
+def open_event_stream(collection, job_id=None, statuses=None,
+                      last_event_id=None):
+    """
+    Return a generator of the status change events on `collection` matching
+    `job_id` and `statuses`, from a change stream if supported or from the
+    in-process broadcast otherwise.
+    """
+    if supports_change_streams(collection):
+        return watch_collection(collection, job_id, statuses, last_event_id)
+    return broadcaster.subscribe(job_id, statuses, last_event_id)
@@ -8,6 +8,14 @@ class InvalidStateError(Exception):
     pass
 
 
+class InvalidTransitionError(InvalidStateError):
+    """
+    Raised when a batch job can't move to a status, either because the
+    transition isn't allowed or because its status changed concurrently.
+    """
+    pass
+
+
 class NotReadyError(Exception):
     """
     Raised if the processing pipeline is not ready.
@@ -44,3 +52,15 @@ class StorageException(Exception):
     Thrown when an GCSCloud operation fails.
     """
     pass
+
+
+class BackendUnavailable(Exception):
+    """
+    Raised instead of calling a backend (a cluster's API server or GCS)
+    while its circuit breaker is open. It may be back in `retry_after`
+    seconds.
+    """
+
+    def __init__(self, message='', retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
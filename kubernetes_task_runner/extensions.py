@@ -1,20 +1,68 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 import os
 import re
 from functools import wraps
 
 import click
+import yaml
 from flask import current_app
 from jinja2 import Environment, FileSystemLoader
+from kubernetes_task_runner.admission import parse_limits
 from kubernetes_task_runner.cluster import ClusterManager
+from kubernetes_task_runner.exceptions import ClusterError
 from kubernetes_task_runner.gcloud import GCSClient
+from kubernetes_task_runner.models import DEFAULT_CLUSTER
+from kubernetes_task_runner.placement import LEAST_LOADED, PLACEMENT_POLICIES
 
 
-def get_cluster_manager_instance(**kubernetes_settings):
+# finished Jobs must outlive their synchronization and cleanup job, which the
+# cluster would delete along with them
+MIN_JOB_TTL_SECONDS = 3600
+
+# one ClusterManager per settings, so their API clients and caches are reused
+_cluster_managers = {}
+
+
+def get_clusters_settings():
+    """
+    Settings of every cluster by name, in order of preference.
+    `KUBERNETES_SETTINGS` holds either the settings of a single cluster,
+    named `DEFAULT_CLUSTER`, or those of several named ones:
+
+        {'eu': {'host': 'https://eu.example.com', 'namespace': 'jobs',
+                'namespaces': ['tenant-a'], 'labels': {'region': 'eu'}},
+         'us': {'host': 'https://us.example.com', 'labels': {'region': 'us'}}}
+    """
+    settings = current_app.config['KUBERNETES_SETTINGS']
+    if 'host' in settings:
+        return {DEFAULT_CLUSTER: settings}
+    return settings
+
+
+def get_cluster_manager_instance(cluster=None, **kubernetes_settings):
+    """
+    Return the pooled ClusterManager of the `cluster` name (default is the
+    first one), or of the given `kubernetes_settings`, which may override
+    the rate limit of every cluster.
+    """
     if not kubernetes_settings:
-        kubernetes_settings = current_app.config['KUBERNETES_SETTINGS']
-    return ClusterManager(**kubernetes_settings)
+        clusters = get_clusters_settings()
+        cluster = cluster or next(iter(clusters))
+        if cluster not in clusters:
+            raise ClusterError(f'Unknown cluster {cluster}.')
+        kubernetes_settings = clusters[cluster]
+    key = json.dumps(kubernetes_settings, sort_keys=True)
+    if key not in _cluster_managers:
+        _cluster_managers[key] = ClusterManager(**{
+            'connection_pool_size': current_app.config.get(
+                'CONNECTION_POOL_SIZE',
+            ),
+            **current_app.config.get('KUBERNETES_RATE_LIMIT', {}),
+            **kubernetes_settings,
+        })
+    return _cluster_managers[key]
 
 
 def get_gcloud_client(**google_cloud_settings):
@@ -23,6 +71,48 @@ def get_gcloud_client(**google_cloud_settings):
     return GCSClient(**google_cloud_settings)
 
 
+def get_admission_limits(**admission_settings):
+    """ Overall and per owner admission `Limits`. """
+    if not admission_settings:
+        admission_settings = current_app.config.get('ADMISSION_SETTINGS', {})
+    return parse_limits(admission_settings)
+
+
+def parse_clusters_file(ctx, param, value):
+    """
+    Load the settings of more named clusters from a YAML file, e.g.:
+
+        us:
+          host: https://us.example.com
+          api_key: ...
+          namespace: jobs
+          namespaces: [tenant-a, tenant-b]
+          labels: {region: us}
+    """
+    if value is None:
+        return {}
+    with open(value) as clusters_file:
+        clusters = yaml.safe_load(clusters_file) or {}
+    if not isinstance(clusters, dict):
+        raise click.BadParameter('Expected a mapping of cluster names.')
+    for name, settings in clusters.items():
+        if not isinstance(settings, dict) or 'host' not in settings:
+            raise click.BadParameter(f'Cluster {name} has no host.')
+    return clusters
+
+
+def parse_priority_classes(ctx, param, value):
+    """ Parse PriorityClass `name=value` pairs, e.g. 'bulk=-10,urgent=100'. """
+    priority_classes = {}
+    for pair in filter(None, (value or '').split(',')):
+        name, _, priority = pair.partition('=')
+        try:
+            priority_classes[name.strip()] = int(priority)
+        except ValueError:
+            raise click.BadParameter(f'Invalid priority class: {pair}')
+    return priority_classes
+
+
 def app_config_reader(func):
     """
     Parses common app config parameters, groups them and passes them as a
@@ -39,6 +129,9 @@ def app_config_reader(func):
     @click.argument('KUBERNETES_API_URL', envvar='KUBERNETES_API_URL')
     @click.argument('KUBERNETES_NAMESPACE', envvar='KUBERNETES_NAMESPACE',
                     default='default')
+    @click.option('--kubernetes-namespaces', envvar='KUBERNETES_NAMESPACES',
+                  default='',
+                  help='Comma separated namespaces jobs may also run in.')
     @click.argument('LOG_LEVEL', envvar='LOG_LEVEL', default='WARNING',
                     type=click.Choice(logging._levelToName.values()))
     @click.argument('GC_BUCKET_NAME', envvar='GC_BUCKET_NAME')
@@ -49,31 +142,100 @@ def app_config_reader(func):
                     envvar='JOB_SYNCHRONIZATION_INTERVAL',
                     type=click.INT, default=30)
     @click.option('--kubernetes-api-key', envvar='KUBERNETES_API_KEY')
+    @click.option('--connection-pool-size', envvar='CONNECTION_POOL_SIZE',
+                  type=click.IntRange(min=1), default=100,
+                  help='Connections kept to MongoDB and to each Kubernetes '
+                       'API, for the requests served at a time.')
+    @click.option('--kubernetes-qps', envvar='KUBERNETES_QPS',
+                  type=click.FLOAT, default=50,
+                  help='Calls a second to each Kubernetes API, 0 for no '
+                       'limit.')
+    @click.option('--kubernetes-burst', envvar='KUBERNETES_BURST',
+                  type=click.IntRange(min=1), default=100,
+                  help='Calls to each Kubernetes API allowed at once above '
+                       'the QPS.')
+    @click.option('--job-retention-days', envvar='JOB_RETENTION_DAYS',
+                  type=click.IntRange(min=1),
+                  help='Days finished jobs are kept before being archived.')
+    @click.option('--job-ttl-seconds', envvar='JOB_TTL_SECONDS',
+                  type=click.IntRange(min=MIN_JOB_TTL_SECONDS),
+                  help='Seconds the cluster keeps finished Jobs before '
+                       'deleting them (ttlSecondsAfterFinished).')
+    @click.option('--kubernetes-clusters', envvar='KUBERNETES_CLUSTERS',
+                  type=click.Path(exists=True, dir_okay=False),
+                  callback=parse_clusters_file,
+                  help='YAML file with the settings of more named clusters.')
+    @click.option('--placement-policy', envvar='PLACEMENT_POLICY',
+                  type=click.Choice(PLACEMENT_POLICIES), default=LEAST_LOADED,
+                  help='How new jobs are placed on the clusters.')
+    @click.option('--max-running-jobs', envvar='MAX_RUNNING_JOBS',
+                  type=click.IntRange(min=0))
+    @click.option('--max-cpu', envvar='MAX_CPU',
+                  help='CPU requested by all active jobs, e.g. 64.')
+    @click.option('--max-memory', envvar='MAX_MEMORY',
+                  help='Memory requested by all active jobs, e.g. 256Gi.')
+    @click.option('--max-running-jobs-per-owner',
+                  envvar='MAX_RUNNING_JOBS_PER_OWNER',
+                  type=click.IntRange(min=0))
+    @click.option('--max-cpu-per-owner', envvar='MAX_CPU_PER_OWNER')
+    @click.option('--max-memory-per-owner', envvar='MAX_MEMORY_PER_OWNER')
+    @click.option('--priority-classes', envvar='PRIORITY_CLASSES',
+                  callback=parse_priority_classes,
+                  help='PriorityClasses for job priorities, e.g. '
+                       '\'bulk=-10,urgent=100\'.')
     def wrapper(*args, **kwargs):
         app_config = {
             'LOG_LEVEL': kwargs.pop('log_level'),
             'JOB_SYNCHRONIZATION_INTERVAL': kwargs.pop(
                 'job_synchronization_interval',
             ),
+            'JOB_RETENTION_DAYS': kwargs.pop('job_retention_days'),
+            'JOB_TTL_SECONDS': kwargs.pop('job_ttl_seconds'),
             'CELERY_BROKER_URL': kwargs.pop('celery_broker_url'),
+            'CONNECTION_POOL_SIZE': kwargs['connection_pool_size'],
             'MONGODB_SETTINGS': {
                 'db': kwargs.pop('mongodb_database'),
                 'host': kwargs.pop('mongodb_host'),
-                'port': kwargs.pop('mongodb_port')
+                'port': kwargs.pop('mongodb_port'),
+                'maxPoolSize': kwargs.pop('connection_pool_size'),
             },
             'KUBERNETES_SETTINGS': {
-                'api_key': kwargs.pop('kubernetes_api_key'),
-                'host': kwargs.pop('kubernetes_api_url'),
-                'namespace': kwargs.pop('kubernetes_namespace'),
+                DEFAULT_CLUSTER: {
+                    'api_key': kwargs.pop('kubernetes_api_key'),
+                    'host': kwargs.pop('kubernetes_api_url'),
+                    'namespace': kwargs.pop('kubernetes_namespace'),
+                    'namespaces': list(filter(None, (
+                        namespace.strip() for namespace in
+                        kwargs.pop('kubernetes_namespaces').split(',')
+                    ))),
+                },
+                # may override the default cluster too
+                **kwargs.pop('kubernetes_clusters'),
             },
+            'KUBERNETES_RATE_LIMIT': {
+                'qps': kwargs.pop('kubernetes_qps'),
+                'burst': kwargs.pop('kubernetes_burst'),
+            },
+            'PLACEMENT_POLICY': kwargs.pop('placement_policy'),
             'GOOGLE_CLOUD_SETTINGS': {
                 'bucket_name': kwargs.pop('gc_bucket_name'),
                 'credentials_file_path': kwargs.pop(
                     'gc_credentials_file_path'
                 ),
             },
+            'ADMISSION_SETTINGS': {
+                setting: kwargs.pop(setting)
+                for setting in ('max_running_jobs', 'max_cpu', 'max_memory',
+                                'max_running_jobs_per_owner',
+                                'max_cpu_per_owner', 'max_memory_per_owner')
+            },
+            'PRIORITY_CLASSES': kwargs.pop('priority_classes'),
             'TEMPLATE_ENVIRONMENT': configure_template_environment(),
         }
+        try:
+            get_admission_limits(**app_config['ADMISSION_SETTINGS'])
+        except ValueError as e:
+            raise click.BadParameter(str(e))
         kwargs['app_config'] = app_config
         return func(*args, **kwargs)
     return wrapper
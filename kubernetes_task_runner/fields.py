@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from mongoengine import fields
 
+from kubernetes_task_runner.util import parse_quantity
+
 
 class ExtendedStringField(fields.StringField):
     """
@@ -28,9 +30,6 @@ class KubernetesResourceField(fields.DictField):
         'limits':   {'cpu': '500m', 'memory': '128Mi'},
         'requests': {'cpu': '500m', 'memory': '128Mi'}
       }
-
-    Note: for now only the structure is validated, but the actual values are
-    not.
     """
 
     def _validate_single_resource_object(self, value, name):
@@ -41,6 +40,11 @@ class KubernetesResourceField(fields.DictField):
         if extra_keys:
             self.error(f'A {name} can only specify \'cpu\' or \'memory\'. '
                        f'Found: {extra_keys}')
+        for quantity in single_resource.values():
+            try:
+                parse_quantity(quantity)
+            except ValueError as e:
+                self.error(f'Invalid {name}: {e}')
 
     def validate(self, value):
         super().validate(value)
@@ -1,45 +1,138 @@
 # -*- coding: utf-8 -*-
+import logging
+import time
 from datetime import datetime, timedelta
+from functools import partial
 
 from google.api_core.exceptions import GoogleAPICallError
-from google.auth.exceptions import GoogleAuthError
+from google.auth.exceptions import GoogleAuthError, TransportError
 from google.cloud.storage import Client
+from requests.exceptions import RequestException
 
 from kubernetes_task_runner.exceptions import StorageException
+from kubernetes_task_runner.metrics import (BACKEND_RETRIES,
+                                            GCS_OPERATION_LATENCY,
+                                            observe_latency)
+from kubernetes_task_runner.resilience import (MAX_RETRIES, CircuitBreaker,
+                                               backoff_delays)
 
 
 URL_DURATION_SECONDS = 3600 * 24 * 30  # 30 days
+# errors of the GCS operations, raised as `StorageException`
+GCS_ERRORS = (GoogleAPICallError, GoogleAuthError, RequestException)
+
+# circuit breakers of the buckets, shared by their clients
+_circuit_breakers = {}
+
+
+def load_bucket(credentials_file_path, bucket_name):
+    client = Client.from_service_account_json(credentials_file_path)
+    return client.get_bucket(bucket_name)
+
+
+def is_server_failure(error):
+    """
+    Whether GCS failed to handle an operation (connection errors and 5xx
+    responses), as opposed to refusing it.
+    """
+    if isinstance(error, GoogleAPICallError):
+        return (error.code or 0) >= 500
+    return isinstance(error, (RequestException, TransportError))
 
 
 class GCSClient:
-    """ Google Cloud Storage interface. """
+    """
+    Google Cloud Storage interface.
+
+    Every operation is idempotent (uploads overwrite the same blob), so
+    failed ones are all retried, see `resilience`.
+    """
 
     def __init__(self, credentials_file_path, bucket_name):
         self._credentials_file_path = credentials_file_path
         self._bucket_name = bucket_name
-        try:
-            self._client = Client.from_service_account_json(
-                self._credentials_file_path,
+        if bucket_name not in _circuit_breakers:
+            _circuit_breakers[bucket_name] = CircuitBreaker(
+                f'GCS bucket {bucket_name}',
+                probe=partial(load_bucket, credentials_file_path,
+                              bucket_name),
             )
-            self._bucket = self._client.get_bucket(self._bucket_name)
-        except (GoogleAuthError, GoogleAPICallError) as e:
+        self.circuit_breaker = _circuit_breakers[bucket_name]
+        try:
+            self._bucket = self._call('get_bucket', load_bucket,
+                                      credentials_file_path, bucket_name)
+        except GCS_ERRORS as e:
             raise StorageException(f'Failed to initialize GCSClient: {e}')
 
+    def _call(self, operation, func, *args, file_obj=None, **kwargs):
+        """
+        Run `func` for `operation`, retrying failures after `backoff_delays`
+        and rewinding `file_obj` first if given. Raises `BackendUnavailable`
+        without running it while the bucket's `circuit_breaker` is open.
+        """
+        position = file_obj.tell() if file_obj is not None else None
+        delays = backoff_delays()
+        retries = 0
+        while True:
+            self.circuit_breaker.check()
+            if position is not None:
+                file_obj.seek(position)
+            try:
+                with observe_latency(GCS_OPERATION_LATENCY,
+                                     outcome_label='status',
+                                     operation=operation):
+                    result = func(*args, **kwargs)
+            except GCS_ERRORS as e:
+                if is_server_failure(e):
+                    self.circuit_breaker.record_failure()
+                else:
+                    self.circuit_breaker.record_success()
+                throttled = getattr(e, 'code', None) == 429
+                if retries == MAX_RETRIES or not (is_server_failure(e)
+                                                  or throttled):
+                    raise
+                retries += 1
+                delay = next(delays)
+                BACKEND_RETRIES.labels(
+                    backend=self.circuit_breaker.backend,
+                ).inc()
+                logging.warning(f'GCS {operation} failed ({e}), retrying in '
+                                f'{delay:.1f} seconds.')
+                time.sleep(delay)
+            else:
+                self.circuit_breaker.record_success()
+                return result
+
     def upload_input_file(self, input_file, filename):
         blob = self._bucket.blob(filename)
         try:
-            blob.upload_from_file(input_file)
-        except GoogleAPICallError as e:
+            self._call('upload', blob.upload_from_file, input_file,
+                       file_obj=input_file)
+        except GCS_ERRORS as e:
             raise StorageException(f'Failed to upload file {filename}: {e}')
 
+    def upload_file(self, file_obj, blob_name, content_type=None,
+                    content_encoding=None):
+        """
+        Upload `file_obj` from its current position. `content_encoding` is
+        stored so GCS decompresses e.g. gzipped files on download.
+        """
+        blob = self._bucket.blob(blob_name)
+        blob.content_encoding = content_encoding
+        try:
+            self._call('upload', blob.upload_from_file, file_obj,
+                       content_type=content_type, file_obj=file_obj)
+        except GCS_ERRORS as e:
+            raise StorageException(f'Failed to upload file {blob_name}: {e}')
+
     def get_output_file_url(self, blob_name):
         try:
-            blob = self._bucket.get_blob(blob_name)
+            blob = self._call('get_blob', self._bucket.get_blob, blob_name)
             if blob is None:
                 raise OSError(
                     f'No file {blob_name} in bucket {self._bucket_name}'
                 )
-        except (GoogleAPICallError, OSError) as e:
+        except GCS_ERRORS + (OSError,) as e:
             raise StorageException(f'Failed to retrieve file {blob_name}: {e}')
         # NOTE: GCS' signed URLs *require* an expiration time
         return blob.generate_signed_url(
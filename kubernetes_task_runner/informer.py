@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Informer-style cache of the task runner's Jobs and Pods on a cluster.
+
+Like client-go's informers, every `Informer` lists the labelled objects once,
+then watches them from the list's resource version and applies every change
+to its store. It lists them again when the watch fails, e.g. once its
+resource version is too old. Reads never call the API server: the API, the
+creations and the synchronization share the cache of every cluster, and only
+call the API server themselves until it's `synced`.
+
+The caches are started by the long running processes (see
+`server.start_background_tasks` and `tasks.start_cluster_caches`).
+"""
+import logging
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+from kubernetes import client
+
+# seconds a watch lasts before being started again from where it was
+WATCH_TIMEOUT = 300
+# seconds to wait for before listing again after a failure
+RELIST_DELAY = 5
+# label Kubernetes sets on the pods of a Job, with its name
+JOB_NAME_LABEL = 'job-name'
+
+
+def object_key(obj):
+    return obj.metadata.namespace, obj.metadata.name
+
+
+class Informer:
+    """
+    Store of the objects listed by `list_objects()` and kept current with
+    the events of `watch_objects(resource_version, timeout_seconds)`, by
+    namespace and name, and indexed by `index_key(obj)`.
+    """
+
+    def __init__(self, kind, list_objects, watch_objects,
+                 index_key=object_key):
+        self.kind = kind
+        self.synced = False
+        # changes applied so far, see `follow`
+        self.version = 0
+        self._list_objects = list_objects
+        self._watch_objects = watch_objects
+        self._index_key = index_key
+        self._objects = {}
+        self._index = defaultdict(set)
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """ List and watch the objects in the background, once. """
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.list_and_watch()
+            except Exception as e:
+                logging.error(f'Failed to watch the {self.kind}: {e}')
+                with self._condition:
+                    # don't serve objects going stale
+                    self.synced = False
+                time.sleep(RELIST_DELAY)
+
+    def list_and_watch(self):
+        """ List the objects, then watch them until the watch fails. """
+        object_list = self._list_objects()
+        with self._condition:
+            self._objects.clear()
+            self._index.clear()
+            for obj in object_list.items:
+                self._store(obj)
+            self._changed()
+            self.synced = True
+        resource_version = object_list.metadata.resource_version
+        while True:
+            events = self._watch_objects(resource_version, WATCH_TIMEOUT)
+            for event in events:
+                if event['type'] == 'ERROR':
+                    # e.g. the resource version is gone, list them again
+                    logging.warning(f'Watch of the {self.kind} failed: '
+                                    f'{event["object"]}')
+                    return
+                obj = event['object']
+                resource_version = obj.metadata.resource_version
+                with self._condition:
+                    if event['type'] == 'DELETED':
+                        self._remove(obj)
+                    else:
+                        self._store(obj)
+                    self._changed()
+
+    def _store(self, obj):
+        key = object_key(obj)
+        self._remove(obj)
+        self._objects[key] = obj
+        self._index[self._index_key(obj)].add(key)
+
+    def _remove(self, obj):
+        key = object_key(obj)
+        stored = self._objects.pop(key, None)
+        if stored is not None:
+            index_key = self._index_key(stored)
+            self._index[index_key].discard(key)
+            if not self._index[index_key]:
+                del self._index[index_key]
+
+    def _changed(self):
+        self.version += 1
+        self._condition.notify_all()
+
+    def list(self):
+        with self._condition:
+            return list(self._objects.values())
+
+    def get(self, namespace, name):
+        return self._objects.get((namespace, name))
+
+    def by_index(self, index_key):
+        with self._condition:
+            return [self._objects[key] for key in self._index.get(index_key,
+                                                                  ())]
+
+    def follow(self, read, deadline):
+        """
+        Yield `read()` now and again after every change to the store, until
+        `deadline` (a `time.monotonic` value).
+        """
+        while True:
+            version = self.version
+            yield read()
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            with self._condition:
+                self._condition.wait_for(lambda: self.version != version,
+                                         timeout)
+
+
+class ClusterCache:
+    """
+    Informers of the task runner's Jobs and Pods in every namespace managed
+    by `cluster_manager`, indexed by job name.
+    """
+
+    def __init__(self, cluster_manager):
+        # the manager owns its cache, don't keep it (and its API clients'
+        # thread pools) alive
+        cluster_manager = weakref.proxy(cluster_manager)
+        self.jobs = Informer(
+            'jobs',
+            list_objects=lambda: cluster_manager.list_managed(
+                cluster_manager.batch_v1, 'job',
+            ),
+            watch_objects=lambda resource_version, timeout_seconds: (
+                cluster_manager.watch_managed(
+                    cluster_manager.batch_v1, 'job', timeout_seconds,
+                    resource_version,
+                )
+            ),
+        )
+        self.pods = Informer(
+            'pods',
+            list_objects=lambda: cluster_manager.list_managed(
+                cluster_manager.core_v1, 'pod',
+            ),
+            watch_objects=lambda resource_version, timeout_seconds: (
+                cluster_manager.watch_managed(
+                    cluster_manager.core_v1, 'pod', timeout_seconds,
+                    resource_version,
+                )
+            ),
+            index_key=lambda pod: (pod.metadata.namespace,
+                                   (pod.metadata.labels or {}).get(
+                                       JOB_NAME_LABEL,
+                                   )),
+        )
+        self._default_namespace = cluster_manager.namespace
+
+    @property
+    def synced(self):
+        return self.jobs.synced and self.pods.synced
+
+    def start(self):
+        self.jobs.start()
+        self.pods.start()
+
+    def get_job(self, job_name, namespace=None):
+        """ The cached Job `job_name`, None if there's none. """
+        return self.jobs.get(namespace or self._default_namespace, job_name)
+
+    def list_pods(self, job_name, namespace=None):
+        """ The cached pods of `job_name`, like `ClusterManager.list_pods`. """
+        return client.V1PodList(items=self.pods.by_index(
+            (namespace or self._default_namespace, job_name),
+        ))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus metrics shared by the API server and the worker.
+
+The API server exposes them on `/metrics` while the worker starts a
+standalone metrics HTTP server (see `worker.py`).
+"""
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from prometheus_client import Counter, Gauge, Histogram
+
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+
+
+CLUSTER_API_CALL_LATENCY = Histogram(
+    'ktr_cluster_api_call_duration_seconds',
+    'Latency of Kubernetes API calls issued by ClusterManager.api_call.',
+    ['endpoint', 'status_code'],
+)
+
+CLUSTER_API_RATE_LIMIT_WAIT = Histogram(
+    'ktr_cluster_api_rate_limit_wait_seconds',
+    'Time Kubernetes API calls waited for the client side rate limiter.',
+    ['lane'],
+    buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+CLUSTER_API_THROTTLED = Counter(
+    'ktr_cluster_api_throttled_total',
+    'Kubernetes API calls throttled by the API server (429) and retried.',
+    ['endpoint'],
+)
+
+BACKEND_RETRIES = Counter(
+    'ktr_backend_retries_total',
+    'Failed calls to a cluster\'s API server or GCS that were retried.',
+    ['backend'],
+)
+
+BACKEND_AVAILABLE = Gauge(
+    'ktr_backend_available',
+    'Whether the circuit breaker of a backend is closed (1) or open (0).',
+    ['backend'],
+)
+
+GCS_OPERATION_LATENCY = Histogram(
+    'ktr_gcs_operation_duration_seconds',
+    'Latency of Google Cloud Storage operations.',
+    ['operation', 'status'],
+)
+
+SYNC_CYCLE_DURATION = Histogram(
+    'ktr_sync_cycle_duration_seconds',
+    'Duration of a full `synchronize_batch_jobs` cycle.',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+CLUSTER_SYNC_DURATION = Histogram(
+    'ktr_cluster_sync_duration_seconds',
+    'Duration of the synchronization of a single cluster.',
+    ['cluster'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+SYNC_JOBS_PROCESSED = Counter(
+    'ktr_sync_jobs_processed_total',
+    'Number of jobs processed by the synchronization loop, per action.',
+    ['action'],
+)
+
+BATCH_JOBS_BY_STATUS = Gauge(
+    'ktr_batch_jobs',
+    'Number of batch jobs per status.',
+    ['status'],
+)
+
+ADMISSION_WAIT = Histogram(
+    'ktr_admission_wait_seconds',
+    'Time batch jobs spent queued until they were admitted.',
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 14400),
+)
+
+ADMISSION_OLDEST_QUEUED = Gauge(
+    'ktr_admission_oldest_queued_seconds',
+    'Time the oldest queued batch job has been waiting for.',
+)
+
+REQUEST_LATENCY = Histogram(
+    'ktr_http_request_duration_seconds',
+    'Latency of API requests per view.',
+    ['view', 'method', 'status_code'],
+)
+
+WEBHOOK_REQUEST_LATENCY = Histogram(
+    'ktr_webhook_request_duration_seconds',
+    'Latency of the webhook requests delivering notifications.',
+    ['status_code'],
+)
+
+WEBHOOK_DELIVERY_LATENCY = Histogram(
+    'ktr_webhook_delivery_latency_seconds',
+    'Time from a terminal status change until its webhook was delivered.',
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 14400),
+)
+
+WEBHOOK_NOTIFICATIONS = Counter(
+    'ktr_webhook_notifications_total',
+    'Webhook notifications per outcome (delivered, retried, failed).',
+    ['outcome'],
+)
+
+ORPHANS_RECLAIMED = Counter(
+    'ktr_orphans_reclaimed_total',
+    'Orphaned cluster objects deleted by the sweeper, per kind.',
+    ['kind'],
+)
+
+ARCHIVED_BATCH_JOBS = Counter(
+    'ktr_archived_batch_jobs_total',
+    'Expired batch jobs archived to GCS and removed from MongoDB.',
+)
+
+
+@contextmanager
+def observe_latency(histogram, outcome_label=None, **labels):
+    """
+    Time the wrapped block and record it in `histogram`.
+
+    Yields the `labels` dict so the block can fill in labels that are only
+    known after the fact (e.g. a status code). The `outcome_label`, if left
+    unset, is recorded as 'error' if the block raised, 'ok' otherwise.
+    """
+    start = time.monotonic()
+    outcome = 'ok'
+    try:
+        yield labels
+    except BaseException:
+        outcome = 'error'
+        raise
+    finally:
+        if outcome_label is not None:
+            labels.setdefault(outcome_label, outcome)
+        histogram.labels(**labels).observe(time.monotonic() - start)
+
+
+def update_batch_job_status_counts():
+    """ Refresh `BATCH_JOBS_BY_STATUS` with a single aggregation query. """
+    counts = {status.value: 0 for status in BatchJobStatus}
+    pipeline = [{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]
+    for row in BatchJob.objects.aggregate(*pipeline):
+        counts[row['_id']] = row['count']
+    for status, count in counts.items():
+        BATCH_JOBS_BY_STATUS.labels(status=status).set(count)
+
+
+def init_app(app):
+    """ Record `REQUEST_LATENCY` for every request handled by `app`. """
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start_time = time.monotonic()
+
+    @app.after_request
+    def observe_request_latency(response):
+        start = getattr(g, 'request_start_time', None)
+        if start is not None:
+            REQUEST_LATENCY.labels(
+                view=request.endpoint or 'unknown',
+                method=request.method,
+                status_code=str(response.status_code),
+            ).observe(time.monotonic() - start)
+        return response
@@ -1,24 +1,32 @@
 import re
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 
 from flask_mongoengine import MongoEngine
+from mongoengine.errors import NotUniqueError
 from slugify import slugify
 
+from kubernetes_task_runner.events import broadcaster
+from kubernetes_task_runner.exceptions import InvalidTransitionError
 from kubernetes_task_runner.fields import (ExtendedStringField,
                                            KubernetesResourceField)
+from kubernetes_task_runner.util import parse_quantity
 
 
 db = MongoEngine()
 
+# name of the cluster of single cluster setups (see `KUBERNETES_SETTINGS`)
+DEFAULT_CLUSTER = 'default'
+
 
 def list_enum_values(enum):
     return [item.value for item in enum]
 
 
 class BatchJobStatus(Enum):
-    CREATED = 'created'      # Just created and is currently being deployed
+    QUEUED = 'queued'        # Waiting to be admitted to the cluster
+    CREATED = 'created'      # Admitted and is currently being deployed
     RUNNING = 'running'      # Deployed and is running on Kubernetes
     FAILED = 'failed'        # Couldn't be deployed or failed mid-execution
     KILLED = 'killed'        # Killed by the user before finishing
@@ -26,18 +34,86 @@ class BatchJobStatus(Enum):
     SUCCEEDED = 'succeeded'  # Job and cleanup process finished successfully
 
 
+TERMINAL_STATUSES = (BatchJobStatus.SUCCEEDED.value,
+                     BatchJobStatus.FAILED.value,
+                     BatchJobStatus.KILLED.value)
+
+# seconds before retrying a failed job are doubled after every attempt, up to
+MAX_RETRY_BACKOFF = 3600
+
+# statuses a batch job is allowed to move to from each status
+LEGAL_TRANSITIONS = {
+    BatchJobStatus.QUEUED: {BatchJobStatus.CREATED,
+                            BatchJobStatus.FAILED,
+                            BatchJobStatus.KILLED},
+    BatchJobStatus.CREATED: {BatchJobStatus.RUNNING,
+                             BatchJobStatus.CLEANING,
+                             BatchJobStatus.FAILED,
+                             BatchJobStatus.KILLED,
+                             # its cluster or GCS is unavailable
+                             BatchJobStatus.QUEUED},
+    BatchJobStatus.RUNNING: {BatchJobStatus.CLEANING,
+                             BatchJobStatus.FAILED,
+                             BatchJobStatus.KILLED,
+                             # retried after failing on the cluster
+                             BatchJobStatus.QUEUED},
+    BatchJobStatus.CLEANING: {BatchJobStatus.SUCCEEDED,
+                              BatchJobStatus.FAILED,
+                              BatchJobStatus.KILLED},
+    BatchJobStatus.FAILED: set(),
+    BatchJobStatus.KILLED: set(),
+    BatchJobStatus.SUCCEEDED: set(),
+}
+
+
 class BaseModel(db.Document):
     id = db.UUIDField(primary_key=True, default=uuid.uuid4)
     created = db.DateTimeField(default=datetime.utcnow)
     meta = {'abstract': True}
 
 
+class StatusTransition(db.EmbeddedDocument):
+    """ Records a batch job entering a new status. """
+    status = db.StringField(required=True,
+                            choices=list_enum_values(BatchJobStatus))
+    timestamp = db.DateTimeField(default=datetime.utcnow)
+    # when the cluster reports the change actually happened, if known
+    cluster_timestamp = db.DateTimeField(required=False, null=True)
+
+
+class JobAttempt(db.EmbeddedDocument):
+    """ Records a failed attempt at running a batch job on the cluster. """
+    number = db.IntField(required=True)
+    start_time = db.DateTimeField(required=False, null=True)
+    stop_time = db.DateTimeField(default=datetime.utcnow)
+    reason = db.StringField(required=False, null=True)
+
+
 class BatchJobParameters(db.EmbeddedDocument):
     """ Holds configuration for batch jobs. """
     docker_image = db.StringField(required=True)
     environment_variables = db.DictField(default={})
     input_zip = db.FileField(required=False)
     resources = KubernetesResourceField(default={})
+    # queued jobs are admitted highest priority first
+    priority = db.IntField(default=0)
+    # labels the cluster the job is placed on must have
+    cluster_selector = db.DictField(default={})
+    # times the job is run before considering it failed, and seconds before
+    # the first retry
+    max_attempts = db.IntField(default=1, min_value=1, max_value=10)
+    retry_backoff = db.IntField(default=60, min_value=1)
+
+    @property
+    def requested_resources(self):
+        """
+        CPU cores and bytes of memory requested for the job's container.
+
+        Raises `ValueError` if a requested quantity isn't valid.
+        """
+        requests = (self.resources or {}).get('requests', {})
+        return (parse_quantity(requests.get('cpu', 0)),
+                parse_quantity(requests.get('memory', 0)))
 
 
 class BatchJob(BaseModel):
@@ -65,17 +141,68 @@ class BatchJob(BaseModel):
     start_time = db.DateTimeField(required=False, null=True)
     stop_time = db.DateTimeField(required=False, null=True)
     output_file_url = db.StringField(required=False, null=True)
+    # notified with the job when it reaches a terminal status
+    callback_url = db.URLField(required=False, null=True)
+    status_transitions = db.EmbeddedDocumentListField(StatusTransition)
+    # the cluster's capacity is shared fairly between owners
+    owner = db.StringField(default='default')
+    # parsed from the job_parameters' resource requests, for admission
+    requested_cpu = db.FloatField(default=0)
+    requested_memory = db.FloatField(default=0)
+    # name of the cluster the job was placed on
+    cluster = db.StringField(default=DEFAULT_CLUSTER)
+    # namespace the job runs in, the cluster's default one if None
+    namespace = db.StringField(required=False, null=True)
+    # the input file was uploaded to GCS and removed from GridFS
+    input_uploaded = db.BooleanField(default=False)
+    # the job's PVCs (and cleanup job) are owned by its cluster Job, so the
+    # cluster deletes them along with it
+    dependencies_owned = db.BooleanField(default=False)
+    # failed attempts, and when a queued job may be admitted (set for every
+    # queued job, so admission reads a single range)
+    attempts = db.EmbeddedDocumentListField(JobAttempt)
+    retry_at = db.DateTimeField(required=False, null=True)
+    # `Idempotency-Key` of the request creating the job, left unset rather
+    # than null for the sparse unique index
+    idempotency_key = db.StringField(required=False, max_length=255)
+    # bumped by every update, for the API's ETags and Last-Modified
+    version = db.IntField(default=0)
+    updated = db.DateTimeField(required=False, null=True)
 
-    meta = {'collection': 'batch_jobs'}
+    meta = {
+        'collection': 'batch_jobs',
+        # the next job to admit is the first one in the index that's due
+        'indexes': [
+            ('status', 'owner', '-job_parameters.priority', 'created',
+             'retry_at'),
+            # the job queued the longest
+            ('status', 'created'),
+            # the latency statistics' window
+            'created',
+            {'fields': ['idempotency_key'], 'unique': True, 'sparse': True},
+        ],
+    }
 
     @property
     def has_input_file(self):
-        return self.job_parameters.input_zip.grid_id is not None
+        return (self.input_uploaded
+                or self.job_parameters.input_zip.grid_id is not None)
 
     @property
     def input_file(self):
         return self.job_parameters.input_zip
 
+    @property
+    def can_retry(self):
+        """ Whether the job is retried if the current attempt fails. """
+        return len(self.attempts) + 1 < self.job_parameters.max_attempts
+
+    @property
+    def retry_delay(self):
+        """ Seconds before retrying the job if the current attempt fails. """
+        return min(self.job_parameters.retry_backoff * 2 ** len(self.attempts),
+                   MAX_RETRY_BACKOFF)
+
     @property
     def cleanup_job_name(self):
         return f'{self.name}{self.cleanup_job_suffix}'
@@ -89,7 +216,27 @@ class BatchJob(BaseModel):
         return f'job-{self.name}-output'
 
     def clean(self):
-        """ Set a job name based on the job_parameters. """
+        """
+        Record the initial status transition and update time, the requested
+        resources and set a job name based on the job_parameters.
+        """
+        if not self.status_transitions:
+            self.status_transitions = [
+                StatusTransition(status=self.status, timestamp=self.created),
+            ]
+        if self.updated is None:
+            self.updated = self.created
+        if (self.status == BatchJobStatus.QUEUED.value
+                and self.retry_at is None):
+            self.retry_at = self.created
+        if isinstance(self.job_parameters, BatchJobParameters):
+            try:
+                self.requested_cpu, self.requested_memory = (
+                    self.job_parameters.requested_resources
+                )
+            except ValueError:
+                # reported by the `resources` field's validation
+                pass
         if self.name is not None:
             return
         if (self.job_parameters is None or
@@ -104,22 +251,139 @@ class BatchJob(BaseModel):
         docker_name_slug = slugify(self.job_parameters.docker_image)
         self.name = f'{docker_name_slug}-{timestamp}'
 
-    def set_running(self):
-        self.update(status=BatchJobStatus.RUNNING.value)
-        self.reload()
+    def modify(self, query=None, **update):
+        """ Update the job, bumping its `version`. """
+        return super().modify(query=query, inc__version=1,
+                              set__updated=datetime.utcnow(), **update)
+
+    def transition(self, status, expected=None, cluster_timestamp=None,
+                   attempt=None, **updates):
+        """
+        Atomically move the job to `status`, recording the transition and
+        setting any extra field `updates`, with a single `find_one_and_update`.
+
+        The update only applies if the job's status in the database is still
+        one of `expected` (default is the status this instance holds), so
+        concurrent transitions can't overwrite each other.
+
+        `cluster_timestamp` is the time the cluster reports the change
+        happened, when known. A failed `attempt` is recorded along, if given.
+
+        Raises `InvalidTransitionError` if moving to `status` isn't allowed by
+        `LEGAL_TRANSITIONS` or if the job's status changed in the meantime.
+        """
+        expected = [self.status] if expected is None else list(expected)
+        illegal = [current for current in expected
+                   if BatchJobStatus(status) not in
+                   LEGAL_TRANSITIONS[BatchJobStatus(current)]]
+        if illegal:
+            raise InvalidTransitionError(
+                f'Batch job {self.id} can\'t move from {", ".join(illegal)} '
+                f'to {status}.'
+            )
+
+        transition = StatusTransition(status=status,
+                                      cluster_timestamp=cluster_timestamp)
+        updates = {f'set__{field}': value for field, value in updates.items()}
+        if attempt is not None:
+            updates['push__attempts'] = attempt
+        updated = self.modify(
+            query={'status__in': expected},
+            set__status=status,
+            push__status_transitions=transition,
+            **updates
+        )
+        if not updated:
+            self.reload()
+            raise InvalidTransitionError(
+                f'Batch job {self.id} can\'t move to {status}: its status '
+                f'changed to {self.status}.'
+            )
+        broadcaster.publish(self.id, status, transition.timestamp,
+                            cluster_timestamp)
+        return self
+
+    def set_running(self, cluster_timestamp=None, **updates):
+        return self.transition(BatchJobStatus.RUNNING.value,
+                               cluster_timestamp=cluster_timestamp, **updates)
+
+    def set_failed(self, cluster_timestamp=None, **updates):
+        return self.transition(BatchJobStatus.FAILED.value,
+                               cluster_timestamp=cluster_timestamp, **updates)
+
+    def set_succeeded(self, cluster_timestamp=None, **updates):
+        return self.transition(BatchJobStatus.SUCCEEDED.value,
+                               cluster_timestamp=cluster_timestamp, **updates)
+
+    def set_killed(self, cluster_timestamp=None, **updates):
+        return self.transition(BatchJobStatus.KILLED.value,
+                               cluster_timestamp=cluster_timestamp, **updates)
+
+    def set_cleaning(self, cluster_timestamp=None, **updates):
+        return self.transition(BatchJobStatus.CLEANING.value,
+                               cluster_timestamp=cluster_timestamp, **updates)
+
+
+class WebhookNotificationStatus(Enum):
+    PENDING = 'pending'      # Waiting to be delivered
+    DELIVERED = 'delivered'  # Accepted by the callback URL
+    FAILED = 'failed'        # Gave up after too many attempts
+
+
+class WebhookNotification(BaseModel):
+    """ A batch job's terminal status change to notify its callback URL of. """
+    job_id = db.UUIDField(required=True)
+    callback_url = db.URLField(required=True)
+    # serialized batch job, as returned by the API
+    payload = db.DictField(required=True)
+    status = db.StringField(
+        default=WebhookNotificationStatus.PENDING.value,
+        choices=list_enum_values(WebhookNotificationStatus),
+    )
+    attempts = db.IntField(default=0)
+    next_attempt_at = db.DateTimeField(default=datetime.utcnow)
+    # set on the notifications being delivered by a worker
+    claim_id = db.UUIDField(required=False, null=True)
+    delivered_at = db.DateTimeField(required=False, null=True)
+    last_error = db.StringField(required=False, null=True)
+
+    meta = {
+        'collection': 'webhook_notifications',
+        'indexes': [('status', 'callback_url', 'next_attempt_at')],
+    }
+
 
-    def set_failed(self):
-        self.update(set__status=BatchJobStatus.FAILED.value)
-        self.reload()
+class Lease(db.Document):
+    """
+    Lease on a task that must not run concurrently with itself, even across
+    processes. It's held until released or, in case its holder died, until
+    it expires.
+    """
+    name = db.StringField(primary_key=True)
+    holder = db.UUIDField(required=True)
+    expires_at = db.DateTimeField(required=True)
 
-    def set_succeeded(self):
-        self.update(set__status=BatchJobStatus.SUCCEEDED.value)
-        self.reload()
+    meta = {'collection': 'leases'}
 
-    def set_killed(self):
-        self.update(set__status=BatchJobStatus.KILLED.value)
-        self.reload()
+    @classmethod
+    def acquire(cls, name, seconds):
+        """
+        Acquire the lease `name` for `seconds`. Returns the holder id to
+        release it with, None if it's held already.
+        """
+        holder = uuid.uuid4()
+        now = datetime.utcnow()
+        try:
+            # only matches an expired lease, inserting one with the same name
+            # as a held lease fails
+            cls.objects(name=name, expires_at__lte=now).modify(
+                upsert=True, set__holder=holder,
+                set__expires_at=now + timedelta(seconds=seconds),
+            )
+        except NotUniqueError:
+            return None
+        return holder
 
-    def set_cleaning(self):
-        self.update(set__status=BatchJobStatus.CLEANING.value)
-        self.reload()
+    @classmethod
+    def release(cls, name, holder):
+        cls.objects(name=name, holder=holder).delete()
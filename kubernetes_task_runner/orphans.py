@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Reclaim the cluster objects batch jobs left behind.
+
+Jobs, pods and PVCs are labelled with the name of their batch job (see
+`BATCH_JOB_LABEL`). They're orphaned when the batch job doesn't exist, or
+when it finished more than `GRACE_PERIOD` ago, so the synchronization should
+have deleted them already: e.g. PVCs of jobs which failed to deploy, cleanup
+jobs of removed batch jobs or jobs killed while the runner was down.
+
+The `sweep_orphans` task deletes them with a few collection deletes per
+namespace, selecting them by label, and reports what it reclaimed:
+
+    {'tenant-a': {'batch_jobs': ['python-1520000000000'],
+                  'jobs': ['python-1520000000000'],
+                  'pvcs': ['job-python-1520000000000-output']}}
+"""
+import logging
+from datetime import datetime, timedelta
+
+from kubernetes_task_runner.cluster import (BATCH_JOB_LABEL,
+                                            RUNNER_LABEL_SELECTOR)
+from kubernetes_task_runner.metrics import ORPHANS_RECLAIMED
+from kubernetes_task_runner.models import TERMINAL_STATUSES, BatchJob
+
+GRACE_PERIOD = timedelta(hours=1)
+# batch jobs selected by each collection delete, keeping selectors short
+DELETE_BATCH_SIZE = 100
+
+
+def batch_job_name(obj):
+    return (obj.metadata.labels or {}).get(BATCH_JOB_LABEL)
+
+
+def finished_at(batch_job):
+    if batch_job.status_transitions:
+        return batch_job.status_transitions[-1].timestamp
+    return batch_job.created
+
+
+def orphaned_batch_jobs(names, now):
+    """ The batch jobs out of `names` whose cluster objects are orphaned. """
+    local_jobs = {
+        batch_job.name: batch_job
+        for batch_job in BatchJob.objects(name__in=list(names)).only(
+            'name', 'status', 'created', 'status_transitions',
+        )
+    }
+    orphaned = set()
+    for name in names:
+        batch_job = local_jobs.get(name)
+        if batch_job is None or (
+                batch_job.status in TERMINAL_STATUSES
+                and finished_at(batch_job) < now - GRACE_PERIOD):
+            orphaned.add(name)
+    return orphaned
+
+
+def find_orphans(cluster_manager):
+    """ Report of the orphaned objects of every managed namespace. """
+    managed = {'jobs': cluster_manager.list_managed_jobs(),
+               'pvcs': cluster_manager.list_managed_pvcs()}
+    names = {batch_job_name(obj)
+             for by_namespace in managed.values()
+             for objects in by_namespace.values()
+             for obj in objects} - {None}
+    orphaned = orphaned_batch_jobs(names, datetime.utcnow())
+
+    report = {}
+    for kind, by_namespace in managed.items():
+        for namespace, objects in by_namespace.items():
+            orphans = [obj for obj in objects
+                       if batch_job_name(obj) in orphaned]
+            if not orphans:
+                continue
+            namespace_report = report.setdefault(
+                namespace, {'batch_jobs': set(), 'jobs': [], 'pvcs': []},
+            )
+            namespace_report[kind] = sorted(obj.metadata.name
+                                            for obj in orphans)
+            namespace_report['batch_jobs'].update(batch_job_name(obj)
+                                                  for obj in orphans)
+    for namespace_report in report.values():
+        namespace_report['batch_jobs'] = sorted(
+            namespace_report['batch_jobs'],
+        )
+    return report
+
+
+def sweep_orphans(cluster_manager, dry_run=False):
+    """
+    Delete the orphaned objects of `cluster_manager`'s cluster, unless
+    `dry_run`, and return the report of `find_orphans`.
+    """
+    report = find_orphans(cluster_manager)
+    if dry_run:
+        return report
+    for namespace, namespace_report in report.items():
+        names = namespace_report['batch_jobs']
+        for start in range(0, len(names), DELETE_BATCH_SIZE):
+            selected = ','.join(names[start:start + DELETE_BATCH_SIZE])
+            cluster_manager.delete_collections(
+                f'{RUNNER_LABEL_SELECTOR},{BATCH_JOB_LABEL} in ({selected})',
+                namespace=namespace,
+            )
+        for kind in ('jobs', 'pvcs'):
+            ORPHANS_RECLAIMED.labels(kind=kind).inc(
+                len(namespace_report[kind]),
+            )
+        logging.info(f'Reclaimed {len(namespace_report["jobs"])} jobs and '
+                     f'{len(namespace_report["pvcs"])} PVCs of '
+                     f'{len(names)} batch jobs in namespace {namespace}')
+    return report
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Placement of new batch jobs on one of the clusters in `KUBERNETES_SETTINGS`.
+
+Clusters may have `labels`, which jobs select with their `cluster_selector`
+parameter: only the clusters having all of the selector's labels are
+eligible. Out of those, the `PLACEMENT_POLICY` picks:
+
+- `least-loaded`: the one whose queued and active jobs request the least CPU,
+  then the one with the fewest of them.
+- `label`: the first one in the configured order, so jobs only move to other
+  clusters by their labels.
+- `round-robin`: each one in turn.
+"""
+import itertools
+
+from kubernetes_task_runner.admission import ACTIVE_STATUSES
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+
+LEAST_LOADED = 'least-loaded'
+LABEL = 'label'
+ROUND_ROBIN = 'round-robin'
+PLACEMENT_POLICIES = (LEAST_LOADED, LABEL, ROUND_ROBIN)
+
+# turns of the round-robin policy, taken by this process' placements
+_turns = itertools.count()
+
+
+def matches_selector(labels, selector):
+    """ Whether `labels` include every label of `selector`. """
+    return all(labels.get(name) == str(value)
+               for name, value in selector.items())
+
+
+def cluster_loads():
+    """
+    CPU requested by the queued and active jobs of each cluster, and their
+    number, with a single aggregation query.
+    """
+    statuses = [BatchJobStatus.QUEUED.value, *ACTIVE_STATUSES]
+    pipeline = [
+        {'$match': {'status': {'$in': statuses}}},
+        {'$group': {
+            '_id': '$cluster',
+            'cpu': {'$sum': '$requested_cpu'},
+            'jobs': {'$sum': 1},
+        }},
+    ]
+    return {row['_id']: (row['cpu'], row['jobs'])
+            for row in BatchJob.objects.aggregate(*pipeline)}
+
+
+def place_batch_job(batch_job, clusters, policy=LEAST_LOADED):
+    """
+    Return the name of the cluster `batch_job` goes to out of `clusters`
+    (names to labels, in order of preference), None if none is eligible.
+    """
+    selector = batch_job.job_parameters.cluster_selector or {}
+    eligible = [name for name, labels in clusters.items()
+                if matches_selector(labels or {}, selector)]
+    if len(eligible) < 2 or policy == LABEL:
+        return eligible[0] if eligible else None
+    if policy == ROUND_ROBIN:
+        return eligible[next(_turns) % len(eligible)]
+    loads = cluster_loads()
+    # ties go to the preferred cluster
+    return min(eligible, key=lambda name: loads.get(name, (0, 0)))
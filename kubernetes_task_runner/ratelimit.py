@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Client side rate limiting of the Kubernetes API calls.
+
+Every `ClusterManager` takes its calls' tokens from a single bucket refilled
+at `qps` tokens a second up to `burst`. Callers wait in priority lanes:
+while a call of a higher lane waits for a token, the lower ones leave it the
+next, so a burst of creations can't starve the reads of the sync loop.
+"""
+import threading
+import time
+from collections import Counter
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+
+# endpoints prefixes of the calls in the `READ` lane
+READ_ENDPOINT_PREFIXES = ('read_', 'list_')
+# seconds to wait for when a 429 response doesn't say how long
+DEFAULT_RETRY_AFTER = 1
+# never wait longer than this for a 429 response, whatever it says
+MAX_RETRY_AFTER = 60
+
+
+class Lane(IntEnum):
+    """ Priority of the calls, higher lanes take the next token first. """
+    BULK = 0
+    READ = 1
+
+
+def endpoint_lane(endpoint):
+    """ Lane of the calls to `endpoint`: reads go before everything else. """
+    if endpoint.startswith(READ_ENDPOINT_PREFIXES):
+        return Lane.READ
+    return Lane.BULK
+
+
+def retry_after(headers):
+    """
+    Seconds the `Retry-After` header of a 429 response asks to wait for,
+    which may be a number of seconds or an HTTP date.
+    """
+    value = (headers or {}).get('Retry-After')
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+class RateLimiter:
+    """
+    Token bucket of `qps` tokens a second holding up to `burst` of them,
+    taken by the lanes in priority order.
+    """
+
+    def __init__(self, qps, burst=None):
+        self.qps = qps
+        self.burst = max(burst or 0, 1)
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        # number of callers waiting in each lane
+        self._waiting = Counter()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens
+                           + (now - self._refilled_at) * self.qps)
+        self._refilled_at = now
+
+    def acquire(self, lane=Lane.BULK):
+        """ Wait for a token, return the seconds waited for. """
+        waited = 0
+        waiting = False
+        try:
+            while True:
+                with self._lock:
+                    self._refill()
+                    ahead = any(count for other, count in self._waiting.items()
+                                if other > lane)
+                    if self._tokens >= 1 and not ahead:
+                        self._tokens -= 1
+                        return waited
+                    if not waiting:
+                        self._waiting[lane] += 1
+                        waiting = True
+                    # until the next token, which a higher lane may take
+                    delay = (1 - self._tokens % 1) / self.qps
+                time.sleep(delay)
+                waited += delay
+        finally:
+            if waiting:
+                with self._lock:
+                    self._waiting[lane] -= 1
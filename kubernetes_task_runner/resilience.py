@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Retries and circuit breakers for the calls to the backends: the API server
+of every cluster and GCS.
+
+Failed calls that are safe to repeat are retried a few times, waiting
+`backoff_delays` in between. Each backend has a `CircuitBreaker`: after too
+many failures in a row its calls fail fast with `BackendUnavailable` instead
+of waiting for timeouts, while a background probe waits for it to recover.
+"""
+import logging
+import random
+import threading
+import time
+
+from kubernetes_task_runner.exceptions import BackendUnavailable
+from kubernetes_task_runner.metrics import BACKEND_AVAILABLE
+
+# times a failed call is retried
+MAX_RETRIES = 3
+# seconds the delays between retries start at and never go over
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10
+# failures in a row opening a circuit breaker
+FAILURE_THRESHOLD = 5
+# seconds between the probes of an unavailable backend
+PROBE_INTERVAL = 10
+
+
+def backoff_delays(base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """
+    Endless seconds to wait between retries, with decorrelated jitter: each
+    one is random between `base` and three times the previous one, up to
+    `cap`, so callers failing at once don't retry at once.
+    """
+    delay = base
+    while True:
+        delay = min(cap, random.uniform(base, delay * 3))
+        yield delay
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` failed calls in a row to `backend`. While
+    open, `check` raises `BackendUnavailable` and `probe` is called every
+    `probe_interval` seconds in the background, closing it once it succeeds.
+    """
+
+    def __init__(self, backend, probe, failure_threshold=FAILURE_THRESHOLD,
+                 probe_interval=PROBE_INTERVAL):
+        self.backend = backend
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.is_open = False
+        self._probe = probe
+        self._prober = None
+        self._lock = threading.Lock()
+        BACKEND_AVAILABLE.labels(backend=backend).set(1)
+
+    def check(self):
+        """ Raise `BackendUnavailable` if the breaker is open. """
+        if self.is_open:
+            raise BackendUnavailable(f'{self.backend} is unavailable.',
+                                     retry_after=self.probe_interval)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            was_open, self.is_open = self.is_open, False
+        if was_open:
+            logging.warning(f'{self.backend} is available again.')
+            BACKEND_AVAILABLE.labels(backend=self.backend).set(1)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.is_open or self.failures < self.failure_threshold:
+                return
+            self.is_open = True
+        logging.error(f'{self.backend} failed {self.failures} times in a '
+                      'row, failing fast until it recovers.')
+        BACKEND_AVAILABLE.labels(backend=self.backend).set(0)
+        self._prober = threading.Thread(target=self._probe_until_closed,
+                                        daemon=True)
+        self._prober.start()
+
+    def _probe_until_closed(self):
+        while self.is_open:
+            time.sleep(self.probe_interval)
+            try:
+                self._probe()
+            except Exception as e:
+                logging.warning(f'{self.backend} is still unavailable: {e}')
+            else:
+                self.record_success()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Expire finished batch jobs created more than `JOB_RETENTION_DAYS` ago.
+
+The `expire_batch_jobs` task archives expired jobs to GCS before removing
+them from MongoDB, along with their leftover GridFS input files and webhook
+notifications. Every batch of jobs goes to a gzipped NDJSON file, one job per
+line as returned by the API:
+
+    archive/batch_jobs/<yyyy-mm-dd>/<first job id>.ndjson.gz
+
+Jobs are only removed once their archive is uploaded, so failed uploads are
+retried by the next run.
+"""
+import gzip
+import json
+import logging
+import tempfile
+from datetime import datetime, timedelta
+
+from kubernetes_task_runner.extensions import get_gcloud_client
+from kubernetes_task_runner.metrics import ARCHIVED_BATCH_JOBS
+from kubernetes_task_runner.models import (TERMINAL_STATUSES, BatchJob,
+                                           WebhookNotification,
+                                           WebhookNotificationStatus)
+from kubernetes_task_runner.serializers import BatchJobSchema
+
+BATCH_SIZE = 1000
+ARCHIVE_PREFIX = 'archive/batch_jobs'
+
+BatchJobSerializer = BatchJobSchema()
+
+
+def archive_name(batch_jobs, now):
+    return f'{ARCHIVE_PREFIX}/{now:%Y-%m-%d}/{batch_jobs[0].id}.ndjson.gz'
+
+
+def expired_batch_jobs(retention, now):
+    """ The oldest terminal jobs created more than `retention` ago. """
+    return BatchJob.objects(
+        status__in=TERMINAL_STATUSES, created__lt=now - retention,
+    ).order_by('created').limit(BATCH_SIZE)
+
+
+def archive_batch_jobs(batch_jobs, now):
+    """ Upload `batch_jobs` to GCS as a gzipped NDJSON file. """
+    with tempfile.TemporaryFile() as archive:
+        with gzip.GzipFile(fileobj=archive, mode='wb') as compressed:
+            for batch_job in batch_jobs:
+                line = json.dumps(BatchJobSerializer.dump(batch_job).data,
+                                  sort_keys=True)
+                compressed.write(f'{line}\n'.encode())
+        archive.seek(0)
+        get_gcloud_client().upload_file(archive,
+                                        archive_name(batch_jobs, now),
+                                        content_type='application/x-ndjson',
+                                        content_encoding='gzip')
+
+
+def remove_batch_jobs(batch_jobs):
+    """ Remove archived `batch_jobs` and what's left of them. """
+    for batch_job in batch_jobs:
+        if batch_job.input_file.grid_id is not None:
+            batch_job.input_file.delete()
+    job_ids = [batch_job.id for batch_job in batch_jobs]
+    WebhookNotification.objects(
+        job_id__in=job_ids,
+        status__ne=WebhookNotificationStatus.PENDING.value,
+    ).delete()
+    return BatchJob.objects(id__in=job_ids,
+                            status__in=TERMINAL_STATUSES).delete()
+
+
+def expire_batch_jobs(retention_days):
+    """
+    Archive and remove the terminal jobs older than `retention_days`, a
+    batch at a time, and return how many were removed.
+
+    Raises `StorageException` if an archive couldn't be uploaded.
+    """
+    retention = timedelta(days=retention_days)
+    now = datetime.utcnow()
+    removed = 0
+    while True:
+        batch_jobs = list(expired_batch_jobs(retention, now))
+        if not batch_jobs:
+            break
+        archive_batch_jobs(batch_jobs, now)
+        count = remove_batch_jobs(batch_jobs)
+        ARCHIVED_BATCH_JOBS.inc(count)
+        removed += count
+        logging.info(f'Archived and removed {count} expired batch jobs')
+        if len(batch_jobs) < BATCH_SIZE:
+            break
+    return removed
@@ -2,27 +2,145 @@
 """
 Classes for simplifying serialization of Mongoengine model instances to
 JSON-encodable Python primitives.
+
+`serialize_raw_batch_job` serializes the raw documents returned by
+`as_pymongo()` to the same output as `BatchJobSchema`, without building
+documents nor introspecting their fields. It's the one used by the API, so
+fields added to `BatchJob` must be added to it too.
 """
 from datetime import datetime, timezone
 
 from marshmallow import fields
 from marshmallow_mongoengine import ModelSchema
 
-from kubernetes_task_runner.models import BatchJob
+from kubernetes_task_runner.models import BatchJob, BatchJobParameters
+
+# values left out of the output, as `ModelSchema` does
+SKIP_VALUES = (None, [], {})
+
+
+def serialize_datetime_value(value):
+    """ Serialize a datetime as a timestamp in milliseconds. """
+    if isinstance(value, datetime):
+        timestamp = value.replace(tzinfo=timezone.utc).timestamp()
+        return int(timestamp * 1000)
 
 
 def serialize_datetime(field_name):
     """ Serialize datetime as timestamp in milliseconds. """
 
     def serializer(obj):
-        timestamp = getattr(obj, field_name, None)
-        if isinstance(timestamp, datetime):
-            timestamp = timestamp.replace(tzinfo=timezone.utc).timestamp()
-            return int(timestamp * 1000)
+        return serialize_datetime_value(getattr(obj, field_name, None))
 
     return serializer
 
 
+def serialize_status_transitions(obj):
+    """ Serialize status transitions with timestamps in milliseconds. """
+    return [
+        {
+            'status': transition.status,
+            'timestamp': serialize_datetime_value(transition.timestamp),
+            'cluster_timestamp': serialize_datetime_value(
+                transition.cluster_timestamp,
+            ),
+        }
+        for transition in obj.status_transitions
+    ]
+
+
+def serialize_attempts(obj):
+    """ Serialize failed attempts with timestamps in milliseconds. """
+    return [
+        {
+            'number': attempt.number,
+            'start_time': serialize_datetime_value(attempt.start_time),
+            'stop_time': serialize_datetime_value(attempt.stop_time),
+            'reason': attempt.reason,
+        }
+        for attempt in obj.attempts
+    ]
+
+
+def serialize_status_event(event):
+    """ Serialize a status change event from `events`. """
+    return {
+        'id': str(event['job_id']),
+        'status': event['status'],
+        'timestamp': serialize_datetime_value(event['timestamp']),
+        'cluster_timestamp': serialize_datetime_value(
+            event['cluster_timestamp'],
+        ),
+    }
+
+
+def serialize_container_state(state):
+    """
+    Serialize a Kubernetes container's state, from its only set field (empty
+    if unknown yet).
+    """
+    if state is None:
+        return {}
+    if state.running:
+        return {
+            'state': 'running',
+            'started_at': serialize_datetime_value(state.running.started_at),
+        }
+    if state.terminated:
+        return {
+            'state': 'terminated',
+            'reason': state.terminated.reason,
+            'exit_code': state.terminated.exit_code,
+            'started_at': serialize_datetime_value(
+                state.terminated.started_at,
+            ),
+            'finished_at': serialize_datetime_value(
+                state.terminated.finished_at,
+            ),
+        }
+    if state.waiting:
+        return {
+            'state': 'waiting',
+            'reason': state.waiting.reason,
+            'message': state.waiting.message,
+        }
+    return {}
+
+
+def serialize_live_state(job, pods):
+    """
+    Serialize the state of a batch job on its cluster, from its Kubernetes
+    Job (None if it's gone) and pods.
+    """
+    serialized_pods = []
+    for pod in pods:
+        containers = [
+            {
+                'name': container.name,
+                'ready': container.ready,
+                'restart_count': container.restart_count,
+                **serialize_container_state(container.state),
+            }
+            for container in pod.status.container_statuses or []
+        ]
+        serialized_pods.append({
+            'name': pod.metadata.name,
+            'phase': pod.status.phase,
+            'node': pod.spec.node_name if pod.spec else None,
+            'restarts': sum(container['restart_count'] or 0
+                            for container in containers),
+            'containers': containers,
+        })
+    return {
+        'job': job and {
+            'active': job.status.active or 0,
+            'succeeded': job.status.succeeded or 0,
+            'failed': job.status.failed or 0,
+        },
+        'pods': serialized_pods,
+    }
+
+
 class BaseModelSchema(ModelSchema):
     created = fields.Function(serialize_datetime('created'))
 
@@ -31,6 +149,106 @@ class BatchJobSchema(BaseModelSchema):
     """ Serialize BatchJob model objects. """
     start_time = fields.Function(serialize_datetime('start_time'))
     stop_time = fields.Function(serialize_datetime('stop_time'))
+    status_transitions = fields.Function(serialize_status_transitions)
+    attempts = fields.Function(serialize_attempts)
+    retry_at = fields.Function(serialize_datetime('retry_at'))
+    updated = fields.Function(serialize_datetime('updated'))
 
     class Meta:
         model = BatchJob
+
+
+def raw_value(document, model, field_name):
+    """ Value of a field of a raw document, or the field's default. """
+    field = model._fields[field_name]
+    if field.db_field in document:
+        return document[field.db_field]
+    return field.default() if callable(field.default) else field.default
+
+
+def convert(value, conversion):
+    return None if value is None else conversion(value)
+
+
+def skip_empty_values(serialized):
+    return {key: value for key, value in serialized.items()
+            if value not in SKIP_VALUES}
+
+
+def serialize_raw_job_parameters(parameters):
+    """ Serialize raw job parameters, leaving out the input file. """
+    if parameters is None:
+        return None
+
+    def value(field_name):
+        return raw_value(parameters, BatchJobParameters, field_name)
+
+    return skip_empty_values({
+        'docker_image': convert(value('docker_image'), str),
+        'environment_variables': value('environment_variables'),
+        'resources': value('resources'),
+        'priority': convert(value('priority'), int),
+        'cluster_selector': value('cluster_selector'),
+        'max_attempts': convert(value('max_attempts'), int),
+        'retry_backoff': convert(value('retry_backoff'), int),
+    })
+
+
+def serialize_raw_batch_job(document):
+    """
+    Serialize a raw BatchJob document from `as_pymongo()` like
+    `BatchJobSchema` does.
+    """
+
+    def value(field_name):
+        return raw_value(document, BatchJob, field_name)
+
+    return skip_empty_values({
+        'id': convert(value('id'), str),
+        'created': serialize_datetime_value(value('created')),
+        'name': convert(value('name'), str),
+        'status': convert(value('status'), str),
+        'job_parameters': serialize_raw_job_parameters(
+            value('job_parameters'),
+        ),
+        'start_time': serialize_datetime_value(value('start_time')),
+        'stop_time': serialize_datetime_value(value('stop_time')),
+        'output_file_url': convert(value('output_file_url'), str),
+        'callback_url': convert(value('callback_url'), str),
+        'status_transitions': [
+            {
+                'status': transition.get('status'),
+                'timestamp': serialize_datetime_value(
+                    transition.get('timestamp'),
+                ),
+                'cluster_timestamp': serialize_datetime_value(
+                    transition.get('cluster_timestamp'),
+                ),
+            }
+            for transition in value('status_transitions') or []
+        ],
+        'owner': convert(value('owner'), str),
+        'requested_cpu': convert(value('requested_cpu'), float),
+        'requested_memory': convert(value('requested_memory'), float),
+        'cluster': convert(value('cluster'), str),
+        'namespace': convert(value('namespace'), str),
+        'input_uploaded': convert(value('input_uploaded'), bool),
+        'dependencies_owned': convert(value('dependencies_owned'), bool),
+        'attempts': [
+            {
+                'number': attempt.get('number'),
+                'start_time': serialize_datetime_value(
+                    attempt.get('start_time'),
+                ),
+                'stop_time': serialize_datetime_value(
+                    attempt.get('stop_time'),
+                ),
+                'reason': attempt.get('reason'),
+            }
+            for attempt in value('attempts') or []
+        ],
+        'retry_at': serialize_datetime_value(value('retry_at')),
+        'idempotency_key': convert(value('idempotency_key'), str),
+        'version': convert(value('version'), int),
+        'updated': serialize_datetime_value(value('updated')),
+    })
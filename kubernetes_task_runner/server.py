@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Serve the API with gevent.
+
+`main.py` monkey patches the standard library before anything else imports
+it, so blocking I/O (MongoDB, the Kubernetes and GCS APIs, `time.sleep`) only
+suspends the greenlet serving the request while the others go on. Each
+process serves many requests at a time; with `API_WORKERS` > 1, several
+processes share the listening socket too.
+"""
+import logging
+import os
+import signal
+import sys
+
+import gevent
+from gevent import pywsgi
+from gevent.monkey import get_original
+
+from kubernetes_task_runner.app import create_app
+from kubernetes_task_runner.extensions import (get_cluster_manager_instance,
+                                               get_clusters_settings)
+
+# the workers are supervised outside of the event loop, which would reap them
+# before we do otherwise
+_fork, _waitpid = get_original('os', ['fork', 'waitpid'])
+
+
+def create_server(host, port, application=None, **kwargs):
+    return pywsgi.WSGIServer((host, port), application, **kwargs)
+
+
+def start_background_tasks(app):
+    # admission checks only read the cached capacity of the nodes, and the
+    # views the cached jobs and pods
+    with app.app_context():
+        cluster_managers = [get_cluster_manager_instance(cluster)
+                            for cluster in get_clusters_settings()]
+    for cluster_manager in cluster_managers:
+        gevent.spawn(cluster_manager.refresh_node_capacity_forever)
+        cluster_manager.cache.start()
+
+
+def serve(server, app_config):
+    """ Serve the app from this process, forever. """
+    app = create_app(app_config)
+    start_background_tasks(app)
+    server.application = app
+    server.serve_forever()
+
+
+def fork_workers(count):
+    """
+    Fork `count` worker processes and keep them running, forking a new one
+    whenever one exits, until SIGTERM stops them all. Only returns in the
+    workers.
+
+    Workers create their app (and so their MongoDB and Kubernetes clients,
+    which aren't fork safe) after forking.
+    """
+    pids = set()
+
+    def stop(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        while len(pids) < count:
+            pid = _fork()
+            if pid == 0:
+                gevent.reinit()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                return
+            pids.add(pid)
+        pid, status = _waitpid(-1, 0)
+        pids.discard(pid)
+        logging.error(f'API worker {pid} exited with status {status}, '
+                      f'forking a new one')
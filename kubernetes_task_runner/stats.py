@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Latency statistics computed from the batch jobs' status transitions.
+"""
+import math
+from collections import namedtuple
+
+from kubernetes_task_runner.models import (BatchJob, BatchJobStatus,
+                                           TERMINAL_STATUSES)
+
+
+Phase = namedtuple('Phase', ['start_statuses', 'start_field',
+                             'end_statuses', 'end_field'])
+
+# Each phase spans from the first transition to one of `start_statuses` to
+# the first transition to one of `end_statuses`. The `*_field` tells which of
+# the transition's timestamps to use: `timestamp` is when we recorded it and
+# `cluster_timestamp` is when the cluster reports it happened.
+PHASES = {
+    # queued until admitted to the cluster
+    'admission': Phase([BatchJobStatus.QUEUED.value], 'timestamp',
+                       [BatchJobStatus.CREATED.value], 'timestamp'),
+    # admitted until the cluster actually started the job
+    'queue': Phase([BatchJobStatus.CREATED.value], 'timestamp',
+                   [BatchJobStatus.RUNNING.value], 'cluster_timestamp'),
+    # admitted until we marked the job as running
+    'time_to_running': Phase([BatchJobStatus.CREATED.value], 'timestamp',
+                             [BatchJobStatus.RUNNING.value], 'timestamp'),
+    # running until the job finished, failed or got killed
+    'run': Phase([BatchJobStatus.RUNNING.value], 'timestamp',
+                 [BatchJobStatus.CLEANING.value, BatchJobStatus.FAILED.value,
+                  BatchJobStatus.KILLED.value], 'timestamp'),
+    # the job finished on the cluster until the sync loop noticed
+    'sync_delay': Phase([BatchJobStatus.CLEANING.value], 'cluster_timestamp',
+                        [BatchJobStatus.CLEANING.value], 'timestamp'),
+    # cleanup job launched until it finished
+    'cleanup': Phase([BatchJobStatus.CLEANING.value], 'timestamp',
+                     [BatchJobStatus.SUCCEEDED.value,
+                      BatchJobStatus.FAILED.value], 'timestamp'),
+    # submitted until a terminal status
+    'total': Phase([BatchJobStatus.QUEUED.value,
+                    BatchJobStatus.CREATED.value], 'timestamp',
+                   list(TERMINAL_STATUSES), 'timestamp'),
+}
+
+DEFAULT_PERCENTILES = (50, 95, 99)
+
+
+def _first_transition_time(statuses, field):
+    """
+    Aggregation expression for the earliest `field` of the transitions to
+    any of `statuses`. Resolves to null if there's no such transition.
+    """
+    return {'$min': {'$map': {
+        'input': {'$filter': {
+            'input': '$status_transitions',
+            'as': 'transition',
+            'cond': {'$in': ['$$transition.status', statuses]},
+        }},
+        'as': 'transition',
+        'in': f'$$transition.{field}',
+    }}}
+
+
+def build_duration_pipeline(phase, since, until):
+    """
+    Build an aggregation pipeline projecting the `duration` (in milliseconds)
+    of `phase` for every job created between `since` and `until`.
+    """
+    return [
+        {'$match': {
+            'created': {'$gte': since, '$lt': until},
+            'status_transitions.status': {'$in': phase.end_statuses},
+        }},
+        {'$project': {
+            'start': _first_transition_time(phase.start_statuses,
+                                            phase.start_field),
+            'end': _first_transition_time(phase.end_statuses,
+                                          phase.end_field),
+        }},
+        {'$match': {'start': {'$ne': None}, 'end': {'$ne': None}}},
+        # subtracting dates gives the difference in milliseconds
+        {'$project': {
+            '_id': 0,
+            'duration': {'$subtract': ['$end', '$start']},
+        }},
+    ]
+
+
+def nearest_rank(percentile, count):
+    """ 1-based rank of the nearest-rank `percentile` of `count` values. """
+    return max(math.ceil(percentile / 100 * count), 1)
+
+
+def pick_percentiles(durations, percentiles=DEFAULT_PERCENTILES):
+    """
+    Return the count and nearest-rank `percentiles` of the sorted
+    `durations`, None if there are none:
+
+      {'count': 10, 'p50': 1200, 'p95': 3100, 'p99': 3800}
+    """
+    picked = {'count': len(durations)}
+    for percentile in percentiles:
+        picked[f'p{percentile}'] = (
+            durations[nearest_rank(percentile, len(durations)) - 1]
+            if durations else None
+        )
+    return picked
+
+
+def phase_latency_percentiles(since, until, percentiles=DEFAULT_PERCENTILES):
+    """
+    Return the duration percentiles (in milliseconds) of every phase in
+    `PHASES` for jobs created between `since` and `until`:
+
+      {'queue': {'count': 10, 'p50': 1200, 'p95': 3100, 'p99': 3800}, ...}
+
+    Each phase takes a single aggregation, streaming its sorted durations
+    rather than gathering them in one document, which could exceed MongoDB's
+    size limit.
+    """
+    result = {}
+    for phase_name, phase in PHASES.items():
+        rows = BatchJob.objects.aggregate(
+            *build_duration_pipeline(phase, since, until),
+            {'$sort': {'duration': 1}},
+            allowDiskUse=True,
+        )
+        result[phase_name] = pick_percentiles(
+            [row['duration'] for row in rows], percentiles,
+        )
+    return result
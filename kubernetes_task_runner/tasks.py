@@ -1,18 +1,112 @@
 # -*- coding: utf-8 -*-
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
-from datetime import datetime
-
-from celery import Celery
-
-from kubernetes_task_runner.models import BatchJob, BatchJobStatus
-from kubernetes_task_runner.batch_jobs import (launch_cleaner_job,
+from datetime import datetime, timedelta
+
+from celery import Celery, Task
+from celery.signals import worker_ready
+from flask import current_app, has_app_context
+from kubernetes.client.rest import ApiException
+
+from kubernetes_task_runner import admission, orphans, retention, webhooks
+from kubernetes_task_runner.exceptions import (BackendUnavailable,
+                                               ClusterError,
+                                               InvalidTransitionError)
+from kubernetes_task_runner.models import (TERMINAL_STATUSES, BatchJob,
+                                           BatchJobStatus, JobAttempt)
+from kubernetes_task_runner.batch_jobs import (JOB_START_TIMEOUT,
+                                               archive_job_logs,
+                                               cluster_create_batch_job,
+                                               launch_cleaner_job,
                                                cleanup_job_dependencies)
-from kubernetes_task_runner.extensions import (get_cluster_manager_instance,
+from kubernetes_task_runner.extensions import (get_admission_limits,
+                                               get_cluster_manager_instance,
+                                               get_clusters_settings,
                                                get_gcloud_client)
+from kubernetes_task_runner.metrics import (CLUSTER_SYNC_DURATION,
+                                            SYNC_CYCLE_DURATION,
+                                            SYNC_JOBS_PROCESSED,
+                                            observe_latency,
+                                            update_batch_job_status_counts)
+
+
+JOBS_QUEUE = 'jobs'
 
+# seconds the synchronization waits for every cluster before moving on, the
+# slower ones finish in the background
+CLUSTER_SYNC_WAIT = 10
+MAX_PARALLEL_CLUSTER_SYNCS = 16
+# seconds after which an admitted job not deployed yet is considered lost,
+# e.g. its deployment task was, and recovered
+STALE_CREATED_SECONDS = JOB_START_TIMEOUT + 300
 
-celery = Celery('__name__')
+# synchronizations of every cluster in progress, so a cluster is never
+# synchronized twice at a time
+_cluster_syncs = {}
+_cluster_sync_executor = ThreadPoolExecutor(
+    max_workers=MAX_PARALLEL_CLUSTER_SYNCS,
+)
+
+
+class AppContextTask(Task):
+    """
+    Runs within the Flask app's context (see `create_app`), which the gevent
+    pool's greenlets don't share with the worker's main one.
+    """
+
+    def __call__(self, *args, **kwargs):
+        flask_app = getattr(self.app, 'flask_app', None)
+        if flask_app is None or has_app_context():
+            return super().__call__(*args, **kwargs)
+        with flask_app.app_context():
+            return super().__call__(*args, **kwargs)
+
+
+celery = Celery('__name__', task_cls=AppContextTask)
+# deliver webhooks and deploy admitted jobs on their own queues (and workers)
+# so they never hold up the synchronization
+celery.conf.task_routes = {
+    'kubernetes_task_runner.tasks.start_batch_job': {'queue': JOBS_QUEUE},
+    webhooks.DELIVER_TASK_NAME: {'queue': webhooks.WEBHOOKS_QUEUE},
+    'kubernetes_task_runner.tasks.enqueue_pending_webhooks': {
+        'queue': webhooks.WEBHOOKS_QUEUE,
+    },
+}
+
+
+def consumes_cluster_tasks(consumer):
+    """
+    Whether the worker of `consumer` runs the tasks looking up jobs and pods,
+    i.e. consumes the default or the jobs queue.
+    """
+    cluster_queues = {consumer.app.conf.task_default_queue, JOBS_QUEUE}
+    return bool(cluster_queues & set(consumer.app.amqp.queues.consume_from))
+
+
+@worker_ready.connect
+def start_cluster_caches(sender=None, **kwargs):
+    """
+    Keep the clusters' caches current for the tasks of this worker, so they
+    don't call the API servers to look up jobs and pods. Workers delivering
+    webhooks only don't need them.
+    """
+    flask_app = getattr(celery, 'flask_app', None)
+    if flask_app is None or not consumes_cluster_tasks(sender):
+        return
+    with flask_app.app_context():
+        for cluster in get_clusters_settings():
+            get_cluster_manager_instance(cluster).cache.start()
+
+
+@worker_ready.connect
+def backfill_queued_jobs(**kwargs):
+    """ Let the jobs queued by earlier versions be admitted. """
+    flask_app = getattr(celery, 'flask_app', None)
+    if flask_app is None:
+        return
+    with flask_app.app_context():
+        admission.backfill_retry_at()
 
 
 class Action(Enum):
@@ -21,6 +115,18 @@ class Action(Enum):
     SUCCEED = 3
 
 
+def record_processed_job(action):
+    """ Count a job processed by the synchronization loop. """
+    action_name = action.name.lower() if action is not None else 'none'
+    SYNC_JOBS_PROCESSED.labels(action=action_name).inc()
+
+
+def load_local_jobs(names):
+    """ Map each of `names` to its local BatchJob using a single query. """
+    return {local_job.name: local_job
+            for local_job in BatchJob.objects(name__in=list(names))}
+
+
 def synchronize_cleanup_job(local_job, cleanup_job):
     """
     Synchronizes local job status if cleanup_job succeeded or failed.
@@ -47,37 +153,97 @@ def synchronize_cleanup_job(local_job, cleanup_job):
     return status, action
 
 
+def is_owned(cluster_job):
+    """ Whether the cluster deletes `cluster_job` along with its owner. """
+    return bool(cluster_job is not None
+                and cluster_job.metadata.owner_references)
+
+
+def failure_reason(cluster_job):
+    """ Reason the cluster gives for `cluster_job`'s failure, if any. """
+    for condition in cluster_job.status.conditions or []:
+        if condition.type == 'Failed':
+            return ': '.join(filter(None, (condition.reason,
+                                           condition.message)))
+    return None
+
+
 def apply_changes(local_job, new_status, action, cluster_manager,
-                  cleanup_jobs=None, is_cleanup=False):
+                  cleanup_jobs=None, is_cleanup=False, cluster_timestamp=None,
+                  cluster_job=None):
     """
     Apply changes to `local_job` based on the `action` we want to perform.
+
+    `cluster_timestamp` is recorded along the status change as the time the
+    cluster reported it. `cluster_job` is the cluster's (regular or cleanup)
+    Job the action is about.
+
+    Deleting a regular Job takes its owned PVCs and cleanup Job along, so
+    owned resources are left to the cluster's garbage collector.
+
+    Jobs whose (regular) Job fails on the cluster get the attempt recorded,
+    and jobs moving back to `queued` are retried after their backoff.
     """
     cleanup_jobs = cleanup_jobs or {}
 
     # apply status change if there's a new status
-    if new_status is not None and new_status != local_job.status:
-        local_job.update(set__status=new_status)
+    transitioned = new_status is not None and new_status != local_job.status
+    if transitioned:
+        updates = {}
+        if (cluster_job is not None and not is_cleanup
+                and new_status in (BatchJobStatus.QUEUED.value,
+                                   BatchJobStatus.FAILED.value)):
+            updates['attempt'] = JobAttempt(
+                number=len(local_job.attempts) + 1,
+                start_time=local_job.start_time,
+                stop_time=cluster_timestamp or datetime.utcnow(),
+                reason=failure_reason(cluster_job),
+            )
+        if new_status == BatchJobStatus.QUEUED.value:
+            updates['start_time'] = None
+            updates['retry_at'] = datetime.utcnow() + timedelta(
+                seconds=local_job.retry_delay,
+            )
+        try:
+            local_job.transition(new_status,
+                                 cluster_timestamp=cluster_timestamp,
+                                 **updates)
+        except InvalidTransitionError as e:
+            # e.g. the job got killed since we loaded it; the next
+            # synchronization will act on its current status
+            logging.warning(f'Skipping {action} for job {local_job.name}: {e}')
+            return
 
     if action == Action.CLEAN:
         has_clean_job = local_job.name in cleanup_jobs
         if not has_clean_job:
-            launch_cleaner_job(local_job)
+            launch_cleaner_job(local_job, owner=cluster_job)
 
     elif action == Action.DELETE:
-        if is_cleanup:
-            cluster_manager.delete_job(local_job.cleanup_job_name)
-        else:
-            cluster_manager.delete_job(local_job.name)
+        # logs go away with the job's pods, archive them first
+        job_name = local_job.cleanup_job_name if is_cleanup else local_job.name
+        archive_job_logs(cluster_manager, job_name, local_job.namespace)
+        if not (is_cleanup and is_owned(cluster_job)):
+            cluster_manager.delete_job(job_name,
+                                       namespace=local_job.namespace)
+        if not (is_cleanup or local_job.dependencies_owned):
             cleanup_job_dependencies(cluster_manager, local_job)
 
     elif action == Action.SUCCEED:
-        cluster_manager.delete_job(local_job.cleanup_job_name)
+        archive_job_logs(cluster_manager, local_job.cleanup_job_name,
+                         local_job.namespace)
+        if not is_owned(cluster_job):
+            cluster_manager.delete_job(local_job.cleanup_job_name,
+                                       namespace=local_job.namespace)
         gcs_client = get_gcloud_client()
         output_file_url = gcs_client.get_output_file_url(
             f'{local_job.name}-output.zip',
         )
-        local_job.update(output_file_url=output_file_url,
-                         stop_time=datetime.utcnow())
+        local_job.modify(set__output_file_url=output_file_url,
+                         set__stop_time=datetime.utcnow())
+
+    if transitioned and local_job.status in TERMINAL_STATUSES:
+        webhooks.notify_batch_job_finished(local_job)
 
 
 def synchronize_job(local_job, cluster_job):
@@ -88,6 +254,7 @@ def synchronize_job(local_job, cluster_job):
     | local status | cluster status | action                         |
     |--------------+----------------+--------------------------------|
     | running      | Succeeded      | launch cleaner;status=cleaning |
+    | running      | Failed         | delete;status=queued (retry)   |
     | running      | Failed         | delete;status=failed           |
     | failed       | *              | delete                         |
     | cleaning     | *              | launch cleaner                 |
@@ -110,6 +277,12 @@ def synchronize_job(local_job, cluster_job):
         logging.info(f'Both local and cluster jobs succeeded.')
         action = Action.DELETE
 
+    elif (local_status == BatchJobStatus.RUNNING and cluster_status.failed
+          and local_job.can_retry):
+        logging.info(f'Cluster job failed and local is running. Retrying.')
+        new_status = BatchJobStatus.QUEUED.value
+        action = Action.DELETE
+
     elif local_status == BatchJobStatus.RUNNING and cluster_status.failed:
         logging.info(f'Cluster job failed and local is running.')
         new_status = BatchJobStatus.FAILED.value
@@ -128,48 +301,218 @@ def synchronize_job(local_job, cluster_job):
 
 
 @celery.task
+@SYNC_CYCLE_DURATION.time()
 def synchronize_batch_jobs():
-    """Synchronize Jobs running on the cluster with local state.
+    """Synchronize Jobs running on the clusters with local state.
 
-    Polls cluster for running jobs and compares their statuses with the
-    corresponding local statuses.
-
-    - Sets appropriate local job state based on cluster status.
-    - Issues delete commands for finished jobs.
-    - Launches cleanup jobs when a regular jobs succeedes.
+    Every cluster is synchronized in parallel (see `synchronize_cluster`),
+    waiting up to `CLUSTER_SYNC_WAIT` seconds for them. A slower cluster
+    finishes in the background and is skipped by the next cycles until it
+    does, so it never holds up the others.
 
+    Then admits the queued jobs that fit in the freed capacity.
     """
     logging.info('Starting periodic task `synchronize_batch_jobs`.')
 
-    cluster_manager = get_cluster_manager_instance()
-    cluster_jobs = cluster_manager.list_jobs()
+    clusters = list(get_clusters_settings())
+    flask_app = current_app._get_current_object()
+    if len(clusters) == 1:
+        # nothing to run in parallel
+        synchronize_cluster_in_background(flask_app, clusters[0])
+    else:
+        started = []
+        for cluster in clusters:
+            running = _cluster_syncs.get(cluster)
+            if running is not None and not running.done():
+                logging.warning(f'Cluster {cluster} is still synchronizing '
+                                'since a previous cycle. Skipping it.')
+                continue
+            _cluster_syncs[cluster] = _cluster_sync_executor.submit(
+                synchronize_cluster_in_background, flask_app, cluster,
+            )
+            started.append(_cluster_syncs[cluster])
+        _, not_done = wait(started, timeout=CLUSTER_SYNC_WAIT)
+        if not_done:
+            logging.warning(f'{len(not_done)} clusters are taking over '
+                            f'{CLUSTER_SYNC_WAIT}s to synchronize.')
+
+    # finished jobs freed some capacity
+    dispatch_queued_jobs()
+    update_batch_job_status_counts()
+
+
+def synchronize_cluster_in_background(flask_app, cluster):
+    with flask_app.app_context():
+        try:
+            synchronize_cluster(cluster)
+        except Exception as e:
+            logging.error(f'Failed to synchronize cluster {cluster}: {e}')
+
+
+def synchronize_cluster(cluster):
+    """
+    Polls `cluster` for the jobs in all its managed namespaces and
+    synchronizes them with their local state, a namespace at a time (see
+    `synchronize_cluster_jobs`).
+    """
+    with observe_latency(CLUSTER_SYNC_DURATION, cluster=cluster):
+        cluster_manager = get_cluster_manager_instance(cluster)
+        managed_jobs = cluster_manager.list_managed_jobs()
+        for local_job in fetch_unlisted_jobs(cluster_manager, cluster,
+                                             managed_jobs):
+            fail_vanished_job(local_job, cluster_manager)
+        recover_stale_jobs(cluster_manager, cluster, managed_jobs)
+        for namespace, cluster_jobs in managed_jobs.items():
+            logging.info(f'Got {len(cluster_jobs)} jobs on cluster {cluster} '
+                         f'in namespace {namespace}. Starting '
+                         'synchronization...')
+            synchronize_cluster_jobs(cluster_manager, cluster_jobs)
+
+
+def fetch_unlisted_jobs(cluster_manager, cluster, managed_jobs):
+    """
+    Fetch by name the (regular and cleanup) Jobs of the jobs running or
+    cleaning on `cluster` missing from `managed_jobs`, adding them to their
+    namespace's list.
 
-    logging.info(f'Got {len(cluster_jobs.items)} jobs on the cluster. '
-                 'Starting synchronization...')
+    Jobs deployed before the runner labelled its Jobs aren't listed, but
+    must be synchronized until they finish.
 
+    Returns the jobs none of whose Jobs exist anymore, e.g. deleted by the
+    cluster after their `ttlSecondsAfterFinished` before being synchronized.
+    """
+    listed = {cluster_job.metadata.name
+              for cluster_jobs in managed_jobs.values()
+              for cluster_job in cluster_jobs}
+    active_jobs = BatchJob.objects(
+        cluster=cluster, status__in=[BatchJobStatus.RUNNING.value,
+                                     BatchJobStatus.CLEANING.value],
+    ).only('name', 'status', 'namespace')
+    vanished = []
+    for local_job in active_jobs:
+        job_names = [local_job.name]
+        if local_job.status == BatchJobStatus.CLEANING.value:
+            job_names.append(local_job.cleanup_job_name)
+        namespace = local_job.namespace or cluster_manager.namespace
+        found = False
+        for job_name in job_names:
+            if job_name in listed:
+                found = True
+                continue
+            try:
+                cluster_job = cluster_manager.get_job(
+                    job_name, namespace=local_job.namespace,
+                )
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                continue
+            found = True
+            managed_jobs.setdefault(namespace, []).append(cluster_job)
+        if not found:
+            vanished.append(local_job)
+    return vanished
+
+
+def recover_stale_jobs(cluster_manager, cluster, managed_jobs):
+    """
+    Recover the jobs admitted to `cluster` over `STALE_CREATED_SECONDS` ago
+    but still `created`, e.g. because their deployment task was lost: they
+    hold admission capacity until they move on.
+
+    Jobs whose Job exists are left to the synchronization as running, and
+    the others queued again to be deployed once more.
+    """
+    cluster_jobs = {cluster_job.metadata.name: cluster_job
+                    for jobs in managed_jobs.values() for cluster_job in jobs}
+    stale_jobs = BatchJob.objects(
+        cluster=cluster, status=BatchJobStatus.CREATED.value,
+        updated__lte=datetime.utcnow() - timedelta(
+            seconds=STALE_CREATED_SECONDS,
+        ),
+    )
+    for local_job in stale_jobs:
+        try:
+            cluster_job = cluster_jobs.get(local_job.name)
+            if cluster_job is None:
+                cluster_job = cluster_manager.get_job(
+                    local_job.name, ignore_404=True,
+                    namespace=local_job.namespace,
+                )
+            if cluster_job is not None:
+                logging.warning(f'Job {local_job.name} was deployed but never '
+                                'marked as running. Synchronizing it.')
+                local_job.set_running(
+                    cluster_timestamp=cluster_job.status.start_time,
+                    start_time=cluster_job.status.start_time,
+                )
+            else:
+                logging.warning(f'Job {local_job.name} was admitted but never '
+                                'deployed. Queueing it again.')
+                local_job.transition(BatchJobStatus.QUEUED.value,
+                                     retry_at=datetime.utcnow())
+        except InvalidTransitionError:
+            # e.g. its deployment went on after all
+            pass
+        except Exception as e:
+            logging.error(f'Failed to recover job {local_job.name} '
+                          f'({local_job.id}):\n{e}')
+
+
+def fail_vanished_job(local_job, cluster_manager):
+    """
+    Mark `local_job` as failed, its Jobs being gone from the cluster before
+    it could tell how they ended.
+    """
+    logging.error(f'Job {local_job.name} is gone from the cluster. '
+                  'Considering it as failed.')
+    local_job.reload()
+    try:
+        apply_changes(local_job, BatchJobStatus.FAILED.value, None,
+                      cluster_manager)
+        record_processed_job(None)
+    except Exception as e:
+        logging.error('Failed to synchronize cluster with job '
+                      f'{local_job.name} ({local_job.id}):\n{e}')
+
+
+def synchronize_cluster_jobs(cluster_manager, cluster_jobs):
+    """
+    Compare the statuses of the jobs in `cluster_jobs`, all in the same
+    namespace, with the corresponding local statuses.
+
+    - Sets appropriate local job state based on cluster status.
+    - Issues delete commands for finished jobs.
+    - Launches cleanup jobs when a regular jobs succeedes.
+    """
     # Build mapping of regular and cleanup jobs for processing:
-    jobs = {}
-    cleanup_jobs = {}
-    for cluster_job in cluster_jobs.items:
+    cluster_regular_jobs = {}
+    cluster_cleanup_jobs = {}
+    for cluster_job in cluster_jobs:
         name = cluster_job.metadata.name
-        is_cleanup = False
 
         annotations = cluster_job.metadata.annotations or {}
         job_type = annotations.get('job_runner_job_type', None)
         related_job_name = annotations.get('job_runner_related_job', None)
         if job_type == 'cleanup' and related_job_name:
-            is_cleanup = True
-            name = related_job_name
-        try:
-            local_job = BatchJob.objects.get(name=name)
-        except BatchJob.DoesNotExist:
-            logging.warn(f'Found an unmanaged job \'{name}\'in '
-                         'the cluster. Ignoring...')
-            continue
-        if is_cleanup:
-            cleanup_jobs[name] = (local_job, cluster_job)
+            cluster_cleanup_jobs[related_job_name] = cluster_job
         else:
-            jobs[name] = (local_job, cluster_job)
+            cluster_regular_jobs[name] = cluster_job
+
+    local_jobs = load_local_jobs(
+        set(cluster_regular_jobs) | set(cluster_cleanup_jobs),
+    )
+    jobs = {}
+    cleanup_jobs = {}
+    for cluster_mapping, local_mapping in ((cluster_regular_jobs, jobs),
+                                           (cluster_cleanup_jobs,
+                                            cleanup_jobs)):
+        for name, cluster_job in cluster_mapping.items():
+            if name not in local_jobs:
+                logging.warn(f'Found an unmanaged job \'{name}\'in '
+                             'the cluster. Ignoring...')
+                continue
+            local_mapping[name] = (local_jobs[name], cluster_job)
 
     # synchronize cleanup jobs
     for job_name, (local_job, cluster_job) in cleanup_jobs.items():
@@ -177,20 +520,123 @@ def synchronize_batch_jobs():
             new_status, action = synchronize_cleanup_job(local_job,
                                                          cluster_job)
             apply_changes(local_job, new_status, action, cluster_manager,
-                          is_cleanup=True)
+                          is_cleanup=True,
+                          cluster_timestamp=cluster_job.status.completion_time,
+                          cluster_job=cluster_job)
+            record_processed_job(action)
         except Exception as e:
             logging.error('Failed to synchronize cluster with job '
                           f'{local_job.name} ({local_job.id}):\n{e}')
     logging.info(f'Synchronized {len(cleanup_jobs)} cleanup jobs')
 
-    # synchronize regular jobs
+    # synchronize regular jobs, with their local state as left by the cleanup
+    # jobs synchronization
+    reloaded_jobs = load_local_jobs(jobs.keys())
     for job_name, (local_job, cluster_job) in jobs.items():
         try:
-            local_job.reload()
+            if job_name not in reloaded_jobs:
+                raise BatchJob.DoesNotExist(f'{job_name} no longer exists')
+            local_job = reloaded_jobs[job_name]
             new_status, action = synchronize_job(local_job, cluster_job)
             apply_changes(local_job, new_status, action, cluster_manager,
-                          cleanup_jobs=cleanup_jobs)
+                          cleanup_jobs=cleanup_jobs,
+                          cluster_timestamp=cluster_job.status.completion_time,
+                          cluster_job=cluster_job)
+            record_processed_job(action)
         except Exception as e:
             logging.error('Failed to synchronize cluster with job '
                           f'{local_job.name} ({local_job.id}):\n{e}')
     logging.info(f'Synchronized {len(jobs)} jobs')
+
+
+@celery.task
+def dispatch_queued_jobs():
+    """
+    Admit the queued jobs that fit within the admission limits and schedule
+    their deployment. Skipped while another worker is admitting jobs (see
+    `admission.admit_queued_jobs`).
+    """
+    limits, owner_limits = get_admission_limits()
+    node_capacities = {}
+    unavailable_clusters = set()
+    for cluster in get_clusters_settings():
+        try:
+            node_capacities[cluster] = get_cluster_manager_instance(
+                cluster,
+            ).node_capacity()
+        except ApiException:
+            # admit the cluster's jobs within the limits only
+            node_capacities[cluster] = None
+        except BackendUnavailable:
+            unavailable_clusters.add(cluster)
+    admitted = admission.admit_queued_jobs(limits, owner_limits,
+                                           node_capacities,
+                                           unavailable_clusters)
+    for batch_job in admitted:
+        start_batch_job.delay(str(batch_job.id))
+
+
+@celery.task
+def start_batch_job(job_id):
+    """ Deploy an admitted batch job and wait for it to start. """
+    batch_job = BatchJob.objects.get(id=job_id)
+    try:
+        _, message = cluster_create_batch_job(batch_job)
+        logging.info(message)
+    except BackendUnavailable as e:
+        # the job is queued again
+        logging.warning(f'Failed to start batch job {batch_job.name}: {e}')
+    except ClusterError as e:
+        # the job is marked as failed already
+        logging.error(f'Failed to start batch job {batch_job.name}: {e}')
+        webhooks.notify_batch_job_finished(batch_job)
+
+
+@celery.task(bind=True, max_retries=None)
+def deliver_webhooks(self, callback_url):
+    """
+    Deliver the pending notifications to `callback_url`, retrying when the
+    next failed one is due.
+    """
+    retry_in = webhooks.deliver_pending(callback_url)
+    if retry_in is not None:
+        raise self.retry(countdown=retry_in)
+
+
+@celery.task
+def enqueue_pending_webhooks():
+    """
+    Schedule deliveries for notifications whose delivery task got lost, e.g.
+    because the broker was down when they were created.
+    """
+    for callback_url in webhooks.pending_callback_urls():
+        webhooks.enqueue_delivery(callback_url)
+
+
+@celery.task
+def expire_batch_jobs():
+    """
+    Archive and remove the finished jobs older than `JOB_RETENTION_DAYS`, if
+    set.
+    """
+    retention_days = current_app.config.get('JOB_RETENTION_DAYS')
+    if retention_days:
+        retention.expire_batch_jobs(retention_days)
+
+
+@celery.task
+def sweep_orphans(dry_run=False):
+    """
+    Delete the cluster objects of batch jobs which are gone or finished long
+    ago, or only report them if `dry_run`. Returns the report of every
+    cluster.
+    """
+    reports = {}
+    for cluster in get_clusters_settings():
+        try:
+            reports[cluster] = orphans.sweep_orphans(
+                get_cluster_manager_instance(cluster), dry_run=dry_run,
+            )
+        except ApiException as e:
+            logging.error(f'Failed to sweep orphans of cluster {cluster}: {e}')
+    return reports
@@ -2,6 +2,7 @@
 import base64
 import binascii
 import logging
+import re
 
 from flask import jsonify
 from mongoengine.errors import ValidationError
@@ -9,6 +10,18 @@ from mongoengine.errors import ValidationError
 
 DEFAULT_LOG_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
 
+# a number with an optional exponent followed by an optional suffix
+QUANTITY_REGEX = re.compile(
+    r'^([0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)([a-zA-Z]*)$'
+)
+QUANTITY_MULTIPLIERS = {
+    'm': 10 ** -3, '': 1,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12, 'P': 10 ** 15,
+    'E': 10 ** 18,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50,
+    'Ei': 2 ** 60,
+}
+
 
 def response_helper(result, msg="", error="", data="", code=200):
     return jsonify(
@@ -33,3 +46,17 @@ def decode_zip_file(base64_encoded_input_zip):
         raise ValidationError('', {
             'input_zip': 'must be a base64 encoded zip file.'
         })
+
+
+def parse_quantity(quantity):
+    """
+    Parse a Kubernetes resource quantity, e.g. '500m' CPUs or '128Mi' of
+    memory, into a number (of cores or bytes).
+
+    Raises `ValueError` if `quantity` isn't a valid quantity.
+    """
+    match = QUANTITY_REGEX.match(str(quantity))
+    if match is None or match.group(2) not in QUANTITY_MULTIPLIERS:
+        raise ValueError(f'Invalid quantity: {quantity}')
+    number, suffix = match.groups()
+    return float(number) * QUANTITY_MULTIPLIERS[suffix]
@@ -1,50 +1,338 @@
 # -*- coding: utf-8 -*-
-from flask import Blueprint, request
-from kubernetes_task_runner.batch_jobs import (cluster_create_batch_job,
-                                               cluster_stop_batch_job)
-from kubernetes_task_runner.exceptions import ClusterError
-from kubernetes_task_runner.models import BatchJob, BatchJobStatus
-from kubernetes_task_runner.serializers import BatchJobSchema
+import hashlib
+import json
+import math
+from datetime import datetime, timedelta
+
+from flask import Blueprint, Response, current_app, redirect, request
+from kubernetes.client.rest import ApiException
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from kubernetes_task_runner.admission import exceeds_limits, queue_stats
+from kubernetes_task_runner.batch_jobs import (cluster_stop_batch_job,
+                                               find_job_pod, log_archive_name,
+                                               parse_cluster_exception)
+from kubernetes_task_runner.events import open_event_stream
+from kubernetes_task_runner.exceptions import (BackendUnavailable,
+                                               ClusterError,
+                                               InvalidTransitionError,
+                                               StorageException)
+from kubernetes_task_runner.extensions import (get_admission_limits,
+                                               get_cluster_manager_instance,
+                                               get_clusters_settings,
+                                               get_gcloud_client)
+from kubernetes_task_runner.metrics import update_batch_job_status_counts
+from kubernetes_task_runner.models import (BatchJob, BatchJobStatus,
+                                           list_enum_values)
+from kubernetes_task_runner.placement import LEAST_LOADED, place_batch_job
+from kubernetes_task_runner.serializers import (BatchJobSchema,
+                                                serialize_live_state,
+                                                serialize_raw_batch_job,
+                                                serialize_status_event)
+from kubernetes_task_runner.stats import phase_latency_percentiles
 from kubernetes_task_runner.util import decode_zip_file, response_helper
 from mongoengine.errors import (FieldDoesNotExist, NotUniqueError,
                                 ValidationError)
+from pymongo.errors import OperationFailure
 
 BatchJobSerializer = BatchJobSchema()
 
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+# creations repeated with the same key within this time return the first job
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+
 
 api_views = Blueprint('api_views', __name__)
 
 
+@api_views.errorhandler(BackendUnavailable)
+def backend_unavailable(e):
+    """ Fail fast while the cluster or GCS is down, see `resilience`. """
+    response, code = response_helper(False, code=503,
+                                     error='BackendUnavailable', msg=str(e))
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, code
+
+
+def batch_jobs_etag(documents):
+    """
+    ETag of raw batch job documents, from their ids and versions, so it
+    changes when any of them is updated or the set of jobs changes.
+    """
+    versions = sorted(f'{document["_id"]}:{document.get("version", 0)}'
+                      for document in documents)
+    return hashlib.sha1(','.join(versions).encode()).hexdigest()
+
+
+def last_modified(documents):
+    return max(document.get('updated') or document['created']
+               for document in documents)
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
 @api_views.route('/batch/', methods=['GET'], defaults={'job_id': None})
 @api_views.route('/batch/<job_id>', methods=['GET'])
 def get_batch_job(job_id):
-    """ Retrieve one or all running batch jobs. """
-    filters = {
-        'status': request.args.get('status', BatchJobStatus.RUNNING.value),
-    }
-    if not job_id:
-        serialized = BatchJobSerializer.dump(
-            BatchJob.objects.filter(**filters),
-            many=True,
+    """
+    Retrieve one or all running batch jobs, with an `ETag` and
+    `Last-Modified`. Answers 304 if `If-None-Match` matches the ETag, only
+    querying the jobs' versions.
+
+    With `live=true`, a single job also includes its Job and pods' state from
+    its cluster's cache (see `live_state`), and so has no ETag.
+    """
+    live = bool(job_id) and request.args.get('live', 'false').lower() == 'true'
+    if job_id:
+        queryset = BatchJob.objects(id=job_id)
+    else:
+        queryset = BatchJob.objects(
+            status=request.args.get('status', BatchJobStatus.RUNNING.value),
         )
-        return response_helper(True, code=200, data=serialized.data)
     try:
-        instance = BatchJob.objects.get(id=job_id)
-    except (BatchJob.DoesNotExist, ValueError):
+        if request.if_none_match and not live:
+            versions = list(queryset.only('id', 'version').as_pymongo())
+            etag = batch_jobs_etag(versions)
+            if ((versions or not job_id)
+                    and request.if_none_match.contains(etag)):
+                return not_modified(etag)
+        documents = list(queryset.as_pymongo())
+    except ValueError:
+        documents = []
+    if job_id and not documents:
         return response_helper(False, code=404, error='DoesNotExist',
                                msg=f'Batch job {job_id} not found.')
+
+    serialized = [serialize_raw_batch_job(document) for document in documents]
+    if live:
+        serialized[0]['live'] = live_state(documents[0])
+    response, code = response_helper(
+        True, code=200, data=serialized[0] if job_id else serialized,
+    )
+    if not live:
+        response.set_etag(batch_jobs_etag(documents))
+    if documents:
+        response.last_modified = last_modified(documents)
+    return response, code
+
+
+def live_state(document):
+    """
+    State of a raw batch job document's Job and pods from its cluster's
+    cache, without calling the API server. None until the cache is synced.
+    """
+    try:
+        cluster_manager = get_cluster_manager_instance(document.get('cluster'))
+    except ClusterError:
+        return None
+    cache = cluster_manager.cache
+    if not cache.synced:
+        return None
+    name, namespace = document.get('name'), document.get('namespace')
+    return serialize_live_state(cache.get_job(name, namespace),
+                                cache.list_pods(name, namespace).items)
+
+
+@api_views.route('/batch/stats/latency', methods=['GET'])
+def get_batch_job_latency_stats():
+    """
+    Percentiles of each batch job phase's duration (in milliseconds) for jobs
+    created in the requested window (timestamps in milliseconds, default is
+    the last 24 hours).
+    """
+    until = request.args.get('until', type=int)
+    since = request.args.get('since', type=int)
+    until = (datetime.utcfromtimestamp(until / 1000) if until is not None
+             else datetime.utcnow())
+    since = (datetime.utcfromtimestamp(since / 1000) if since is not None
+             else until - timedelta(days=1))
+    if since >= until:
+        return response_helper(False, code=400, error='InvalidParameters',
+                               msg='`since` must be earlier than `until`.')
     return response_helper(True, code=200,
-                           data=BatchJobSerializer.dump(instance).data)
+                           data=phase_latency_percentiles(since, until))
+
+
+@api_views.route('/batch/stats/queue', methods=['GET'])
+def get_batch_job_queue_stats():
+    """
+    Queue depth and wait time of the queued batch jobs and the usage of the
+    active ones, overall and per owner.
+    """
+    limits, _ = get_admission_limits()
+    return response_helper(True, code=200, data=queue_stats(limits))
+
+
+def server_sent_events(events):
+    """ Format status change events, or heartbeats for None. """
+    try:
+        for event in events:
+            if event is None:
+                yield ': heartbeat\n\n'
+                continue
+            data = json.dumps(serialize_status_event(event), sort_keys=True)
+            yield f'id: {event["id"]}\nevent: status\ndata: {data}\n\n'
+    finally:
+        # stop watching as soon as the client goes away
+        events.close()
+
+
+@api_views.route('/batch/events', methods=['GET'], defaults={'job_id': None})
+@api_views.route('/batch/<job_id>/events', methods=['GET'])
+def stream_batch_job_events(job_id):
+    """
+    Stream the status changes of one or all batch jobs as server-sent events,
+    optionally only the changes to the given `status` values. Resumes after
+    the `Last-Event-ID` header if given.
+    """
+    statuses = request.args.getlist('status')
+    invalid_statuses = set(statuses) - set(list_enum_values(BatchJobStatus))
+    if invalid_statuses:
+        return response_helper(False, code=400, error='InvalidParameters',
+                               msg=f'Invalid status: '
+                                   f'{", ".join(sorted(invalid_statuses))}.')
+    if job_id is not None:
+        try:
+            job_id = BatchJob.objects.only('id').get(id=job_id).id
+        except (BatchJob.DoesNotExist, ValueError):
+            return response_helper(False, code=404, error='DoesNotExist',
+                                   msg=f'Batch job {job_id} not found.')
+
+    try:
+        events = open_event_stream(BatchJob._get_collection(), job_id,
+                                   statuses,
+                                   request.headers.get('Last-Event-ID'))
+    except (OperationFailure, ValueError):
+        return response_helper(False, code=400, error='InvalidParameters',
+                               msg='Can\'t resume from the last event id.')
+
+    return Response(server_sent_events(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             # don't let proxies buffer the stream
+                             'X-Accel-Buffering': 'no'})
+
+
+@api_views.route('/batch/<job_id>/logs', methods=['GET'])
+def get_batch_job_logs(job_id):
+    """
+    Stream the logs of the batch job's pod, or of its cleanup job's pod with
+    `cleanup=true`. With `follow=true` the stream goes on until the pod
+    terminates. Once the pod is gone, redirects to the logs archived on GCS.
+    """
+    try:
+        batch_job = BatchJob.objects.only(
+            'name', 'cluster', 'namespace',
+        ).get(id=job_id)
+    except (BatchJob.DoesNotExist, ValueError):
+        return response_helper(False, code=404, error='DoesNotExist',
+                               msg=f'Batch job {job_id} not found.')
+    follow = request.args.get('follow', 'false').lower() == 'true'
+    cleanup = request.args.get('cleanup', 'false').lower() == 'true'
+    job_name = batch_job.cleanup_job_name if cleanup else batch_job.name
+
+    try:
+        cluster_manager = get_cluster_manager_instance(batch_job.cluster)
+        pod = find_job_pod(cluster_manager, job_name, batch_job.namespace)
+        if pod is not None:
+            chunks = cluster_manager.stream_pod_log(
+                pod.metadata.name, follow=follow,
+                namespace=batch_job.namespace,
+            )
+            return Response(chunks, mimetype='text/plain',
+                            headers={'X-Accel-Buffering': 'no'})
+    except ApiException as e:
+        return response_helper(False, code=500, error='ClusterError',
+                               msg=f'Failed to read the logs of {job_name}',
+                               data=parse_cluster_exception(e))
+    except ClusterError as e:
+        return response_helper(False, code=500, error='ClusterError',
+                               msg=str(e))
+
+    try:
+        archive_url = get_gcloud_client().get_output_file_url(
+            log_archive_name(job_name),
+        )
+    except StorageException:
+        return response_helper(False, code=404, error='DoesNotExist',
+                               msg=f'No logs found for {job_name}.')
+    return redirect(archive_url)
+
+
+def place_new_batch_job(batch_job):
+    """
+    Pick the cluster for `batch_job` out of the ones managing its namespace
+    and with a node it fits on, as far as their cached capacity tells.
+    """
+    clusters = {}
+    for name, settings in get_clusters_settings().items():
+        cluster_manager = get_cluster_manager_instance(name)
+        if (batch_job.namespace is not None
+                and batch_job.namespace not in cluster_manager.namespaces):
+            continue
+        # never list the nodes here, the cached capacity is refreshed in the
+        # background
+        node_capacity = cluster_manager.node_capacity(refresh=False)
+        if not exceeds_limits(batch_job, node_capacity=node_capacity):
+            clusters[name] = settings.get('labels')
+    return place_batch_job(
+        batch_job, clusters,
+        current_app.config.get('PLACEMENT_POLICY', LEAST_LOADED),
+    )
+
+
+def find_idempotent_batch_job(idempotency_key):
+    """
+    The job created with `idempotency_key`, None if there's none or its key
+    expired, in which case the key is released for a new job.
+    """
+    batch_job = BatchJob.objects(idempotency_key=idempotency_key).first()
+    if batch_job is None:
+        return None
+    if batch_job.created >= datetime.utcnow() - IDEMPOTENCY_KEY_TTL:
+        return batch_job
+    BatchJob.objects(id=batch_job.id, idempotency_key=idempotency_key).update(
+        unset__idempotency_key=True,
+        inc__version=1,
+        set__updated=datetime.utcnow(),
+    )
+    return None
+
+
+def replay_batch_job(batch_job):
+    """ Respond to a repeated creation request with the job it created. """
+    response, code = response_helper(
+        True, code=200,
+        msg=f'Batch job {batch_job.id} was already created with this '
+            f'{IDEMPOTENCY_KEY_HEADER}.',
+        data=BatchJobSerializer.dump(batch_job).data,
+    )
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, code
 
 
 @api_views.route('/batch/', methods=['POST'])
 def create_batch_job():
     """
-    Create a new batch job and schedule an asynchronous task to start running
-    it on the cluster.
+    Create a new batch job and queue it until the dispatcher admits it to the
+    cluster.
+
+    Requests with an `Idempotency-Key` header already used by a job created
+    within `IDEMPOTENCY_KEY_TTL` return that job instead.
     """
     body = request.json or {}
-    body.pop('status', None)
+    body['status'] = BatchJobStatus.QUEUED.value
+    idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+    body.pop('idempotency_key', None)
+    if idempotency_key is not None:
+        existing_batch_job = find_idempotent_batch_job(idempotency_key)
+        if existing_batch_job is not None:
+            return replay_batch_job(existing_batch_job)
+        body['idempotency_key'] = idempotency_key
 
     try:
         job_parameters = body.get('job_parameters', None)
@@ -52,6 +340,26 @@ def create_batch_job():
         if isinstance(job_parameters, dict):
             input_zip = job_parameters.pop('input_zip', None)
         batch_job = BatchJob(**body)
+        batch_job.validate()
+        if exceeds_limits(batch_job, *get_admission_limits()):
+            return response_helper(
+                False, code=400, error='InvalidParameters',
+                msg='The requested resources exceed the admission limits.',
+            )
+        # assigning None to the field would set its default instead
+        cluster = place_new_batch_job(batch_job)
+        if cluster is None:
+            return response_helper(
+                False, code=400, error='InvalidParameters',
+                msg='No cluster matching the cluster selector and managing '
+                    'the namespace has a node with capacity for the '
+                    'requested resources.',
+            )
+        batch_job.cluster = cluster
+        if batch_job.namespace is None:
+            batch_job.namespace = get_cluster_manager_instance(
+                batch_job.cluster,
+            ).namespace
         if input_zip:
             batch_job.job_parameters.input_zip.put(decode_zip_file(input_zip))
         saved_batch_job = batch_job.save()
@@ -59,6 +367,13 @@ def create_batch_job():
         return response_helper(False, code=400, error='InvalidParameters',
                                msg=str(err))
     except NotUniqueError:
+        if batch_job.input_file.grid_id is not None:
+            batch_job.input_file.delete()
+        if idempotency_key is not None:
+            # a concurrent request with the same key may have won
+            existing_batch_job = find_idempotent_batch_job(idempotency_key)
+            if existing_batch_job is not None:
+                return replay_batch_job(existing_batch_job)
         # mongoengine doesn't give us the field that raises the exception
         unique_fields = ''.join([field_name for field_name, field
                                  in BatchJob._fields.items() if field.unique])
@@ -70,12 +385,7 @@ def create_batch_job():
                                msg='One or more fields had invalid values',
                                data=err.to_dict())
 
-    try:
-        _, message = cluster_create_batch_job(saved_batch_job)
-    except ClusterError as e:
-        return response_helper(False, code=500, error='ClusterError',
-                               msg=str(e), data=e.context)
-
+    message = f'Batch job {saved_batch_job.id} queued.'
     return response_helper(True, code=200, msg=message,
                            data=BatchJobSerializer.dump(saved_batch_job).data)
 
@@ -88,7 +398,9 @@ def stop_batch_job(job_id):
     except (BatchJob.DoesNotExist, ValueError):
         return response_helper(False, code=404, error='DoesNotExist',
                                msg=f'Batch job {job_id} not found.')
-    running_status_list = (BatchJobStatus.RUNNING.value,
+    running_status_list = (BatchJobStatus.QUEUED.value,
+                           BatchJobStatus.CREATED.value,
+                           BatchJobStatus.RUNNING.value,
                            BatchJobStatus.CLEANING.value)
     if batch_job.status not in running_status_list:
         message = (f'Can\'t stop batch job {job_id}. Status is: '
@@ -98,6 +410,9 @@ def stop_batch_job(job_id):
 
     try:
         cluster_stop_batch_job(batch_job)
+    except InvalidTransitionError as e:
+        return response_helper(False, code=409, error='InvalidTransition',
+                               msg=str(e))
     except ClusterError as e:
         return response_helper(False, code=500, error='ClusterError',
                                msg=str(e), data=e.context)
@@ -105,3 +420,10 @@ def stop_batch_job(job_id):
     message = f'Instance {job_id} was successfully deleted from the cluster.'
     return response_helper(True, code=200, msg=message,
                            data=BatchJobSerializer.dump(batch_job).data)
+
+
+@api_views.route('/metrics', methods=['GET'])
+def metrics():
+    """ Expose Prometheus metrics. """
+    update_batch_job_status_counts()
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Notify a batch job's `callback_url` when it reaches a terminal status.
+
+Notifications are stored in MongoDB and delivered by the
+`deliver_webhooks` task on the dedicated `webhooks` Celery queue, so slow or
+failing destinations never hold up the synchronization loop. Every delivery
+POSTs all the notifications due for a destination as one batch:
+
+    {"events": [<batch job>, ...]}
+
+Failed deliveries are retried with exponential backoff until
+`MAX_ATTEMPTS` is reached.
+"""
+import logging
+import uuid
+from datetime import datetime, timedelta
+
+import requests
+from celery import current_app as celery_app
+
+from kubernetes_task_runner.metrics import (WEBHOOK_DELIVERY_LATENCY,
+                                            WEBHOOK_NOTIFICATIONS,
+                                            WEBHOOK_REQUEST_LATENCY,
+                                            observe_latency)
+from kubernetes_task_runner.models import (TERMINAL_STATUSES,
+                                           WebhookNotification,
+                                           WebhookNotificationStatus)
+from kubernetes_task_runner.serializers import BatchJobSchema
+
+DELIVER_TASK_NAME = 'kubernetes_task_runner.tasks.deliver_webhooks'
+WEBHOOKS_QUEUE = 'webhooks'
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 8
+# seconds before the first retry, doubled on every attempt
+BACKOFF_BASE = 10
+BACKOFF_MAX = 3600
+REQUEST_TIMEOUT = 10
+# seconds a worker has to deliver the notifications it claimed
+CLAIM_TIMEOUT = 60
+
+BatchJobSerializer = BatchJobSchema()
+
+
+def backoff_seconds(attempts):
+    """ Seconds to wait before retrying after `attempts` failed attempts. """
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def enqueue_delivery(callback_url, countdown=None):
+    celery_app.send_task(DELIVER_TASK_NAME, args=[callback_url],
+                         countdown=countdown)
+
+
+def notify_batch_job_finished(batch_job):
+    """
+    Schedule a notification of `batch_job`'s terminal status to its
+    callback URL, if it has one.
+    """
+    if not batch_job.callback_url or batch_job.status not in TERMINAL_STATUSES:
+        return
+    WebhookNotification(
+        job_id=batch_job.id,
+        callback_url=batch_job.callback_url,
+        payload=BatchJobSerializer.dump(batch_job).data,
+    ).save()
+    try:
+        enqueue_delivery(batch_job.callback_url)
+    except Exception as e:
+        # the periodic `enqueue_pending_webhooks` task will pick it up
+        logging.error('Failed to schedule webhook delivery for job '
+                      f'{batch_job.name}: {e}')
+
+
+def claim_due_notifications(callback_url, limit=BATCH_SIZE):
+    """
+    Claim up to `limit` pending notifications to `callback_url` which are
+    due, so no other worker delivers them until `CLAIM_TIMEOUT` passes.
+    """
+    now = datetime.utcnow()
+    due = dict(status=WebhookNotificationStatus.PENDING.value,
+               callback_url=callback_url, next_attempt_at__lte=now)
+    ids = [notification.id for notification in WebhookNotification.objects(
+        **due
+    ).order_by('next_attempt_at').only('id').limit(limit)]
+    if not ids:
+        return []
+    claim_id = uuid.uuid4()
+    # only notifications nobody else claimed in the meantime are still due
+    WebhookNotification.objects(id__in=ids, **due).update(
+        set__claim_id=claim_id,
+        set__next_attempt_at=now + timedelta(seconds=CLAIM_TIMEOUT),
+    )
+    return list(WebhookNotification.objects(claim_id=claim_id))
+
+
+def record_failure(notification, error):
+    """ Schedule the next attempt of `notification`, or give up. """
+    attempts = notification.attempts + 1
+    if attempts >= MAX_ATTEMPTS:
+        WEBHOOK_NOTIFICATIONS.labels(outcome='failed').inc()
+        logging.error(f'Giving up on notifying {notification.callback_url} '
+                      f'of job {notification.job_id}: {error}')
+        status = WebhookNotificationStatus.FAILED.value
+    else:
+        WEBHOOK_NOTIFICATIONS.labels(outcome='retried').inc()
+        status = WebhookNotificationStatus.PENDING.value
+    next_attempt_at = (datetime.utcnow()
+                       + timedelta(seconds=backoff_seconds(attempts)))
+    notification.update(set__status=status, set__attempts=attempts,
+                        set__next_attempt_at=next_attempt_at,
+                        set__last_error=error, unset__claim_id=True)
+
+
+def seconds_until_next_attempt(callback_url):
+    """ Seconds until a pending notification to `callback_url` is due. """
+    notification = WebhookNotification.objects(
+        status=WebhookNotificationStatus.PENDING.value,
+        callback_url=callback_url,
+    ).order_by('next_attempt_at').only('next_attempt_at').first()
+    if notification is None:
+        return None
+    delay = (notification.next_attempt_at - datetime.utcnow()).total_seconds()
+    return max(delay, 0)
+
+
+def deliver_pending(callback_url):
+    """
+    Deliver the due notifications to `callback_url` in batches.
+
+    Returns the seconds until the next attempt is due if there are pending
+    notifications left (e.g. a delivery failed), None otherwise.
+    """
+    while True:
+        notifications = claim_due_notifications(callback_url)
+        if not notifications:
+            break
+        body = {'events': [notification.payload
+                           for notification in notifications]}
+        try:
+            with observe_latency(WEBHOOK_REQUEST_LATENCY,
+                                 outcome_label='status_code') as labels:
+                response = requests.post(callback_url, json=body,
+                                         timeout=REQUEST_TIMEOUT)
+                labels['status_code'] = str(response.status_code)
+                response.raise_for_status()
+        except requests.RequestException as e:
+            logging.warning(f'Failed to deliver {len(notifications)} '
+                            f'notifications to {callback_url}: {e}')
+            for notification in notifications:
+                record_failure(notification, str(e))
+            break
+
+        now = datetime.utcnow()
+        WebhookNotification.objects(
+            id__in=[notification.id for notification in notifications],
+        ).update(set__status=WebhookNotificationStatus.DELIVERED.value,
+                 set__delivered_at=now, unset__claim_id=True)
+        for notification in notifications:
+            WEBHOOK_NOTIFICATIONS.labels(outcome='delivered').inc()
+            WEBHOOK_DELIVERY_LATENCY.observe(
+                (now - notification.created).total_seconds(),
+            )
+    return seconds_until_next_attempt(callback_url)
+
+
+def pending_callback_urls():
+    """ Callback URLs with notifications waiting to be delivered. """
+    return WebhookNotification.objects(
+        status=WebhookNotificationStatus.PENDING.value,
+        next_attempt_at__lte=datetime.utcnow(),
+    ).distinct('callback_url')
@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
+# make blocking I/O (MongoDB, the Kubernetes and GCS APIs, `time.sleep`)
+# cooperative before anything else imports it, see `server`
+from gevent import monkey
+monkey.patch_all()
+
 import click
-from gevent import pywsgi
 
-from kubernetes_task_runner.app import create_app
 from kubernetes_task_runner.extensions import app_config_reader
+from kubernetes_task_runner.server import create_server, fork_workers, serve
 from kubernetes_task_runner.util import logger_pick
 
 
 @click.command()
 @click.argument('API_HOST', envvar='API_HOST', default='0.0.0.0')
 @click.argument('API_PORT', envvar='API_PORT', default=4898)
+@click.option('--workers', envvar='API_WORKERS', type=click.IntRange(min=1),
+              default=1, help='Processes serving the API.')
 @app_config_reader
-def run_server(api_host, api_port, app_config):
+def run_server(api_host, api_port, workers, app_config):
     logger_pick(app_config['LOG_LEVEL'])
-    app = create_app(app_config)
-    server = pywsgi.WSGIServer((api_host, api_port), app)
-    server.serve_forever()
+    server = create_server(api_host, api_port)
+    if workers > 1:
+        # bind before forking, so every worker accepts on the same socket
+        server.init_socket()
+        fork_workers(workers)
+    serve(server, app_config)
 
 
 if __name__ == '__main__':
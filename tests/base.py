@@ -15,7 +15,6 @@ TEST_CONFIG = {
         'api_key': '',
         'host': 'localhost',
         'namespace': 'default',
-        'statefulset_name': 'test_sts',
     },
     'GOOGLE_CLOUD_SETTINGS': {
         'bucket_name': 'bucket_name',
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory stand-in for `ClusterManager`, for offline end-to-end and load
+testing.
+
+Jobs move through their states over (virtual) time: they wait for a free slot
+when the cluster is at capacity, take `start_delay` seconds to get their pod
+running, run for `run_duration` seconds and then either succeed or fail
+according to `failure_rate`. Time is driven by a `FakeClock`, so simulations
+run as fast as the code under test allows.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from kubernetes_task_runner.informer import ClusterCache
+from kubernetes_task_runner.resilience import CircuitBreaker
+from kubernetes_task_runner.tasks import start_batch_job
+
+
+EPOCH = datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeClock:
+    """
+    Virtual clock, in seconds. Patch `time.sleep` with `sleep`: only the
+    thread creating the clock sleeps virtually, others (e.g. the thread
+    pools of the API clients) keep sleeping for real.
+    """
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self._thread = threading.current_thread()
+        self._real_sleep = time.sleep
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if threading.current_thread() is not self._thread:
+            return self._real_sleep(seconds)
+        self.now += max(seconds, 0)
+
+    def datetime(self, seconds=None):
+        """ Convert a virtual time (default: now) to a datetime. """
+        seconds = self.now if seconds is None else seconds
+        return EPOCH + timedelta(seconds=seconds)
+
+
+class FakeJob:
+    """ State of a Job (and its single pod) on the fake cluster. """
+
+    def __init__(self, body, namespace, created_at, ready_at):
+        self.body = body
+        self.namespace = namespace
+        self.uid = str(uuid.uuid4())
+        self.created_at = created_at
+        # earliest time the pod can start running
+        self.ready_at = ready_at
+        self.started_at = None
+        self.finish_at = None
+        self.finished_at = None
+        self.succeeded = None
+        self.deleted = False
+
+    @property
+    def name(self):
+        return self.body['metadata']['name']
+
+    @property
+    def pod_phase(self):
+        if self.started_at is None:
+            return 'Pending'
+        if self.finished_at is None:
+            return 'Running'
+        return 'Succeeded' if self.succeeded else 'Failed'
+
+
+def _not_found(kind, name):
+    return ApiException(status=404, reason=f'{kind} {name} not found')
+
+
+def _already_exists(kind, name):
+    return ApiException(status=409, reason=f'{kind} {name} already exists')
+
+
+class FakeClusterManager:
+    """
+    Implements the `ClusterManager` surface used by the task runner: jobs,
+    pods (including watches and logs), PVCs and secrets.
+
+    - `latency`: virtual seconds every API call takes.
+    - `start_delay`/`run_duration`: (min, max) seconds, sampled uniformly.
+    - `failure_rate`: probability of a job failing after running.
+    - `capacity`: maximum number of concurrently running pods (None for no
+      limit).
+    """
+
+    def __init__(self, clock=None, latency=0.0, start_delay=(1, 5),
+                 run_duration=(10, 60), failure_rate=0.0, capacity=None,
+                 namespace='default', seed=None):
+        self.clock = clock or FakeClock()
+        self.latency = latency
+        self.start_delay = start_delay
+        self.run_duration = run_duration
+        self.failure_rate = failure_rate
+        self.capacity = capacity
+        self.namespace = namespace
+        self.namespaces = [namespace]
+        self.random = random.Random(seed)
+        self.jobs = {}
+        self.pvcs = {}
+        self.secrets = {}
+        self.api_calls = 0
+        # never opens, the fake cluster doesn't fail
+        self.circuit_breaker = CircuitBreaker('Fake cluster', probe=None)
+        # never started, the calls are counted
+        self.cache = ClusterCache(self)
+        # heaps of (ready_at, seq, job) and (finish_at, seq, job)
+        self._pending = []
+        self._running = []
+        self._running_count = 0
+        self._sequence = itertools.count()
+        # time of the last processed simulation event
+        self._simulation_time = self.clock.time()
+
+    # simulation
+
+    def _call(self):
+        """ Account for an API call and bring the cluster state up to date. """
+        self.api_calls += 1
+        self.clock.sleep(self.latency)
+        self._advance()
+
+    def _advance(self):
+        """ Process every start/finish event up to the current time. """
+        now = self.clock.time()
+        while True:
+            # jobs deleted while pending/running are dropped lazily
+            for heap in (self._pending, self._running):
+                while heap and heap[0][2].deleted:
+                    heapq.heappop(heap)
+            has_capacity = (self.capacity is None
+                            or self._running_count < self.capacity)
+
+            start_at = finish_at = None
+            if self._pending and has_capacity:
+                start_at = max(self._pending[0][0], self._simulation_time)
+            if self._running:
+                finish_at = self._running[0][0]
+
+            if finish_at is not None and finish_at <= now and (
+                    start_at is None or finish_at <= start_at):
+                _, _, job = heapq.heappop(self._running)
+                job.finished_at = finish_at
+                self._running_count -= 1
+                self._simulation_time = finish_at
+            elif start_at is not None and start_at <= now:
+                _, _, job = heapq.heappop(self._pending)
+                job.started_at = start_at
+                job.finish_at = start_at + self.random.uniform(
+                    *self.run_duration
+                )
+                job.succeeded = self.random.random() >= self.failure_rate
+                heapq.heappush(self._running,
+                               (job.finish_at, next(self._sequence), job))
+                self._running_count += 1
+                self._simulation_time = start_at
+            else:
+                self._simulation_time = now
+                return
+
+    def _get(self, collection, kind, name):
+        try:
+            return collection[name]
+        except KeyError:
+            raise _not_found(kind, name)
+
+    def _watch(self, select, to_response, timeout_seconds):
+        """
+        Yield MODIFIED/DELETED events for the jobs returned by `select`
+        whose pod phase changes within `timeout_seconds`, advancing the clock
+        a second at a time.
+        """
+        jobs = {job.name: job for job in select()}
+        phases = {name: job.pod_phase for name, job in jobs.items()}
+        deadline = self.clock.time() + timeout_seconds
+        while self.clock.time() < deadline:
+            self.clock.sleep(min(1, deadline - self.clock.time()))
+            self._advance()
+            current = {job.name: job for job in select()}
+            for name in set(jobs) - set(current):
+                del phases[name]
+                job = jobs.pop(name)
+                yield {'type': 'DELETED', 'object': to_response(job)}
+            for name, job in current.items():
+                jobs[name] = job
+                if phases.get(name) != job.pod_phase:
+                    phases[name] = job.pod_phase
+                    yield {'type': 'MODIFIED', 'object': to_response(job)}
+
+    # API representations
+
+    def _job_response(self, job):
+        phase = job.pod_phase
+        return client.V1Job(
+            metadata=client.V1ObjectMeta(
+                name=job.name,
+                namespace=job.namespace,
+                uid=job.uid,
+                annotations=job.body['metadata'].get('annotations'),
+                labels=job.body['metadata'].get('labels'),
+                owner_references=[
+                    client.V1OwnerReference(
+                        api_version=reference['apiVersion'],
+                        kind=reference['kind'], name=reference['name'],
+                        uid=reference['uid'],
+                    )
+                    for reference in
+                    job.body['metadata'].get('ownerReferences') or []
+                ] or None,
+            ),
+            status=client.V1JobStatus(
+                active=1 if phase in ('Pending', 'Running') else None,
+                succeeded=1 if phase == 'Succeeded' else None,
+                failed=1 if phase == 'Failed' else None,
+                start_time=self.clock.datetime(job.created_at),
+                completion_time=(self.clock.datetime(job.finished_at)
+                                 if phase == 'Succeeded' else None),
+            ),
+        )
+
+    def _pod_response(self, job):
+        return client.V1Pod(
+            metadata=client.V1ObjectMeta(
+                name=f'{job.name}-{job.uid[:5]}',
+                namespace=job.namespace,
+                labels={'job-name': job.name},
+            ),
+            status=client.V1PodStatus(phase=job.pod_phase),
+        )
+
+    # ClusterManager surface
+
+    def get_job(self, job_name, ignore_404=False, namespace=None):
+        self._call()
+        if ignore_404 and job_name not in self.jobs:
+            return None
+        return self._job_response(self._get(self.jobs, 'Job', job_name))
+
+    def watch_job(self, job_name, timeout_seconds, resource_version=None,
+                  namespace=None):
+        self._call()
+        return self._watch(
+            lambda: [self.jobs[job_name]] if job_name in self.jobs else [],
+            self._job_response, timeout_seconds,
+        )
+
+    def create_job(self, job_configuration, namespace=None):
+        self._call()
+        name = job_configuration['metadata']['name']
+        if name in self.jobs:
+            raise _already_exists('Job', name)
+        now = self.clock.time()
+        job = FakeJob(job_configuration, namespace or self.namespace,
+                      created_at=now,
+                      ready_at=now + self.random.uniform(*self.start_delay))
+        self.jobs[name] = job
+        heapq.heappush(self._pending,
+                       (job.ready_at, next(self._sequence), job))
+        return self._job_response(job)
+
+    def list_jobs(self, label_selector=None, namespace=None):
+        self._call()
+        return client.V1JobList(items=[
+            self._job_response(job) for job in self.jobs.values()
+            if job.namespace == (namespace or self.namespace)
+        ])
+
+    def list_managed_jobs(self):
+        self._call()
+        managed_jobs = {namespace: [] for namespace in self.namespaces}
+        for job in self.jobs.values():
+            if job.namespace in managed_jobs:
+                managed_jobs[job.namespace].append(self._job_response(job))
+        return managed_jobs
+
+    def _remove_job(self, job):
+        # background propagation: the pod goes away with the job
+        if job.pod_phase == 'Running':
+            self._running_count -= 1
+        job.deleted = True
+        del self.jobs[job.name]
+
+        # and so does whatever the job owns, as the garbage collector would
+        def owned(body):
+            return any(reference['uid'] == job.uid for reference in
+                       body['metadata'].get('ownerReferences') or [])
+        for name, pvc in list(self.pvcs.items()):
+            if owned(pvc):
+                del self.pvcs[name]
+        for owned_job in list(self.jobs.values()):
+            if owned_job.name in self.jobs and owned(owned_job.body):
+                self._remove_job(owned_job)
+
+    def delete_job(self, job_name, namespace=None):
+        self._call()
+        self._remove_job(self._get(self.jobs, 'Job', job_name))
+        return client.V1Status(status='Success')
+
+    def _select_pods(self, label_selector):
+        jobs = list(self.jobs.values())
+        if label_selector is not None:
+            key, _, value = label_selector.partition('=')
+            if key != 'job-name':
+                raise ApiException(status=400,
+                                   reason=f'Unsupported selector {key}')
+            jobs = [job for job in jobs if job.name == value]
+        return jobs
+
+    def list_pods(self, label_selector=None, namespace=None):
+        self._call()
+        return client.V1PodList(
+            metadata=client.V1ListMeta(resource_version=str(self.api_calls)),
+            items=[self._pod_response(job)
+                   for job in self._select_pods(label_selector)],
+        )
+
+    def watch_pods(self, label_selector, timeout_seconds,
+                   resource_version=None, namespace=None):
+        self._call()
+        return self._watch(lambda: self._select_pods(label_selector),
+                           self._pod_response, timeout_seconds)
+
+    def stream_pod_log(self, pod_name, follow=False, chunk_size=None,
+                       namespace=None):
+        self._call()
+        if not any(pod_name.startswith(f'{name}-') for name in self.jobs):
+            raise _not_found('Pod', pod_name)
+        return iter([f'Log of {pod_name}\n'.encode('utf-8')])
+
+    def node_capacity(self, max_age=None, refresh=True):
+        # capacity is modelled as pod slots, not node resources
+        return None
+
+    def create_pvc(self, pvc_configuration, namespace=None):
+        self._call()
+        name = pvc_configuration['metadata']['name']
+        if name in self.pvcs:
+            raise _already_exists('PersistentVolumeClaim', name)
+        self.pvcs[name] = pvc_configuration
+        return pvc_configuration
+
+    def get_pvc(self, pvc_name, ignore_404=False, namespace=None):
+        self._call()
+        if ignore_404 and pvc_name not in self.pvcs:
+            return None
+        return self._get(self.pvcs, 'PersistentVolumeClaim', pvc_name)
+
+    def delete_pvc(self, pvc_name, ignore_404=False, namespace=None):
+        self._call()
+        if pvc_name not in self.pvcs:
+            if ignore_404:
+                return
+            raise _not_found('PersistentVolumeClaim', pvc_name)
+        del self.pvcs[pvc_name]
+        return client.V1Status(status='Success')
+
+    def create_secrets_file(self, name, file_path, ignore_existing=False,
+                            filename=None, namespace=None):
+        self._call()
+        if name in self.secrets:
+            if ignore_existing:
+                return
+            raise _already_exists('Secret', name)
+        self.secrets[name] = {'file_path': file_path, 'filename': filename}
+        return self.secrets[name]
+
+    def read_secret(self, name, namespace=None):
+        self._call()
+        return self._get(self.secrets, 'Secret', name)
+
+    def delete_secret(self, name, namespace=None):
+        self._call()
+        self._get(self.secrets, 'Secret', name)
+        del self.secrets[name]
+        return client.V1Status(status='Success')
+
+
+@contextmanager
+def simulated_cluster(cluster_manager):
+    """
+    Route every cluster and GCS access of the task runner to
+    `cluster_manager`, with `time.sleep` advancing its virtual clock and the
+    runner's deadlines following it.
+    """
+    gcs_client = Mock()
+    gcs_client.get_output_file_url = Mock(
+        return_value='https://storage.googleapis.com/fake-output.zip',
+    )
+    with ExitStack() as stack:
+        for module in ('batch_jobs', 'tasks'):
+            module_path = f'kubernetes_task_runner.{module}'
+            stack.enter_context(patch(
+                f'{module_path}.get_cluster_manager_instance',
+                return_value=cluster_manager,
+            ))
+            stack.enter_context(patch(f'{module_path}.get_gcloud_client',
+                                      return_value=gcs_client))
+        stack.enter_context(patch('time.sleep', cluster_manager.clock.sleep))
+        # deploy admitted jobs right away instead of through the broker
+        stack.enter_context(patch(
+            'kubernetes_task_runner.tasks.start_batch_job.delay',
+            start_batch_job,
+        ))
+        # deadlines of the task runner follow the virtual clock too
+        stack.enter_context(patch(
+            'kubernetes_task_runner.batch_jobs.time',
+            Mock(sleep=cluster_manager.clock.sleep,
+                 monotonic=cluster_manager.clock.time),
+        ))
+        yield cluster_manager
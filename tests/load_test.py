@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Offline end-to-end load test.
+
+Submits jobs through the Flask test client against a `FakeClusterManager`,
+runs the synchronization task until every job reaches a terminal state and
+reports throughput and time-to-terminal-state percentiles:
+
+    python -m tests.load_test --jobs 2000 --capacity 200 --failure-rate 0.05
+
+Cluster time is virtual (see `FakeClock`): time-to-terminal-state is measured
+in simulated seconds while throughput is measured against the wall clock.
+"""
+import json
+import math
+import time
+from collections import Counter
+
+import click
+
+from kubernetes_task_runner.app import create_app
+from kubernetes_task_runner.models import BatchJob, db
+from kubernetes_task_runner.stats import TERMINAL_STATUSES
+from kubernetes_task_runner.tasks import synchronize_batch_jobs
+
+from .base import TEST_CONFIG
+from .fake_cluster import FakeClock, FakeClusterManager, simulated_cluster
+
+
+def percentile(values, percent):
+    """ Nearest-rank percentile of `values`. """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def run_simulation(app, cluster_manager, job_count, sync_interval=30,
+                   max_cycles=1000):
+    """
+    Submit `job_count` jobs and synchronize every `sync_interval` (virtual)
+    seconds until all of them are terminal or `max_cycles` is reached.
+    """
+    clock = cluster_manager.clock
+    client = app.test_client()
+    submitted_at = {}
+    terminal_at = {}
+
+    wall_start = time.monotonic()
+    with simulated_cluster(cluster_manager):
+        for index in range(job_count):
+            name = f'load-test-{index}'
+            submitted_at[name] = clock.time()
+            client.post('/batch/', content_type='application/json',
+                        data=json.dumps({
+                            'name': name,
+                            'job_parameters': {'docker_image': 'python'},
+                        }))
+        submission_seconds = time.monotonic() - wall_start
+
+        cycles = 0
+        with app.app_context():
+            while len(terminal_at) < job_count and cycles < max_cycles:
+                terminal_jobs = BatchJob.objects(
+                    status__in=TERMINAL_STATUSES,
+                    name__nin=list(terminal_at),
+                ).only('name')
+                for batch_job in terminal_jobs:
+                    terminal_at[batch_job.name] = clock.time()
+                if len(terminal_at) == job_count:
+                    break
+                clock.sleep(sync_interval)
+                synchronize_batch_jobs()
+                cycles += 1
+            statuses = Counter(batch_job.status for batch_job
+                               in BatchJob.objects.only('status'))
+    wall_seconds = time.monotonic() - wall_start
+
+    times_to_terminal = [terminal_at[name] - submitted_at[name]
+                         for name in terminal_at]
+    return {
+        'jobs': job_count,
+        'terminal_jobs': len(terminal_at),
+        'statuses': dict(statuses),
+        'sync_cycles': cycles,
+        'api_calls': cluster_manager.api_calls,
+        'wall_seconds': round(wall_seconds, 3),
+        'submissions_per_second': round(job_count / submission_seconds, 2),
+        'terminal_jobs_per_second': round(len(terminal_at) / wall_seconds, 2),
+        'simulated_seconds': clock.time(),
+        'time_to_terminal_seconds': {
+            f'p{percent}': percentile(times_to_terminal, percent)
+            for percent in (50, 95, 99)
+        },
+    }
+
+
+@click.command()
+@click.option('--jobs', type=click.INT, default=1000,
+              help='Number of jobs to submit.')
+@click.option('--capacity', type=click.INT, default=None,
+              help='Maximum concurrently running pods (default: no limit).')
+@click.option('--latency', type=click.FLOAT, default=0.05,
+              help='Simulated seconds per cluster API call.')
+@click.option('--failure-rate', type=click.FLOAT, default=0.0,
+              help='Probability of a job failing.')
+@click.option('--start-delay', type=click.FLOAT, nargs=2, default=(1, 5),
+              help='Min and max seconds for a pod to start.')
+@click.option('--run-duration', type=click.FLOAT, nargs=2, default=(10, 60),
+              help='Min and max seconds a job runs for.')
+@click.option('--sync-interval', type=click.INT, default=30,
+              help='Simulated seconds between synchronizations.')
+@click.option('--max-cycles', type=click.INT, default=1000,
+              help='Give up after this many synchronizations.')
+@click.option('--seed', type=click.INT, default=0)
+@click.option('--mongodb-host', default='mongomock://localhost',
+              help='Use a real MongoDB to include its latency.')
+def run_load_test(jobs, capacity, latency, failure_rate, start_delay,
+                  run_duration, sync_interval, max_cycles, seed,
+                  mongodb_host):
+    config = {
+        **TEST_CONFIG,
+        'MONGODB_SETTINGS': {'db': 'load_test', 'host': mongodb_host},
+    }
+    app = create_app(config)
+    with app.app_context():
+        db.connection.drop_database(config['MONGODB_SETTINGS']['db'])
+
+    cluster_manager = FakeClusterManager(
+        clock=FakeClock(), latency=latency, start_delay=start_delay,
+        run_duration=run_duration, failure_rate=failure_rate,
+        capacity=capacity, seed=seed,
+    )
+    report = run_simulation(app, cluster_manager, jobs,
+                            sync_interval=sync_interval,
+                            max_cycles=max_cycles)
+    click.echo(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    run_load_test()
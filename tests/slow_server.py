@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+API server whose `/batch/stats/queue` blocks in a plain `time.sleep`, started
+like `main.py` does after its monkey patching:
+
+    python -m tests.slow_server 1
+
+Prints the port it listens on, then serves until it's terminated.
+"""
+# patch the standard library before anything else imports it, as in
+# production
+import main  # noqa: F401
+
+import sys
+import time
+from unittest.mock import patch
+
+from kubernetes_task_runner.app import create_app
+from kubernetes_task_runner.server import create_server
+
+from .base import TEST_CONFIG
+
+QUEUE_STATS_PATCH_PATH = 'kubernetes_task_runner.views.queue_stats'
+
+
+def run_slow_server(slow_call_seconds):
+    def slow_queue_stats(*args, **kwargs):
+        # cooperative only if the monkey patching took
+        time.sleep(slow_call_seconds)
+        return {}
+
+    server = create_server('127.0.0.1', 0, create_app(TEST_CONFIG), log=None)
+    server.start()
+    print(server.server_port, flush=True)
+    with patch(QUEUE_STATS_PATCH_PATH, side_effect=slow_queue_stats):
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    run_slow_server(float(sys.argv[1]))
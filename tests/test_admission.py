@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from kubernetes_task_runner.admission import (ADMISSION_LEASE,
+                                              ADMISSION_LEASE_SECONDS, Limits,
+                                              NO_LIMITS, admit_queued_jobs,
+                                              backfill_retry_at, queue_stats)
+from kubernetes_task_runner.cluster import NodeCapacity
+from kubernetes_task_runner.models import (DEFAULT_CLUSTER, BatchJob,
+                                           BatchJobStatus, Lease)
+from kubernetes_task_runner.tasks import dispatch_queued_jobs
+
+from .base import BaseTestCase
+from .utilities import create_cluster_manager_mock
+
+
+START_BATCH_JOB_PATCH_PATH = ('kubernetes_task_runner.tasks.start_batch_job.'
+                              'delay')
+CLUSTER_PATCH_PATH = ('kubernetes_task_runner.tasks.'
+                      'get_cluster_manager_instance')
+
+
+class AdmissionTestCase(BaseTestCase):
+    """
+    Test cases for the admission of queued batch jobs.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.start = datetime.utcnow() - timedelta(hours=1)
+        self.job_count = 0
+
+    def _job(self, owner, status=BatchJobStatus.QUEUED.value, cpu='1',
+             priority=0):
+        """ Create a job of `owner`, each one later than the previous. """
+        self.job_count += 1
+        with self.app.app_context():
+            return BatchJob(
+                owner=owner,
+                status=status,
+                created=self.start + timedelta(seconds=self.job_count),
+                job_parameters={
+                    'docker_image': 'python',
+                    'resources': {'requests': {'cpu': cpu}},
+                    'priority': priority,
+                },
+            ).save()
+
+    def _names(self, batch_jobs):
+        return [batch_job.name for batch_job in batch_jobs]
+
+    def test_admit_within_limits(self):
+        """ Should admit the oldest jobs fitting within the limits. """
+        first_job = self._job('reports')
+        second_job = self._job('reports')
+        third_job = self._job('reports')
+
+        admitted = admit_queued_jobs(Limits(None, 2, None))
+
+        self.assertEqual(self._names(admitted),
+                         self._names([first_job, second_job]))
+        third_job.reload()
+        self.assertEqual(third_job.status, BatchJobStatus.QUEUED.value)
+        for batch_job in admitted:
+            self.assertEqual(batch_job.status, BatchJobStatus.CREATED.value)
+
+    def test_fair_share(self):
+        """ Owners using less of the cluster should be admitted first. """
+        self._job('reports', status=BatchJobStatus.RUNNING.value)
+        first_report = self._job('reports')
+        self._job('reports')
+        first_export = self._job('exports')
+        self._job('exports')
+
+        admitted = admit_queued_jobs(Limits(3, None, None))
+
+        # exports had no share yet, then both have one job each and the
+        # oldest one goes first
+        self.assertEqual(self._names(admitted),
+                         self._names([first_export, first_report]))
+
+    def test_priority(self):
+        """ Higher priority jobs should be admitted first. """
+        self._job('reports')
+        urgent_report = self._job('reports', priority=10)
+        self._job('exports')
+        urgent_export = self._job('exports', priority=10)
+
+        admitted = admit_queued_jobs(Limits(2, None, None))
+
+        self.assertEqual(self._names(admitted),
+                         self._names([urgent_report, urgent_export]))
+
+    def test_retry_backoff(self):
+        """ Retries shouldn't be admitted before their backoff is over. """
+        retried_job = self._job('reports')
+        with self.app.app_context():
+            retried_job.modify(
+                set__retry_at=datetime.utcnow() + timedelta(minutes=1),
+            )
+        batch_job = self._job('reports')
+
+        admitted = admit_queued_jobs()
+
+        self.assertEqual(self._names(admitted), self._names([batch_job]))
+
+    def test_backfill_retry_at(self):
+        """
+        Jobs queued before every queued job had a `retry_at` should be
+        admitted once it's set.
+        """
+        batch_job = self._job('reports')
+        self.assertEqual(batch_job.retry_at, batch_job.created)
+        with self.app.app_context():
+            batch_job.update(unset__retry_at=True)
+
+        self.assertEqual(admit_queued_jobs(), [])
+        backfill_retry_at()
+        admitted = admit_queued_jobs()
+
+        self.assertEqual(self._names(admitted), self._names([batch_job]))
+
+    def test_owner_limits(self):
+        """ Should keep every owner within its own limits. """
+        self._job('reports', status=BatchJobStatus.RUNNING.value, cpu='2')
+        self._job('reports')
+        first_export = self._job('exports', cpu='2')
+        self._job('exports')
+
+        admitted = admit_queued_jobs(NO_LIMITS, Limits(None, 2, None))
+
+        self.assertEqual(self._names(admitted), self._names([first_export]))
+
+    def test_fail_jobs_exceeding_limits(self):
+        """ Jobs which can never be admitted should fail. """
+        batch_job = self._job('reports', cpu='4')
+
+        self.assertEqual(admit_queued_jobs(Limits(None, 2, None)), [])
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.FAILED.value)
+
+    def test_node_capacity(self):
+        """
+        Jobs should wait for room on a node, even if they don't fit on any
+        of the current ones.
+        """
+        node_capacity = NodeCapacity(allocatable={'node-0': (4, 2 ** 34),
+                                                  'node-1': (2, 2 ** 34)},
+                                     free={'node-0': (1, 2 ** 34),
+                                           'node-1': (2, 2 ** 34)})
+        fitting_job = self._job('reports', cpu='2')
+        waiting_job = self._job('reports', cpu='2')
+        huge_job = self._job('exports', cpu='8')
+
+        admitted = admit_queued_jobs(
+            node_capacities={DEFAULT_CLUSTER: node_capacity},
+        )
+
+        self.assertEqual(self._names(admitted), self._names([fitting_job]))
+        self.assertEqual(node_capacity.free['node-1'], (0, 2 ** 34))
+        waiting_job.reload()
+        self.assertEqual(waiting_job.status, BatchJobStatus.QUEUED.value)
+        huge_job.reload()
+        self.assertEqual(huge_job.status, BatchJobStatus.QUEUED.value)
+
+    def test_unavailable_clusters(self):
+        """ Jobs of unavailable clusters should stay queued. """
+        waiting_job = self._job('reports')
+        admitted_job = self._job('reports')
+        with self.app.app_context():
+            admitted_job.modify(set__cluster='eu')
+
+        admitted = admit_queued_jobs(unavailable_clusters={DEFAULT_CLUSTER})
+
+        self.assertEqual(self._names(admitted), self._names([admitted_job]))
+        waiting_job.reload()
+        self.assertEqual(waiting_job.status, BatchJobStatus.QUEUED.value)
+
+    def test_admission_lease(self):
+        """
+        Nothing should be admitted while another pass holds the lease, and
+        passes should release it.
+        """
+        batch_job = self._job('reports')
+        holder = Lease.acquire(ADMISSION_LEASE, ADMISSION_LEASE_SECONDS)
+
+        self.assertEqual(admit_queued_jobs(), [])
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.QUEUED.value)
+
+        Lease.release(ADMISSION_LEASE, holder)
+        self.assertEqual(self._names(admit_queued_jobs()),
+                         self._names([batch_job]))
+        self.assertEqual(Lease.objects.count(), 0)
+
+    def test_dispatch_queued_jobs(self):
+        """ Admitted jobs should be deployed by the `start_batch_job` task. """
+        self.app.config['ADMISSION_SETTINGS'] = {'max_running_jobs': 1}
+        batch_job = self._job('reports')
+        self._job('reports')
+
+        cluster_manager = create_cluster_manager_mock()
+        with patch(START_BATCH_JOB_PATCH_PATH) as start_batch_job:
+            with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+                with self.app.app_context():
+                    dispatch_queued_jobs()
+
+        start_batch_job.assert_called_once_with(str(batch_job.id))
+
+    def test_queue_stats(self):
+        """ Should report the queue per owner, by their share. """
+        self._job('reports', status=BatchJobStatus.RUNNING.value, cpu='2')
+        self._job('reports')
+        self._job('exports')
+
+        stats = queue_stats(Limits(None, 4, None))
+
+        self.assertEqual(stats['queued'], 2)
+        self.assertGreater(stats['oldest_wait_seconds'], 0)
+        self.assertEqual(stats['active']['cpu'], 2)
+        self.assertEqual([owner['owner'] for owner in stats['owners']],
+                         ['exports', 'reports'])
+        self.assertEqual(stats['owners'][1]['share'], 0.5)
@@ -1,20 +1,33 @@
 # -*- coding: utf-8 -*-
+import gzip
+import time
 from datetime import datetime
 from unittest.mock import Mock, patch
 
+from bson import ObjectId
+from kubernetes import client
 from kubernetes.client.rest import ApiException
 
-from kubernetes_task_runner.batch_jobs import (cluster_create_batch_job,
-                                               cluster_stop_batch_job)
-from kubernetes_task_runner.exceptions import ClusterError
-from kubernetes_task_runner.models import BatchJobStatus
+from kubernetes_task_runner.batch_jobs import (archive_job_logs,
+                                               cluster_create_batch_job,
+                                               cluster_stop_batch_job,
+                                               find_job_pod,
+                                               launch_cleaner_job,
+                                               wait_for_job_start)
+from kubernetes_task_runner.exceptions import (BackendUnavailable,
+                                               ClusterError, JobStartException)
+from kubernetes_task_runner.informer import ClusterCache
+from kubernetes_task_runner.models import (BatchJob, BatchJobStatus,
+                                           JobAttempt)
 
 from .base import BaseTestCase
-from .utilities import create_cluster_manager_mock, mock_job, mock_pod_list
+from .utilities import (create_cluster_manager_mock, mock_job, mock_pod,
+                        mock_pod_list, watch_event)
 
 CLUSTER_PATCH_PATH = ('kubernetes_task_runner.batch_jobs.'
                       'get_cluster_manager_instance')
 GCLOUD_PATCH_PATH = 'kubernetes_task_runner.batch_jobs.get_gcloud_client'
+GRIDFS_DELETE_PATCH_PATH = 'mongoengine.fields.GridFSProxy.delete'
 
 
 class BatchJobsTestCase(BaseTestCase):
@@ -60,6 +73,193 @@ class BatchJobsTestCase(BaseTestCase):
                          expected_start_time.isoformat())
         self.assertEqual(response, api_returned_job)
 
+    def test_creation_purges_input_file(self):
+        """ Uploaded input files should be removed from GridFS. """
+        batch_job = self.create_batch_job()
+        # mongomock has no GridFS, reference a stored file directly
+        BatchJob._get_collection().update_one(
+            {'_id': batch_job.id},
+            {'$set': {'job_parameters.input_zip': ObjectId()}},
+        )
+        batch_job.reload()
+        cluster_manager = create_cluster_manager_mock(
+            create_job=mock_job(name=batch_job.name),
+            get_job=mock_job(name=batch_job.name, active=1),
+            list_pods=mock_pod_list(['Running']),
+        )
+
+        with patch(GRIDFS_DELETE_PATCH_PATH) as delete:
+            self._create(batch_job, cluster_manager)
+
+        delete.assert_called_once_with()
+        batch_job.reload()
+        self.assertTrue(batch_job.input_uploaded)
+        self.assertTrue(batch_job.has_input_file)
+        self.assertIsNone(batch_job.input_file.grid_id)
+
+    def test_creation_watches_pod(self):
+        """
+        If the pod hasn't started yet, the batch_job should be marked as
+        started as soon as a watch event reports its pod running.
+        """
+        batch_job = self.create_batch_job()
+        pending_pods = mock_pod_list(['Pending'])
+        pod_name = pending_pods.items[0].metadata.name
+        cluster_manager = create_cluster_manager_mock(
+            create_job=mock_job(name=batch_job.name),
+            get_job=mock_job(name=batch_job.name, active=1),
+            list_pods=pending_pods,
+            watch_pods=[
+                watch_event('MODIFIED', mock_pod('Pending', name=pod_name)),
+                watch_event('MODIFIED', mock_pod('Running', name=pod_name)),
+            ],
+        )
+
+        self._create(batch_job, cluster_manager)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.RUNNING.value)
+        # pods were listed once and then watched from that version
+        cluster_manager.list_pods.assert_called_once_with(
+            label_selector=f'job-name={batch_job.name}', namespace=None,
+        )
+        self.assertEqual(
+            cluster_manager.watch_pods.call_args[1]['resource_version'],
+            pending_pods.metadata.resource_version,
+        )
+
+    def test_creation_reads_cache(self):
+        """
+        Once the cluster's cache is synced, the job and its pod should be
+        read from it instead of the API server.
+        """
+        batch_job = self.create_batch_job()
+        metadata = {'namespace': 'default', 'resource_version': '1'}
+        job = client.V1Job(
+            metadata=client.V1ObjectMeta(name=batch_job.name, **metadata),
+            status=client.V1JobStatus(active=1, start_time=datetime.utcnow()),
+        )
+        pod = client.V1Pod(
+            metadata=client.V1ObjectMeta(name=f'{batch_job.name}-x',
+                                         labels={'job-name': batch_job.name},
+                                         **metadata),
+            status=client.V1PodStatus(phase='Running'),
+        )
+        lists = {'job': client.V1JobList, 'pod': client.V1PodList}
+        cache = ClusterCache(Mock(
+            namespace='default',
+            list_managed=lambda api, kind: lists[kind](
+                items=[job if kind == 'job' else pod],
+                metadata=client.V1ListMeta(resource_version='1'),
+            ),
+            watch_managed=Mock(return_value=[watch_event('ERROR', {})]),
+        ))
+        cache.jobs.list_and_watch()
+        cache.pods.list_and_watch()
+        cluster_manager = create_cluster_manager_mock(
+            create_job=mock_job(name=batch_job.name), cache=cache,
+        )
+
+        response, _ = self._create(batch_job, cluster_manager)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.RUNNING.value)
+        self.assertIs(response, job)
+        cluster_manager.get_job.assert_not_called()
+        cluster_manager.list_pods.assert_not_called()
+        cluster_manager.watch_job.assert_not_called()
+        cluster_manager.watch_pods.assert_not_called()
+
+    def test_creation_priority_class(self):
+        """
+        Jobs should get the PriorityClass with the highest value not above
+        their priority.
+        """
+        self.app.config['PRIORITY_CLASSES'] = {'bulk': -10, 'urgent': 100}
+        batch_job = self.create_batch_job(job_parameters={
+            'docker_image': 'python',
+            'priority': 500,
+        })
+        cluster_manager = create_cluster_manager_mock(
+            create_job=mock_job(name=batch_job.name),
+            get_job=mock_job(name=batch_job.name, active=1),
+            list_pods=mock_pod_list(['Running']),
+        )
+
+        self._create(batch_job, cluster_manager)
+
+        job_config = cluster_manager.create_job.call_args[0][0]
+        self.assertEqual(job_config['spec']['template']['spec']
+                         ['priorityClassName'], 'urgent')
+
+    def test_creation_owner_references(self):
+        """
+        PVCs should be owned by the job, which the cluster deletes after
+        `JOB_TTL_SECONDS`.
+        """
+        self.app.config['JOB_TTL_SECONDS'] = 3600
+        batch_job = self.create_batch_job()
+        created_job = mock_job(name=batch_job.name)
+        created_job.metadata.uid = 'job-uid'
+        cluster_manager = create_cluster_manager_mock(
+            create_job=created_job,
+            get_job=mock_job(name=batch_job.name, active=1),
+            list_pods=mock_pod_list(['Running']),
+        )
+
+        self._create(batch_job, cluster_manager)
+
+        job_config = cluster_manager.create_job.call_args[0][0]
+        self.assertEqual(job_config['spec']['ttlSecondsAfterFinished'], 3600)
+        pvc_config = cluster_manager.create_pvc.call_args[0][0]
+        self.assertEqual(pvc_config['metadata']['ownerReferences'], [{
+            'apiVersion': 'batch/v1',
+            'kind': 'Job',
+            'name': batch_job.name,
+            'uid': 'job-uid',
+        }])
+        batch_job.reload()
+        self.assertTrue(batch_job.dependencies_owned)
+
+    def test_cleaner_job_owner(self):
+        """
+        Cleanup jobs should be owned by their job, unless the cluster deletes
+        it after `JOB_TTL_SECONDS`.
+        """
+        batch_job = self.create_batch_job()
+        owner = mock_job(name=batch_job.name)
+        owner.metadata.uid = 'job-uid'
+        cluster_manager = create_cluster_manager_mock()
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            with self.app.app_context():
+                launch_cleaner_job(batch_job, owner=owner)
+                self.app.config['JOB_TTL_SECONDS'] = 3600
+                launch_cleaner_job(batch_job, owner=owner)
+
+        owned_config, unowned_config = [
+            call[0][0] for call in cluster_manager.create_job.call_args_list
+        ]
+        self.assertEqual(owned_config['metadata']['ownerReferences'][0]['uid'],
+                         'job-uid')
+        self.assertNotIn('ownerReferences', unowned_config['metadata'])
+
+    def test_job_start_deadline(self):
+        """
+        If the job doesn't start before the deadline, throw an exception
+        with the last job response.
+        """
+        job = mock_job(active=None)
+        cluster_manager = create_cluster_manager_mock(get_job=job)
+
+        with self.assertRaises(JobStartException) as context:
+            wait_for_job_start(cluster_manager, job.metadata.name,
+                               deadline=time.monotonic())
+
+        self.assertEqual(context.exception.context,
+                         {'last_job_response': job.to_dict()})
+        self.assertEqual(cluster_manager.watch_job.call_count, 0)
+
     def test_job_fails_to_start(self):
         """
         If job fails to start, set its status to failed in the DB and throw an
@@ -93,19 +293,83 @@ class BatchJobsTestCase(BaseTestCase):
         batch_job.reload()
         self.assertEqual(batch_job.status, BatchJobStatus.FAILED.value)
 
+    def test_creation_waits_for_previous_attempt(self):
+        """
+        Retries should be queued again while their failed attempt's Job or
+        PVCs are still being deleted.
+        """
+        batch_job = self.create_batch_job(status=BatchJobStatus.CREATED.value)
+        batch_job.modify(push__attempts=JobAttempt(number=1))
+        cluster_manager = create_cluster_manager_mock(
+            get_job=None, get_pvc={'status': {'phase': 'Bound'}},
+        )
+
+        response, _ = self._create(batch_job, cluster_manager)
+
+        self.assertIsNone(response)
+        self.assertEqual(cluster_manager.create_job.call_count, 0)
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.QUEUED.value)
+        self.assertGreater(batch_job.retry_at, datetime.utcnow())
+
+    def test_creation_backend_unavailable(self):
+        """
+        Jobs should be queued again if the cluster is unavailable before
+        they're created, without counting an attempt.
+        """
+        batch_job = self.create_batch_job(status=BatchJobStatus.CREATED.value)
+        cluster_manager = create_cluster_manager_mock()
+        cluster_manager.create_job.side_effect = BackendUnavailable(
+            'Kubernetes API is unavailable.', retry_after=10,
+        )
+
+        with self.assertRaises(BackendUnavailable):
+            self._create(batch_job, cluster_manager)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.QUEUED.value)
+        self.assertGreater(batch_job.retry_at, datetime.utcnow())
+        self.assertEqual(batch_job.attempts, [])
+
+    def test_creation_dependencies_fail(self):
+        """
+        If creating the PVCs fails after the Job was created, delete the Job
+        along with the failed job.
+        """
+        batch_job = self.create_batch_job(status=BatchJobStatus.CREATED.value)
+        cluster_manager = create_cluster_manager_mock(
+            create_job=mock_job(name=batch_job.name),
+        )
+        cluster_manager.create_pvc.side_effect = ApiException(
+            'quota exceeded',
+        )
+
+        with self.assertRaises(ClusterError):
+            self._create(batch_job, cluster_manager)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.FAILED.value)
+        cluster_manager.delete_job.assert_called_once_with(
+            batch_job.name, ignore_404=True, namespace=batch_job.namespace,
+        )
+
     def test_stop_happy_path(self):
         """
         Should delete job from the cluster and set its status to killed in the
         DB.
         """
         batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        with self.app.app_context():
+            batch_job.modify(set__namespace='tenant-a')
         cluster_manager = create_cluster_manager_mock()
 
         self._stop(batch_job, cluster_manager)
 
         batch_job.reload()
         self.assertEqual(batch_job.status, BatchJobStatus.KILLED.value)
-        cluster_manager.delete_job.assert_called_once_with(batch_job.name)
+        cluster_manager.delete_job.assert_called_once_with(
+            batch_job.name, ignore_404=False, namespace='tenant-a',
+        )
 
     def test_stop_fail(self):
         """
@@ -122,3 +386,61 @@ class BatchJobsTestCase(BaseTestCase):
 
         batch_job.reload()
         self.assertEqual(batch_job.status, BatchJobStatus.KILLED.value)
+
+    def test_stop_backend_unavailable(self):
+        """ Jobs shouldn't be killed while their cluster is unavailable. """
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        cluster_manager = create_cluster_manager_mock()
+        cluster_manager.circuit_breaker.check.side_effect = (
+            BackendUnavailable('Kubernetes API is unavailable.')
+        )
+
+        with self.assertRaises(BackendUnavailable):
+            self._stop(batch_job, cluster_manager)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.RUNNING.value)
+        self.assertEqual(cluster_manager.delete_job.call_count, 0)
+
+    def test_archive_job_logs(self):
+        """ Should upload the pod's log to GCS gzipped. """
+        cluster_manager = create_cluster_manager_mock(
+            list_pods=mock_pod_list(['Failed']),
+        )
+        cluster_manager.stream_pod_log = Mock(
+            return_value=iter([b'starting\n', b'failed\n']),
+        )
+        uploaded = {}
+
+        def upload_file(file_obj, blob_name, **kwargs):
+            uploaded[blob_name] = gzip.decompress(file_obj.read())
+
+        gcs_client = Mock()
+        gcs_client.upload_file = Mock(side_effect=upload_file)
+        with patch(GCLOUD_PATCH_PATH, return_value=gcs_client):
+            archive_job_logs(cluster_manager, 'job-name')
+
+        self.assertEqual(uploaded, {
+            'job-name-logs.txt.gz': b'starting\nfailed\n',
+        })
+        self.assertEqual(gcs_client.upload_file.call_args[1],
+                         {'content_type': 'text/plain',
+                          'content_encoding': 'gzip'})
+
+    def test_find_job_pod_cache_miss(self):
+        """
+        Pods missing from the cluster's cache, e.g. unlabelled ones, should
+        be looked up on the cluster.
+        """
+        pod_list = mock_pod_list(['Running'])
+        cache = Mock(synced=True,
+                     list_pods=Mock(return_value=client.V1PodList(items=[])))
+        cluster_manager = create_cluster_manager_mock(list_pods=pod_list,
+                                                      cache=cache)
+
+        self.assertIs(find_job_pod(cluster_manager, 'job-name'),
+                      pod_list.items[0])
+        cache.list_pods.assert_called_once_with('job-name', None)
+        cluster_manager.list_pods.assert_called_once_with(
+            label_selector='job-name=job-name', namespace=None,
+        )
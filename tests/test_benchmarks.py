@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the hot paths of the API and the synchronization task.
+
+Skipped by default when running with `--benchmark-skip`. See the README for
+how to save and compare results.
+"""
+import base64
+import os
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+from dotmap import DotMap
+
+from kubernetes_task_runner.batch_jobs import build_config_from_template
+from kubernetes_task_runner.fields import KubernetesResourceField
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+from kubernetes_task_runner.serializers import (BatchJobSchema,
+                                                serialize_raw_batch_job)
+from kubernetes_task_runner.tasks import (synchronize_batch_jobs,
+                                          synchronize_job)
+from kubernetes_task_runner.util import decode_zip_file
+
+from .base import BaseTestCase
+from .utilities import create_cluster_manager_mock, mock_job
+
+
+CLUSTER_PATCH_PATH = ('kubernetes_task_runner.tasks.'
+                      'get_cluster_manager_instance')
+JOB_COUNTS = (1000, 10000)
+PAYLOAD_SIZES = (1024 ** 2, 16 * 1024 ** 2)  # 1MiB, 16MiB
+
+BatchJobSerializer = BatchJobSchema()
+
+
+def build_batch_jobs(count, status=BatchJobStatus.RUNNING.value):
+    """ Build `count` unsaved batch jobs. """
+    batch_jobs = []
+    for index in range(count):
+        batch_job = BatchJob(
+            name=f'benchmark-job-{index}',
+            status=status,
+            job_parameters={
+                'docker_image': 'python',
+                'environment_variables': {'INDEX': str(index)},
+                'resources': {'requests': {'cpu': '500m', 'memory': '128Mi'}},
+            },
+        )
+        batch_job.clean()
+        batch_jobs.append(batch_job)
+    return batch_jobs
+
+
+class BenchmarkTestCase(BaseTestCase):
+    """
+    Benchmarks for the functions on the hot paths.
+    """
+
+    @pytest.fixture(autouse=True)
+    def _setup_benchmark(self, benchmark):
+        self.benchmark = benchmark
+
+    def _benchmark_large(self, function, *args):
+        """ Run expensive benchmarks a single time. """
+        return self.benchmark.pedantic(function, args=args, rounds=1,
+                                       iterations=1)
+
+    def _synchronize_job(self, count):
+        pairs = [
+            (DotMap({'status': status}), mock_job(succeeded=1))
+            for status in [BatchJobStatus.RUNNING.value,
+                           BatchJobStatus.FAILED.value,
+                           BatchJobStatus.KILLED.value,
+                           BatchJobStatus.SUCCEEDED.value] * (count // 4)
+        ]
+        self.benchmark.group = 'synchronize_job'
+        self.benchmark(lambda: [synchronize_job(local_job, cluster_job)
+                                for local_job, cluster_job in pairs])
+
+    def test_synchronize_job_1k(self):
+        self._synchronize_job(JOB_COUNTS[0])
+
+    def test_synchronize_job_10k(self):
+        self._synchronize_job(JOB_COUNTS[1])
+
+    def _synchronize_batch_jobs(self, count):
+        """ Synchronize `count` running jobs which need no action. """
+        batch_jobs = build_batch_jobs(count)
+        BatchJob.objects.insert(batch_jobs, load_bulk=False)
+        cluster_manager = create_cluster_manager_mock(list_managed_jobs={
+            'default': [mock_job(name=batch_job.name, active=1)
+                        for batch_job in batch_jobs],
+        })
+        self.benchmark.group = 'synchronize_batch_jobs'
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            with self.app.app_context():
+                self._benchmark_large(synchronize_batch_jobs)
+
+    def test_synchronize_batch_jobs_1k(self):
+        self._synchronize_batch_jobs(JOB_COUNTS[0])
+
+    def test_synchronize_batch_jobs_10k(self):
+        self._synchronize_batch_jobs(JOB_COUNTS[1])
+
+    def _build_config_from_template(self, template_name, context):
+        self.benchmark.group = 'build_config_from_template'
+        with self.app.app_context():
+            self.benchmark(build_config_from_template, template_name, context)
+
+    def test_build_job_config(self):
+        batch_job = build_batch_jobs(1)[0]
+        self._build_config_from_template('job.yaml.j2', {
+            'backoff_limit': 0,
+            'bucket_name': 'bucket_name',
+            'job': batch_job,
+        })
+
+    def test_build_cleanup_job_config(self):
+        batch_job = build_batch_jobs(1)[0]
+        self._build_config_from_template('cleanup_job.yaml.j2', {
+            'backoff_limit': 0,
+            'bucket_name': 'bucket_name',
+            'job': batch_job,
+        })
+
+    def test_build_pvc_config(self):
+        self._build_config_from_template('pvc.yaml.j2', {
+            'name': f'job-{uuid4()}-output',
+            'storage_size': '100Gi',
+        })
+
+    def _dump_batch_jobs(self, count):
+        batch_jobs = build_batch_jobs(count)
+        self.benchmark.group = 'BatchJobSchema.dump'
+        self._benchmark_large(BatchJobSerializer.dump, batch_jobs, True)
+
+    def test_dump_batch_jobs_1k(self):
+        self._dump_batch_jobs(JOB_COUNTS[0])
+
+    def test_dump_batch_jobs_10k(self):
+        self._dump_batch_jobs(JOB_COUNTS[1])
+
+    def _list_batch_jobs(self, count, serialize):
+        """ Query and serialize `count` saved jobs as the API lists them. """
+        BatchJob.objects.insert(build_batch_jobs(count), load_bulk=False)
+        self.benchmark.group = f'list_batch_jobs_{count}'
+        with self.app.app_context():
+            self._benchmark_large(serialize)
+
+    def test_list_batch_jobs_schema_1k(self):
+        self._list_batch_jobs(JOB_COUNTS[0], lambda: BatchJobSerializer.dump(
+            BatchJob.objects, many=True,
+        ))
+
+    def test_list_batch_jobs_raw_1k(self):
+        self._list_batch_jobs(JOB_COUNTS[0], lambda: [
+            serialize_raw_batch_job(document)
+            for document in BatchJob.objects.as_pymongo()
+        ])
+
+    def test_list_batch_jobs_schema_10k(self):
+        self._list_batch_jobs(JOB_COUNTS[1], lambda: BatchJobSerializer.dump(
+            BatchJob.objects, many=True,
+        ))
+
+    def test_list_batch_jobs_raw_10k(self):
+        self._list_batch_jobs(JOB_COUNTS[1], lambda: [
+            serialize_raw_batch_job(document)
+            for document in BatchJob.objects.as_pymongo()
+        ])
+
+    def _decode_zip_file(self, size):
+        payload = base64.encodebytes(os.urandom(size)).decode('ascii')
+        self.benchmark.group = 'decode_zip_file'
+        self.benchmark(decode_zip_file, payload)
+
+    def test_decode_zip_file_1mib(self):
+        self._decode_zip_file(PAYLOAD_SIZES[0])
+
+    def test_decode_zip_file_16mib(self):
+        self._decode_zip_file(PAYLOAD_SIZES[1])
+
+    def test_validate_resources(self):
+        field = KubernetesResourceField()
+        resources = {
+            'limits': {'cpu': '500m', 'memory': '128Mi'},
+            'requests': {'cpu': '250m', 'memory': '64Mi'},
+        }
+        self.benchmark.group = 'KubernetesResourceField.validate'
+        self.benchmark(field.validate, resources)
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+import time
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from dotmap import DotMap
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from kubernetes_task_runner.cluster import (MAX_THROTTLED_RETRIES,
+                                            RUNNER_LABEL_SELECTOR,
+                                            ClusterManager, NodeCapacity)
+from kubernetes_task_runner.exceptions import BackendUnavailable
+from kubernetes_task_runner.ratelimit import Lane
+from kubernetes_task_runner.resilience import MAX_RETRIES
+
+from .base import BaseTestCase
+
+
+SLEEP_PATCH_PATH = 'kubernetes_task_runner.cluster.time.sleep'
+WATCH_PATCH_PATH = 'kubernetes_task_runner.cluster.watch.Watch'
+
+
+def throttled(retry_after=None):
+    exception = ApiException(status=429, reason='Too Many Requests')
+    exception.headers = {'Retry-After': retry_after} if retry_after else {}
+    return exception
+
+
+def connection_refused():
+    return MaxRetryError(None, '/apis/batch/v1/jobs',
+                         reason=NewConnectionError(None, 'refused'))
+
+
+def mock_node(name, cpu, memory, unschedulable=None):
+    return DotMap({
+        'metadata': {'name': name},
+        'spec': {'unschedulable': unschedulable},
+        'status': {'allocatable': {'cpu': cpu, 'memory': memory,
+                                   'pods': '110'}},
+    })
+
+
+def mock_pod(node_name, *requests, init_requests=()):
+    def containers(all_requests):
+        return [DotMap({'resources': {'requests': container_requests}})
+                for container_requests in all_requests]
+    return DotMap({'spec': {
+        'node_name': node_name,
+        'containers': containers(requests),
+        'init_containers': containers(init_requests),
+    }})
+
+
+class NodeCapacityTestCase(BaseTestCase):
+    """
+    Test cases for the cached capacity of the cluster's nodes.
+    """
+
+    def test_from_cluster(self):
+        """ Should subtract the active pods' requests from each node. """
+        nodes = [mock_node('node-0', '4', '16Gi'),
+                 mock_node('node-1', '8', '32Gi', unschedulable=True)]
+        pods = [
+            mock_pod('node-0', {'cpu': '500m', 'memory': '1Gi'},
+                     {'cpu': '1'}, init_requests=[{'memory': '4Gi'}]),
+            # not scheduled yet
+            mock_pod(None, {'cpu': '2'}),
+        ]
+
+        node_capacity = NodeCapacity.from_cluster(nodes, pods)
+
+        self.assertEqual(node_capacity.allocatable,
+                         {'node-0': (4, 16 * 2 ** 30)})
+        self.assertEqual(node_capacity.free,
+                         {'node-0': (2.5, 12 * 2 ** 30)})
+        self.assertTrue(node_capacity.fits_any_node(4, 2 ** 30))
+        self.assertIsNone(node_capacity.find_node(4, 2 ** 30))
+
+    def test_node_capacity_cache(self):
+        """ Should only list the nodes again once the cache is stale. """
+        cluster_manager = ClusterManager(host='localhost')
+        api_call = Mock(side_effect=lambda endpoint, **kwargs: SimpleNamespace(
+            items=([mock_node('node-0', '4', '16Gi')]
+                   if endpoint == 'list_node' else []),
+        ))
+
+        with patch.object(cluster_manager, 'api_call', api_call):
+            self.assertIsNone(cluster_manager.node_capacity(refresh=False))
+            node_capacity = cluster_manager.node_capacity(max_age=60)
+            self.assertIs(cluster_manager.node_capacity(max_age=60),
+                          node_capacity)
+            self.assertEqual(api_call.call_count, 2)
+            # only the pods taking room on a node
+            api_call.assert_called_with(
+                client=cluster_manager.core_v1,
+                endpoint='list_pod_for_all_namespaces', namespaced=False,
+                field_selector=('spec.nodeName!=,status.phase!=Succeeded,'
+                                'status.phase!=Failed'),
+            )
+
+            node_capacity.refreshed_at = time.monotonic() - 61
+            cluster_manager.node_capacity(max_age=60)
+            self.assertEqual(api_call.call_count, 4)
+
+
+class ClusterManagerTestCase(BaseTestCase):
+    """
+    Test cases for the cluster manager's namespaces.
+    """
+
+    def _job(self, name, namespace):
+        return SimpleNamespace(
+            metadata=SimpleNamespace(name=name, namespace=namespace),
+        )
+
+    def test_list_managed_jobs(self):
+        """
+        Should list the labelled jobs of every namespace at once and group
+        the ones in the managed namespaces.
+        """
+        cluster_manager = ClusterManager(host='localhost', namespace='jobs',
+                                         namespaces=['tenant-a', 'jobs'])
+        jobs = [self._job('job-0', 'jobs'), self._job('job-1', 'tenant-a'),
+                self._job('job-2', 'jobs'), self._job('job-3', 'unmanaged')]
+        api_call = Mock(return_value=SimpleNamespace(items=jobs))
+
+        with patch.object(cluster_manager, 'api_call', api_call):
+            managed_jobs = cluster_manager.list_managed_jobs()
+
+        self.assertEqual(cluster_manager.namespaces, ['jobs', 'tenant-a'])
+        self.assertEqual(managed_jobs, {'jobs': [jobs[0], jobs[2]],
+                                        'tenant-a': [jobs[1]]})
+        api_call.assert_called_once_with(
+            client=cluster_manager.batch_v1,
+            endpoint='list_job_for_all_namespaces', namespaced=False,
+            label_selector=RUNNER_LABEL_SELECTOR,
+        )
+
+    def test_list_managed_jobs_from_cache(self):
+        """ Should read the jobs from the cache once it's synced. """
+        cluster_manager = ClusterManager(host='localhost', namespace='jobs')
+        jobs = [self._job('job-0', 'jobs'), self._job('job-1', 'unmanaged')]
+        cluster_manager.cache.jobs.list = Mock(return_value=jobs)
+        cluster_manager.cache.jobs.synced = True
+        cluster_manager.cache.pods.synced = True
+        api_call = Mock()
+
+        with patch.object(cluster_manager, 'api_call', api_call):
+            managed_jobs = cluster_manager.list_managed_jobs()
+
+        self.assertEqual(managed_jobs, {'jobs': [jobs[0]]})
+        api_call.assert_not_called()
+
+
+class ThrottlingTestCase(BaseTestCase):
+    """
+    Test cases for the rate limiting of the cluster manager's API calls.
+    """
+
+    def test_retry_throttled_call(self):
+        """ Should retry calls throttled by the API server after a while. """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.create_namespaced_job.side_effect = [
+            throttled('2'), throttled(), 'job',
+        ]
+
+        with patch(SLEEP_PATCH_PATH) as sleep:
+            response = cluster_manager.api_call(
+                client=client, endpoint='create_namespaced_job', body={},
+            )
+
+        self.assertEqual(response, 'job')
+        self.assertEqual(client.create_namespaced_job.call_count, 3)
+        self.assertEqual([call[0][0] for call in sleep.call_args_list],
+                         [2, 1])
+
+    def test_give_up_throttled_call(self):
+        """ Should raise once the call was throttled too many times. """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.create_namespaced_job.side_effect = throttled('1')
+
+        with patch(SLEEP_PATCH_PATH) as sleep:
+            with self.assertRaises(ApiException):
+                cluster_manager.api_call(client=client,
+                                         endpoint='create_namespaced_job',
+                                         body={})
+
+        self.assertEqual(client.create_namespaced_job.call_count,
+                         MAX_THROTTLED_RETRIES + 1)
+        self.assertEqual(sleep.call_count, MAX_THROTTLED_RETRIES)
+
+    def test_rate_limiter_lanes(self):
+        """ Should take a token in the lane of each call first. """
+        cluster_manager = ClusterManager(host='localhost', qps=10, burst=20)
+        client = Mock()
+
+        with patch.object(cluster_manager._rate_limiter, 'acquire',
+                          return_value=0) as acquire:
+            cluster_manager.api_call(client=client,
+                                     endpoint='list_namespaced_job')
+            cluster_manager.api_call(client=client,
+                                     endpoint='create_namespaced_job')
+            cluster_manager.api_call(client=client,
+                                     endpoint='create_namespaced_job',
+                                     lane=Lane.READ)
+
+        self.assertEqual([call[0][0] for call in acquire.call_args_list],
+                         [Lane.READ, Lane.BULK, Lane.READ])
+        self.assertIsNone(ClusterManager(host='localhost', qps=0)
+                          ._rate_limiter)
+
+
+class RetriesTestCase(BaseTestCase):
+    """
+    Test cases for the retries and circuit breaker of the API calls.
+    """
+
+    def test_retry_idempotent_call(self):
+        """ Should retry reads failing with 5xx responses. """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.read_namespaced_job.side_effect = [
+            ApiException(status=500), ApiException(status=503), 'job',
+        ]
+
+        with patch(SLEEP_PATCH_PATH) as sleep:
+            response = cluster_manager.api_call(
+                client=client, endpoint='read_namespaced_job', name='job',
+            )
+
+        self.assertEqual(response, 'job')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(cluster_manager.circuit_breaker.failures, 0)
+
+    def test_dont_retry_sent_creation(self):
+        """
+        Creations which may have reached the API server shouldn't be
+        repeated, unlike the ones which couldn't connect.
+        """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.create_namespaced_job.side_effect = [
+            connection_refused(), ApiException(status=500), 'job',
+        ]
+
+        with patch(SLEEP_PATCH_PATH):
+            with self.assertRaises(ApiException):
+                cluster_manager.api_call(client=client,
+                                         endpoint='create_namespaced_job',
+                                         body={})
+
+        self.assertEqual(client.create_namespaced_job.call_count, 2)
+
+    def test_retried_deletion_went_through(self):
+        """ Deletions retried after going through should succeed. """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.delete_namespaced_job.side_effect = [
+            ApiException(status=503), ApiException(status=404),
+        ]
+
+        with patch(SLEEP_PATCH_PATH):
+            response = cluster_manager.api_call(
+                client=client, endpoint='delete_namespaced_job', name='job',
+            )
+
+        self.assertIsNone(response)
+        self.assertEqual(client.delete_namespaced_job.call_count, 2)
+
+    def test_watch_failure(self):
+        """ Failed watches should count towards opening the breaker. """
+        cluster_manager = ClusterManager(host='localhost')
+
+        def stream(*args, **kwargs):
+            yield {'type': 'ADDED', 'object': 'job'}
+            raise ApiException(status=500)
+
+        with patch(WATCH_PATCH_PATH) as watch:
+            watch.return_value.stream = Mock(side_effect=stream)
+            events = cluster_manager.watch_call(
+                client=Mock(), endpoint='list_namespaced_job',
+                timeout_seconds=10,
+            )
+            with self.assertRaises(ApiException):
+                list(events)
+
+        self.assertEqual(cluster_manager.circuit_breaker.failures, 1)
+
+    def test_give_up_failing_call(self):
+        """ Should raise the last error once out of retries. """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.list_namespaced_job.side_effect = connection_refused()
+
+        with patch(SLEEP_PATCH_PATH):
+            with self.assertRaises(MaxRetryError):
+                cluster_manager.api_call(client=client,
+                                         endpoint='list_namespaced_job')
+
+        self.assertEqual(client.list_namespaced_job.call_count,
+                         MAX_RETRIES + 1)
+
+    def test_fail_fast_while_unavailable(self):
+        """ Shouldn't call the API server while the breaker is open. """
+        cluster_manager = ClusterManager(host='localhost')
+        client = Mock()
+        client.list_namespaced_job.side_effect = ApiException(status=500)
+
+        with patch(SLEEP_PATCH_PATH), patch('threading.Thread'):
+            with self.assertRaises(BackendUnavailable):
+                for _ in range(2):
+                    try:
+                        cluster_manager.api_call(
+                            client=client, endpoint='list_namespaced_job',
+                        )
+                    except ApiException:
+                        pass
+
+        threshold = cluster_manager.circuit_breaker.failure_threshold
+        self.assertTrue(cluster_manager.circuit_breaker.is_open)
+        self.assertEqual(client.list_namespaced_job.call_count, threshold)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import json
+from uuid import uuid4
+
+from kubernetes_task_runner.events import Broadcaster, broadcaster
+from kubernetes_task_runner.models import BatchJobStatus
+
+from .base import BaseTestCase
+
+
+def parse_server_sent_event(chunk):
+    """ Parse a server-sent event into a dict of its fields. """
+    if isinstance(chunk, bytes):
+        chunk = chunk.decode('utf-8')
+    fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+    fields['data'] = json.loads(fields['data'])
+    return fields
+
+
+class EventsTestCase(BaseTestCase):
+    """
+    Test cases for the batch job status change event streams.
+    """
+
+    def _first_event(self, url, last_event_id):
+        response = self.client.get(url, buffered=False,
+                                   headers={'Last-Event-ID': last_event_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        try:
+            return parse_server_sent_event(next(iter(response.response)))
+        finally:
+            response.close()
+
+    def test_job_events_resume(self):
+        """ Should replay the job's status changes after the last event. """
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        last_event_id = broadcaster.last_event_id
+        with self.app.app_context():
+            batch_job.set_cleaning()
+
+        event = self._first_event(f'/batch/{batch_job.id}/events',
+                                  last_event_id)
+
+        self.assertEqual(event['id'], str(int(last_event_id) + 1))
+        self.assertEqual(event['event'], 'status')
+        self.assertEqual(event['data']['id'], str(batch_job.id))
+        self.assertEqual(event['data']['status'],
+                         BatchJobStatus.CLEANING.value)
+
+    def test_events_filtered_by_status(self):
+        """ Should only stream the changes to the requested statuses. """
+        cleaning_job = self.create_batch_job(
+            status=BatchJobStatus.RUNNING.value,
+        )
+        failed_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        last_event_id = broadcaster.last_event_id
+        with self.app.app_context():
+            cleaning_job.set_cleaning()
+            failed_job.set_failed()
+
+        event = self._first_event('/batch/events?status=failed',
+                                  last_event_id)
+
+        self.assertEqual(event['data']['id'], str(failed_job.id))
+        self.assertEqual(event['data']['status'], BatchJobStatus.FAILED.value)
+
+    def test_job_events_404(self):
+        response = self.client.get(f'/batch/{uuid4()}/events')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.data)['error'], 'DoesNotExist')
+
+    def test_events_invalid_parameters(self):
+        response = self.client.get('/batch/events?status=unknown')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/batch/events',
+                                   headers={'Last-Event-ID': 'unknown'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_broadcaster_heartbeat(self):
+        """ Streams should yield None while there are no events. """
+        events = Broadcaster().subscribe(heartbeat=0)
+        self.assertIsNone(next(events))
+        events.close()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+
+from .base import BaseTestCase
+from .fake_cluster import FakeClock, FakeClusterManager
+from .load_test import run_simulation
+
+
+class FakeClusterTestCase(BaseTestCase):
+    """
+    End-to-end test cases running the whole job life cycle against the fake
+    cluster.
+    """
+
+    def _simulate(self, job_count=5, **cluster_settings):
+        cluster_manager = FakeClusterManager(clock=FakeClock(), seed=0,
+                                             **cluster_settings)
+        report = run_simulation(self.app, cluster_manager, job_count,
+                                max_cycles=50)
+        return cluster_manager, report
+
+    def test_jobs_succeed(self):
+        """ Jobs should be cleaned up and removed from the cluster. """
+        cluster_manager, report = self._simulate()
+
+        self.assertEqual(report['terminal_jobs'], 5)
+        self.assertEqual(report['statuses'],
+                         {BatchJobStatus.SUCCEEDED.value: 5})
+        for batch_job in BatchJob.objects:
+            self.assertIsNotNone(batch_job.output_file_url)
+        # jobs, cleanup jobs and PVCs were deleted
+        self.assertEqual(cluster_manager.jobs, {})
+        self.assertEqual(cluster_manager.pvcs, {})
+
+    def test_jobs_fail(self):
+        """ Jobs failing on the cluster should be marked as failed. """
+        cluster_manager, report = self._simulate(failure_rate=1)
+
+        self.assertEqual(report['statuses'],
+                         {BatchJobStatus.FAILED.value: 5})
+        self.assertEqual(cluster_manager.jobs, {})
+
+    def test_capacity(self):
+        """ Jobs waiting on a full cluster should still finish. """
+        cluster_manager, report = self._simulate(job_count=4, capacity=2,
+                                                 run_duration=(20, 20))
+
+        self.assertEqual(report['statuses'],
+                         {BatchJobStatus.SUCCEEDED.value: 4})
+        self.assertIsNotNone(report['time_to_terminal_seconds']['p99'])
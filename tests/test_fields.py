@@ -58,3 +58,11 @@ class TestKubernetesResourceField(BaseTestCase):
         }
         with self.assertRaisesRegex(ValidationError, 'extra_resource'):
             self.TestDoc(resources=input_resources).save()
+
+    def test_invalid_quantity(self):
+        """ Raises an exception when a quantity can't be parsed. """
+        input_resources = {
+            'requests': {'cpu': '500m', 'memory': 'a lot'},
+        }
+        with self.assertRaisesRegex(ValidationError, 'a lot'):
+            self.TestDoc(resources=input_resources).save()
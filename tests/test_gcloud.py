@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import io
+from unittest.mock import Mock, patch
+
+from google.api_core.exceptions import Forbidden, ServiceUnavailable
+from requests.exceptions import ConnectionError
+
+from kubernetes_task_runner import gcloud
+from kubernetes_task_runner.exceptions import StorageException
+from kubernetes_task_runner.gcloud import GCSClient
+
+from .base import BaseTestCase
+
+LOAD_BUCKET_PATCH_PATH = 'kubernetes_task_runner.gcloud.load_bucket'
+SLEEP_PATCH_PATH = 'kubernetes_task_runner.gcloud.time.sleep'
+
+
+class GCSClientTestCase(BaseTestCase):
+    """
+    Test cases for the retries of the GCS operations.
+    """
+
+    def setUp(self):
+        super().setUp()
+        gcloud._circuit_breakers.clear()
+        self.bucket = Mock()
+        with patch(LOAD_BUCKET_PATCH_PATH, return_value=self.bucket):
+            self.gcs_client = GCSClient('credentials.json', 'bucket')
+
+    def test_retry_upload(self):
+        """ Should upload the whole file again after failures. """
+        blob = self.bucket.blob.return_value
+        uploaded = []
+
+        def upload_from_file(file_obj, content_type=None):
+            uploaded.append(file_obj.read())
+            if len(uploaded) < 3:
+                raise (ConnectionError('reset') if len(uploaded) == 1
+                       else ServiceUnavailable('down'))
+
+        blob.upload_from_file.side_effect = upload_from_file
+        file_obj = io.BytesIO(b'header:data')
+        file_obj.seek(len(b'header:'))
+
+        with patch(SLEEP_PATCH_PATH) as sleep:
+            self.gcs_client.upload_file(file_obj, 'archive.gz')
+
+        self.assertEqual(uploaded, [b'data'] * 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_dont_retry_refused(self):
+        """ Errors other than failures shouldn't be retried. """
+        self.bucket.get_blob.side_effect = Forbidden('denied')
+
+        with patch(SLEEP_PATCH_PATH) as sleep:
+            with self.assertRaises(StorageException):
+                self.gcs_client.get_output_file_url('output.zip')
+
+        self.assertEqual(self.bucket.get_blob.call_count, 1)
+        self.assertEqual(sleep.call_count, 0)
+        self.assertEqual(self.gcs_client.circuit_breaker.failures, 0)
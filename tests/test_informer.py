@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+import time
+from unittest.mock import Mock
+
+from kubernetes import client
+
+from kubernetes_task_runner.informer import ClusterCache, Informer
+
+from .base import BaseTestCase
+
+
+def make_pod(name, job_name, phase='Pending', resource_version='1',
+             namespace='default'):
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, namespace=namespace,
+                                     labels={'job-name': job_name},
+                                     resource_version=resource_version),
+        status=client.V1PodStatus(phase=phase),
+    )
+
+
+def make_pod_list(pods, resource_version='1'):
+    return client.V1PodList(
+        items=pods,
+        metadata=client.V1ListMeta(resource_version=resource_version),
+    )
+
+
+def watch_error():
+    return {'type': 'ERROR', 'object': {'code': 410}}
+
+
+class InformerTestCase(BaseTestCase):
+    """
+    Test cases for the informers' stores.
+    """
+
+    def _pod_informer(self, pod_list, watches):
+        watched = []
+
+        def watch_objects(resource_version, timeout_seconds):
+            watched.append(resource_version)
+            return watches.pop(0)
+
+        informer = Informer(
+            'pods', list_objects=Mock(return_value=pod_list),
+            watch_objects=watch_objects,
+            index_key=lambda pod: pod.metadata.labels['job-name'],
+        )
+        return informer, watched
+
+    def test_list_and_watch(self):
+        """
+        Should apply every event to the store and its index, and stop
+        watching on errors.
+        """
+        informer, watched = self._pod_informer(
+            make_pod_list([make_pod('pod-1', 'job-1'),
+                           make_pod('pod-2', 'job-2')], '10'),
+            [
+                # an expired watch is started again where it was
+                [{'type': 'MODIFIED',
+                  'object': make_pod('pod-1', 'job-1', 'Running', '11')}],
+                [{'type': 'DELETED', 'object': make_pod('pod-2', 'job-2')},
+                 {'type': 'ADDED',
+                  'object': make_pod('pod-3', 'job-1', resource_version='12')},
+                 watch_error()],
+            ],
+        )
+
+        informer.list_and_watch()
+
+        self.assertTrue(informer.synced)
+        self.assertEqual(watched, ['10', '11'])
+        self.assertEqual(sorted(pod.metadata.name for pod in informer.list()),
+                         ['pod-1', 'pod-3'])
+        self.assertEqual(informer.get('default', 'pod-1').status.phase,
+                         'Running')
+        self.assertEqual(
+            sorted(pod.metadata.name for pod in informer.by_index('job-1')),
+            ['pod-1', 'pod-3'],
+        )
+        self.assertEqual(informer.by_index('job-2'), [])
+
+    def test_relist_replaces_store(self):
+        """ Objects deleted while not watching should be gone on relists. """
+        informer, _ = self._pod_informer(
+            make_pod_list([make_pod('pod-1', 'job-1')]),
+            [[watch_error()], [watch_error()]],
+        )
+        informer.list_and_watch()
+        informer._list_objects.return_value = make_pod_list([])
+        informer.list_and_watch()
+
+        self.assertEqual(informer.list(), [])
+        self.assertEqual(informer.by_index('job-1'), [])
+
+    def test_follow(self):
+        """ Should read the store again after every change. """
+        events = queue.Queue()
+        informer, _ = self._pod_informer(
+            make_pod_list([make_pod('pod-1', 'job-1')]),
+            [iter(events.get, None)],
+        )
+        watcher = threading.Thread(target=informer.list_and_watch,
+                                   daemon=True)
+        watcher.start()
+        while not informer.synced:
+            time.sleep(0.01)
+
+        phases = []
+        for pod in informer.follow(lambda: informer.get('default', 'pod-1'),
+                                   deadline=time.monotonic() + 5):
+            phases.append(pod.status.phase)
+            if pod.status.phase == 'Running':
+                break
+            events.put({'type': 'MODIFIED',
+                        'object': make_pod('pod-1', 'job-1', 'Running')})
+        events.put(watch_error())
+        watcher.join(timeout=5)
+
+        self.assertEqual(phases, ['Pending', 'Running'])
+
+    def test_follow_until_deadline(self):
+        """ Should stop following at the deadline. """
+        informer, _ = self._pod_informer(make_pod_list([]), [])
+
+        reads = list(informer.follow(lambda: None,
+                                     deadline=time.monotonic() + 0.05))
+
+        self.assertEqual(reads, [None, None])
+
+
+class ClusterCacheTestCase(BaseTestCase):
+    """
+    Test cases for the caches of the clusters' jobs and pods.
+    """
+
+    def test_lookups(self):
+        """ Should look jobs and pods up by job name and namespace. """
+        cluster_manager = Mock(namespace='default')
+        job = client.V1Job(metadata=client.V1ObjectMeta(
+            name='job-1', namespace='default', resource_version='1',
+        ))
+        job_list = client.V1JobList(
+            items=[job], metadata=client.V1ListMeta(resource_version='1'),
+        )
+        pod_list = make_pod_list([
+            make_pod('pod-1', 'job-1'),
+            make_pod('pod-2', 'job-1', namespace='other'),
+            make_pod('pod-3', 'job-2'),
+        ])
+        cluster_manager.list_managed.side_effect = (
+            lambda api, kind: job_list if kind == 'job' else pod_list
+        )
+        cluster_manager.watch_managed.return_value = [watch_error()]
+        cache = ClusterCache(cluster_manager)
+        self.assertFalse(cache.synced)
+
+        cache.jobs.list_and_watch()
+        cache.pods.list_and_watch()
+
+        self.assertTrue(cache.synced)
+        self.assertIs(cache.get_job('job-1'), job)
+        self.assertIsNone(cache.get_job('job-1', namespace='other'))
+        self.assertEqual(
+            [pod.metadata.name for pod in cache.list_pods('job-1').items],
+            ['pod-1'],
+        )
+        self.assertEqual(
+            [pod.metadata.name
+             for pod in cache.list_pods('job-1', 'other').items],
+            ['pod-2'],
+        )
+        self.assertEqual(cache.list_pods('job-3').items, [])
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from prometheus_client import REGISTRY, Histogram
+
+from kubernetes_task_runner.metrics import observe_latency
+from kubernetes_task_runner.models import BatchJobStatus
+
+from .base import BaseTestCase
+
+
+TEST_HISTOGRAM = Histogram('ktr_test_duration_seconds', 'Test histogram.',
+                           ['operation', 'status'])
+
+
+class MetricsTestCase(BaseTestCase):
+    """
+    Test cases for Prometheus instrumentation.
+    """
+
+    def test_metrics_endpoint(self):
+        """ Should expose job counts per status in the Prometheus format. """
+        self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode('utf-8')
+        self.assertIn('ktr_batch_jobs{status="running"} 2.0', body)
+        self.assertIn('ktr_batch_jobs{status="failed"} 0.0', body)
+        self.assertIn('ktr_http_request_duration_seconds', body)
+
+    def test_observe_latency_labels(self):
+        """ Unset labels should reflect whether the block raised. """
+        with observe_latency(TEST_HISTOGRAM, outcome_label='status',
+                             operation='fine'):
+            pass
+        with self.assertRaises(ValueError):
+            with observe_latency(TEST_HISTOGRAM, outcome_label='status',
+                                 operation='broken'):
+                raise ValueError()
+
+        sample_name = 'ktr_test_duration_seconds_count'
+        self.assertEqual(REGISTRY.get_sample_value(
+            sample_name, {'operation': 'fine', 'status': 'ok'},
+        ), 1)
+        self.assertEqual(REGISTRY.get_sample_value(
+            sample_name, {'operation': 'broken', 'status': 'error'},
+        ), 1)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from kubernetes_task_runner.exceptions import InvalidTransitionError
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+
+from .base import BaseTestCase
+
+
+class BatchJobTestCase(BaseTestCase):
+    """
+    Test cases for the BatchJob model.
+    """
+
+    def test_initial_transition(self):
+        """ A new job should record its initial status as a transition. """
+        batch_job = self.create_batch_job()
+        self.assertEqual(len(batch_job.status_transitions), 1)
+        transition = batch_job.status_transitions[0]
+        self.assertEqual(transition.status, BatchJobStatus.CREATED.value)
+        self.assertEqual(transition.timestamp, batch_job.created)
+
+    def test_set_status_records_transition(self):
+        """ Every status change should be appended to the history. """
+        batch_job = self.create_batch_job()
+        cluster_timestamp = datetime.utcnow().replace(microsecond=0)
+
+        with self.app.app_context():
+            batch_job.set_running(cluster_timestamp=cluster_timestamp)
+            batch_job.set_cleaning()
+
+        self.assertEqual(batch_job.status, BatchJobStatus.CLEANING.value)
+        self.assertEqual(
+            [transition.status for transition in batch_job.status_transitions],
+            [BatchJobStatus.CREATED.value, BatchJobStatus.RUNNING.value,
+             BatchJobStatus.CLEANING.value],
+        )
+        self.assertEqual(batch_job.status_transitions[1].cluster_timestamp,
+                         cluster_timestamp)
+        self.assertIsNone(batch_job.status_transitions[2].cluster_timestamp)
+
+    def test_illegal_transition(self):
+        """ Terminal jobs shouldn't move to any other status. """
+        batch_job = self.create_batch_job(
+            status=BatchJobStatus.SUCCEEDED.value,
+        )
+
+        with self.assertRaises(InvalidTransitionError):
+            batch_job.set_running()
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.SUCCEEDED.value)
+        self.assertEqual(len(batch_job.status_transitions), 1)
+
+    def test_concurrent_transition(self):
+        """
+        A transition based on a stale status shouldn't overwrite the current
+        one.
+        """
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        stale_batch_job = BatchJob.objects.get(id=batch_job.id)
+        stop_time = datetime.utcnow().replace(microsecond=0)
+
+        batch_job.set_killed(stop_time=stop_time)
+        with self.assertRaises(InvalidTransitionError):
+            stale_batch_job.set_cleaning()
+
+        # the stale instance got the current state
+        self.assertEqual(stale_batch_job.status, BatchJobStatus.KILLED.value)
+        stale_batch_job.reload()
+        self.assertEqual(stale_batch_job.status, BatchJobStatus.KILLED.value)
+        self.assertEqual(stale_batch_job.stop_time, stop_time)
+        self.assertEqual(
+            [transition.status
+             for transition in stale_batch_job.status_transitions],
+            [BatchJobStatus.RUNNING.value, BatchJobStatus.KILLED.value],
+        )
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from kubernetes_task_runner.cluster import (BATCH_JOB_LABEL,
+                                            RUNNER_LABEL_SELECTOR)
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+from kubernetes_task_runner.orphans import sweep_orphans
+
+from .base import BaseTestCase
+from .utilities import create_cluster_manager_mock
+
+
+class OrphansTestCase(BaseTestCase):
+    """
+    Test cases for the sweeping of orphaned cluster objects.
+    """
+
+    def _job(self, name, status, hours_ago=0):
+        with self.app.app_context():
+            return BatchJob(
+                name=name,
+                status=status,
+                created=datetime.utcnow() - timedelta(hours=hours_ago),
+                job_parameters={'docker_image': 'python'},
+            ).save()
+
+    def _object(self, name, batch_job_name):
+        return SimpleNamespace(metadata=SimpleNamespace(
+            name=name, labels={BATCH_JOB_LABEL: batch_job_name},
+        ))
+
+    def _cluster_manager(self):
+        self._job('running', BatchJobStatus.RUNNING.value, hours_ago=5)
+        self._job('failed-now', BatchJobStatus.FAILED.value)
+        self._job('failed-long-ago', BatchJobStatus.FAILED.value,
+                  hours_ago=5)
+        return create_cluster_manager_mock(
+            list_managed_jobs={'default': [
+                self._object('running', 'running'),
+                self._object('failed-now', 'failed-now'),
+                self._object('failed-long-ago-cleanup', 'failed-long-ago'),
+                self._object('removed', 'removed'),
+            ]},
+            list_managed_pvcs={'default': [
+                self._object('job-failed-long-ago-output', 'failed-long-ago'),
+                self._object('job-running-output', 'running'),
+            ]},
+        )
+
+    def test_dry_run(self):
+        """ Should only report the orphaned objects. """
+        cluster_manager = self._cluster_manager()
+
+        with self.app.app_context():
+            report = sweep_orphans(cluster_manager, dry_run=True)
+
+        self.assertEqual(report, {'default': {
+            'batch_jobs': ['failed-long-ago', 'removed'],
+            'jobs': ['failed-long-ago-cleanup', 'removed'],
+            'pvcs': ['job-failed-long-ago-output'],
+        }})
+        self.assertEqual(cluster_manager.delete_collections.call_count, 0)
+
+    def test_sweep_orphans(self):
+        """ Should delete the orphaned objects by their batch job's label. """
+        cluster_manager = self._cluster_manager()
+
+        with self.app.app_context():
+            sweep_orphans(cluster_manager)
+
+        cluster_manager.delete_collections.assert_called_once_with(
+            f'{RUNNER_LABEL_SELECTOR},{BATCH_JOB_LABEL} in '
+            '(failed-long-ago,removed)',
+            namespace='default',
+        )
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+from kubernetes_task_runner.placement import (LABEL, LEAST_LOADED,
+                                              ROUND_ROBIN, place_batch_job)
+
+from .base import BaseTestCase
+
+
+CLUSTERS = {
+    'eu-1': {'region': 'eu'},
+    'eu-2': {'region': 'eu', 'gpu': 'true'},
+    'us-1': {'region': 'us'},
+}
+
+
+class PlacementTestCase(BaseTestCase):
+    """
+    Test cases for the placement of batch jobs on clusters.
+    """
+
+    def _job(self, cluster=None, status=BatchJobStatus.QUEUED.value,
+             cpu='1', cluster_selector=None):
+        batch_job = BatchJob(
+            status=status,
+            job_parameters={
+                'docker_image': 'python',
+                'resources': {'requests': {'cpu': cpu}},
+                'cluster_selector': cluster_selector or {},
+            },
+        )
+        if cluster is None:
+            return batch_job
+        batch_job.cluster = cluster
+        with self.app.app_context():
+            return batch_job.save()
+
+    def test_least_loaded(self):
+        """ Should place jobs where the least CPU is requested. """
+        self._job('eu-1', status=BatchJobStatus.RUNNING.value, cpu='4')
+        self._job('eu-2', cpu='1')
+        self._job('eu-2', cpu='1')
+        self._job('us-1', status=BatchJobStatus.SUCCEEDED.value, cpu='8')
+
+        self.assertEqual(place_batch_job(self._job(), CLUSTERS, LEAST_LOADED),
+                         'us-1')
+        batch_job = self._job(cluster_selector={'region': 'eu'})
+        self.assertEqual(place_batch_job(batch_job, CLUSTERS, LEAST_LOADED),
+                         'eu-2')
+
+    def test_label(self):
+        """ Should place jobs on the first cluster matching their selector. """
+        self._job('eu-1', status=BatchJobStatus.RUNNING.value, cpu='4')
+
+        self.assertEqual(place_batch_job(self._job(), CLUSTERS, LABEL),
+                         'eu-1')
+        batch_job = self._job(cluster_selector={'gpu': 'true'})
+        self.assertEqual(place_batch_job(batch_job, CLUSTERS, LABEL), 'eu-2')
+
+    def test_round_robin(self):
+        """ Should place jobs on each matching cluster in turn. """
+        batch_job = self._job(cluster_selector={'region': 'eu'})
+
+        placements = {place_batch_job(batch_job, CLUSTERS, ROUND_ROBIN)
+                      for _ in range(4)}
+
+        self.assertEqual(placements, {'eu-1', 'eu-2'})
+
+    def test_no_matching_cluster(self):
+        batch_job = self._job(cluster_selector={'region': 'asia'})
+        self.assertIsNone(place_batch_job(batch_job, CLUSTERS))
+        self.assertIsNone(place_batch_job(self._job(), {}))
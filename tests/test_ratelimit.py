@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from email.utils import formatdate
+from unittest.mock import patch
+
+import gevent
+
+from kubernetes_task_runner.ratelimit import (DEFAULT_RETRY_AFTER,
+                                              MAX_RETRY_AFTER, Lane,
+                                              RateLimiter, endpoint_lane,
+                                              retry_after)
+
+from .base import BaseTestCase
+from .fake_cluster import FakeClock
+
+TIME_PATCH_PATH = 'kubernetes_task_runner.ratelimit.time'
+
+
+class RateLimiterTestCase(BaseTestCase):
+    """
+    Test cases for the token bucket of the Kubernetes API calls.
+    """
+
+    def test_burst_then_qps(self):
+        """ Should allow `burst` calls at once, then `qps` a second. """
+        clock = FakeClock()
+        with patch(TIME_PATCH_PATH, monotonic=clock.time, sleep=clock.sleep):
+            rate_limiter = RateLimiter(qps=10, burst=5)
+            waited = [rate_limiter.acquire() for _ in range(7)]
+
+        self.assertEqual(waited[:5], [0] * 5)
+        self.assertAlmostEqual(waited[5], 0.1)
+        self.assertAlmostEqual(waited[6], 0.1)
+        self.assertAlmostEqual(clock.now, 0.2)
+
+    def test_refill_up_to_burst(self):
+        """ Idle time shouldn't save more than `burst` tokens. """
+        clock = FakeClock()
+        with patch(TIME_PATCH_PATH, monotonic=clock.time, sleep=clock.sleep):
+            rate_limiter = RateLimiter(qps=10, burst=2)
+            rate_limiter.acquire()
+            clock.sleep(60)
+            waited = [rate_limiter.acquire() for _ in range(3)]
+
+        self.assertEqual(waited[:2], [0, 0])
+        self.assertAlmostEqual(waited[2], 0.1)
+
+    def test_reads_go_first(self):
+        """
+        A read waiting for a token should get the next one before the bulk
+        calls waiting since earlier.
+        """
+        rate_limiter = RateLimiter(qps=50, burst=1)
+        rate_limiter.acquire()
+        acquired = []
+
+        def acquire(name, lane):
+            rate_limiter.acquire(lane)
+            acquired.append(name)
+
+        # let the greenlets take turns on the limiter
+        with patch('time.sleep', gevent.sleep):
+            bulk_calls = [gevent.spawn(acquire, f'create-{index}', Lane.BULK)
+                          for index in range(3)]
+            gevent.sleep(0)
+            read_call = gevent.spawn(acquire, 'list', Lane.READ)
+            gevent.joinall(bulk_calls + [read_call], raise_error=True)
+
+        self.assertEqual(acquired[0], 'list')
+        self.assertCountEqual(acquired[1:],
+                              ['create-0', 'create-1', 'create-2'])
+
+    def test_endpoint_lane(self):
+        self.assertEqual(endpoint_lane('list_namespaced_job'), Lane.READ)
+        self.assertEqual(endpoint_lane('read_namespaced_pod_log'), Lane.READ)
+        self.assertEqual(endpoint_lane('create_namespaced_job'), Lane.BULK)
+        self.assertEqual(endpoint_lane('delete_namespaced_job'), Lane.BULK)
+
+    def test_retry_after(self):
+        """ Should read both seconds and HTTP dates, within bounds. """
+        self.assertEqual(retry_after({'Retry-After': '3'}), 3)
+        self.assertEqual(retry_after({'Retry-After': '3600'}),
+                         MAX_RETRY_AFTER)
+        self.assertEqual(retry_after({}), DEFAULT_RETRY_AFTER)
+        self.assertEqual(retry_after(None), DEFAULT_RETRY_AFTER)
+        self.assertEqual(retry_after({'Retry-After': 'soon'}),
+                         DEFAULT_RETRY_AFTER)
+        with patch(TIME_PATCH_PATH, time=lambda: 1000):
+            self.assertEqual(
+                retry_after({'Retry-After': formatdate(1010, usegmt=True)}),
+                10,
+            )
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import random
+from unittest.mock import Mock, patch
+
+from kubernetes_task_runner.exceptions import BackendUnavailable
+from kubernetes_task_runner.resilience import CircuitBreaker, backoff_delays
+
+from .base import BaseTestCase
+
+
+class BackoffDelaysTestCase(BaseTestCase):
+    """
+    Test cases for the delays between retries.
+    """
+
+    def test_decorrelated_jitter(self):
+        """
+        Each delay should be between the base and three times the previous
+        one, never over the cap.
+        """
+        random.seed(0)
+        delays = backoff_delays(base=1, cap=20)
+        previous = 1
+        for _ in range(50):
+            delay = next(delays)
+            self.assertGreaterEqual(delay, 1)
+            self.assertLessEqual(delay, min(20, previous * 3))
+            previous = delay
+
+
+class CircuitBreakerTestCase(BaseTestCase):
+    """
+    Test cases for the circuit breakers of the backends.
+    """
+
+    def test_open_after_failures(self):
+        """ Should open after failures in a row only. """
+        circuit_breaker = CircuitBreaker('backend', probe=Mock(),
+                                         failure_threshold=3)
+
+        with patch('threading.Thread'):
+            for _ in range(2):
+                circuit_breaker.record_failure()
+            circuit_breaker.record_success()
+            for _ in range(2):
+                circuit_breaker.record_failure()
+            circuit_breaker.check()
+            circuit_breaker.record_failure()
+
+        self.assertTrue(circuit_breaker.is_open)
+        with self.assertRaises(BackendUnavailable) as context:
+            circuit_breaker.check()
+        self.assertEqual(context.exception.retry_after,
+                         circuit_breaker.probe_interval)
+
+    def test_probe_until_recovered(self):
+        """ Should probe the backend in the background until it's back. """
+        probe = Mock(side_effect=[OSError('down'), OSError('down'), None])
+        circuit_breaker = CircuitBreaker('backend', probe=probe,
+                                         failure_threshold=1,
+                                         probe_interval=0.01)
+
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.is_open)
+        circuit_breaker._prober.join(timeout=5)
+
+        self.assertFalse(circuit_breaker.is_open)
+        self.assertEqual(probe.call_count, 3)
+        circuit_breaker.check()
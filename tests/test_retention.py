@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+
+from kubernetes_task_runner.exceptions import StorageException
+from kubernetes_task_runner.models import (BatchJob, BatchJobStatus,
+                                           WebhookNotification)
+from kubernetes_task_runner.retention import expire_batch_jobs
+
+from .base import BaseTestCase
+
+
+GCLOUD_PATCH_PATH = 'kubernetes_task_runner.retention.get_gcloud_client'
+
+
+class RetentionTestCase(BaseTestCase):
+    """
+    Test cases for the expiration of finished batch jobs.
+    """
+
+    def _job(self, status, days_ago):
+        with self.app.app_context():
+            return BatchJob(
+                status=status,
+                created=datetime.utcnow() - timedelta(days=days_ago),
+                job_parameters={'docker_image': 'python'},
+            ).save()
+
+    def test_expire_batch_jobs(self):
+        """ Should archive old finished jobs to GCS, then remove them. """
+        expired_job = self._job(BatchJobStatus.SUCCEEDED.value, 10)
+        self._job(BatchJobStatus.SUCCEEDED.value, 1)
+        self._job(BatchJobStatus.RUNNING.value, 10)
+        with self.app.app_context():
+            WebhookNotification(job_id=expired_job.id,
+                                callback_url='https://example.com/jobs',
+                                payload={'id': str(expired_job.id)},
+                                status='delivered').save()
+        uploaded = {}
+
+        def upload_file(file_obj, blob_name, **kwargs):
+            uploaded[blob_name] = gzip.decompress(file_obj.read())
+
+        gcs_client = Mock()
+        gcs_client.upload_file = Mock(side_effect=upload_file)
+        with patch(GCLOUD_PATCH_PATH, return_value=gcs_client):
+            with self.app.app_context():
+                self.assertEqual(expire_batch_jobs(7), 1)
+
+        (blob_name, archive), = uploaded.items()
+        self.assertTrue(blob_name.startswith('archive/batch_jobs/'))
+        self.assertTrue(blob_name.endswith(f'{expired_job.id}.ndjson.gz'))
+        lines = archive.decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [str(expired_job.id)])
+        self.assertEqual(BatchJob.objects.count(), 2)
+        self.assertEqual(BatchJob.objects(id=expired_job.id).count(), 0)
+        self.assertEqual(WebhookNotification.objects.count(), 0)
+
+    def test_expire_batch_jobs_upload_failure(self):
+        """ Jobs should be kept if their archive couldn't be uploaded. """
+        self._job(BatchJobStatus.FAILED.value, 10)
+        gcs_client = Mock()
+        gcs_client.upload_file = Mock(side_effect=StorageException('down'))
+
+        with patch(GCLOUD_PATCH_PATH, return_value=gcs_client):
+            with self.app.app_context():
+                with self.assertRaises(StorageException):
+                    expire_batch_jobs(7)
+
+        self.assertEqual(BatchJob.objects.count(), 1)
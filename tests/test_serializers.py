@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime
+
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus, JobAttempt
+from kubernetes_task_runner.serializers import (BatchJobSchema,
+                                                serialize_raw_batch_job)
+
+from .base import BaseTestCase
+
+
+BatchJobSerializer = BatchJobSchema()
+
+
+class SerializersTestCase(BaseTestCase):
+    """
+    Test cases for the serialization of raw BatchJob documents.
+    """
+
+    def _assert_same_output(self, batch_job):
+        document = BatchJob.objects.as_pymongo().get(id=batch_job.id)
+        batch_job = BatchJob.objects.get(id=batch_job.id)
+        self.assertEqual(
+            json.dumps(serialize_raw_batch_job(document), sort_keys=True),
+            json.dumps(BatchJobSerializer.dump(batch_job).data,
+                       sort_keys=True),
+        )
+
+    def test_serialize_raw_batch_job(self):
+        """ Should serialize raw documents like `BatchJobSchema`. """
+        self._assert_same_output(self.create_batch_job())
+
+        now = datetime.utcnow()
+        with self.app.app_context():
+            batch_job = BatchJob(
+                status=BatchJobStatus.QUEUED.value,
+                job_parameters={
+                    'docker_image': 'python',
+                    'environment_variables': {'A': '1'},
+                    'resources': {'requests': {'cpu': '500m'}},
+                    'cluster_selector': {'region': 'eu'},
+                    'priority': 2,
+                    'max_attempts': 3,
+                },
+                callback_url='https://example.com/jobs',
+                namespace='tenant-a',
+                output_file_url='https://example.com/output.zip',
+                retry_at=now,
+                input_uploaded=True,
+                idempotency_key='key',
+                attempts=[JobAttempt(number=1, start_time=now,
+                                     reason='BackoffLimitExceeded')],
+            )
+            batch_job.clean()
+            batch_job.save()
+        self._assert_same_output(batch_job)
+
+    def test_serialize_raw_batch_job_defaults(self):
+        """ Fields missing from older documents should get their default. """
+        batch_job = self.create_batch_job()
+        BatchJob._get_collection().update_one({'_id': batch_job.id}, {
+            '$unset': {'cluster': 1, 'input_uploaded': 1,
+                       'job_parameters.max_attempts': 1, 'version': 1,
+                       'updated': 1},
+        })
+        self._assert_same_output(batch_job)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+
+from .base import BaseTestCase
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLOW_CALL_SECONDS = 1
+
+
+def http_get(port, path):
+    """ GET `path` and return the response's status code. """
+    connection = HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', path)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+class ServerTestCase(BaseTestCase):
+    """
+    Test cases for the gevent API server.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # a process of its own, monkey patched by `main` like in production
+        self.server = subprocess.Popen(
+            [sys.executable, '-m', 'tests.slow_server',
+             str(SLOW_CALL_SECONDS)],
+            cwd=PACKAGE_ROOT, stdout=subprocess.PIPE,
+        )
+        self.port = int(self.server.stdout.readline())
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        self.server.stdout.close()
+        super().tearDown()
+
+    def test_slow_call_does_not_block(self):
+        """
+        A request blocked in a call shouldn't delay the others, as the
+        monkey patching in `main` makes blocking calls cooperative.
+        """
+        finished = {}
+
+        def get(path):
+            finished[path] = (http_get(self.port, path), time.monotonic())
+
+        slow_request = threading.Thread(target=get,
+                                        args=('/batch/stats/queue',))
+        slow_request.start()
+        # let the slow request reach the blocking call
+        time.sleep(0.1)
+        started = time.monotonic()
+        get('/metrics')
+        slow_request.join()
+
+        metrics_status, metrics_finished = finished['/metrics']
+        queue_status, queue_finished = finished['/batch/stats/queue']
+        self.assertEqual(metrics_status, 200)
+        self.assertEqual(queue_status, 200)
+        self.assertLess(metrics_finished, queue_finished)
+        self.assertLess(metrics_finished - started, SLOW_CALL_SECONDS / 2)
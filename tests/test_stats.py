@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from uuid import uuid4
+
+from mongoengine import connect
+from mongoengine.connection import disconnect
+from mongoengine.context_managers import switch_db
+
+from kubernetes_task_runner.models import BatchJob, StatusTransition
+from kubernetes_task_runner.stats import (PHASES, nearest_rank,
+                                          phase_latency_percentiles,
+                                          pick_percentiles)
+
+from .base import BaseTestCase
+
+# mongomock lacks the aggregation operators of the latency pipelines, so they
+# only run against a real MongoDB, e.g. mongodb://localhost:27017
+MONGODB_TEST_URI = os.environ.get('MONGODB_TEST_URI')
+MONGODB_TEST_ALIAS = 'stats-test'
+BATCH_JOB_PATCH_PATH = 'kubernetes_task_runner.stats.BatchJob'
+
+
+class NearestRankTestCase(BaseTestCase):
+    """
+    Test cases for the ranks of the percentiles.
+    """
+
+    def test_nearest_rank(self):
+        self.assertEqual(nearest_rank(50, 10), 5)
+        self.assertEqual(nearest_rank(95, 10), 10)
+        self.assertEqual(nearest_rank(1, 10), 1)
+        self.assertEqual(nearest_rank(0, 10), 1)
+
+    def test_pick_percentiles(self):
+        durations = [1000 * seconds for seconds in range(1, 11)]
+        self.assertEqual(pick_percentiles(durations),
+                         {'count': 10, 'p50': 5000, 'p95': 10000,
+                          'p99': 10000})
+        self.assertEqual(pick_percentiles([], percentiles=(50,)),
+                         {'count': 0, 'p50': None})
+
+    def test_single_aggregation_per_phase(self):
+        """ Should pick the percentiles from each phase's sorted durations. """
+        now = datetime.utcnow()
+        with patch(BATCH_JOB_PATCH_PATH) as batch_job:
+            batch_job.objects.aggregate.return_value = [
+                {'duration': 1000}, {'duration': 2000},
+            ]
+            stats = phase_latency_percentiles(now - timedelta(days=1), now)
+
+        self.assertEqual(batch_job.objects.aggregate.call_count, len(PHASES))
+        pipeline = batch_job.objects.aggregate.call_args[0]
+        self.assertEqual(pipeline[-1], {'$sort': {'duration': 1}})
+        self.assertEqual(stats['run'],
+                         {'count': 2, 'p50': 1000, 'p95': 2000, 'p99': 2000})
+
+
+@unittest.skipUnless(MONGODB_TEST_URI, 'MONGODB_TEST_URI is not set.')
+class PhaseLatencyTestCase(BaseTestCase):
+    """
+    Test cases for the latency percentiles aggregated from stored jobs.
+    """
+
+    def setUp(self):
+        super().setUp()
+        connect(db='test', host=MONGODB_TEST_URI, alias=MONGODB_TEST_ALIAS)
+
+    def run(self, result=None):
+        with switch_db(BatchJob, MONGODB_TEST_ALIAS):
+            return super().run(result)
+
+    def tearDown(self):
+        BatchJob.drop_collection()
+        disconnect(MONGODB_TEST_ALIAS)
+        super().tearDown()
+
+    def _create_job(self, created_time, **offsets):
+        """ Create a job entering each status `offsets` seconds in. """
+        with self.app.app_context():
+            BatchJob(
+                name=f'job-{uuid4()}',
+                job_parameters={'docker_image': 'python'},
+                created=created_time,
+                status_transitions=[
+                    StatusTransition(
+                        status=status,
+                        timestamp=created_time + timedelta(seconds=seconds),
+                    )
+                    for status, seconds in offsets.items()
+                ],
+            ).save()
+
+    def test_phase_latency_percentiles(self):
+        """ Should aggregate the phases of the jobs in the window only. """
+        now = datetime.utcnow().replace(microsecond=0)
+        # 1 to 10 seconds from being admitted until running
+        for seconds in range(1, 11):
+            self._create_job(now, queued=0, created=1, running=1 + seconds)
+        # never got to run
+        self._create_job(now, queued=0, created=1)
+        # out of the window
+        self._create_job(now - timedelta(days=2), queued=0, created=1,
+                         running=100)
+
+        with self.app.app_context():
+            stats = phase_latency_percentiles(now - timedelta(days=1),
+                                              now + timedelta(days=1))
+
+        self.assertEqual(stats['time_to_running'],
+                         {'count': 10, 'p50': 5000, 'p95': 10000,
+                          'p99': 10000})
+        self.assertEqual(stats['admission'],
+                         {'count': 11, 'p50': 1000, 'p95': 1000, 'p99': 1000})
+        self.assertEqual(stats['cleanup'],
+                         {'count': 0, 'p50': None, 'p95': None, 'p99': None})
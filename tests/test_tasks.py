@@ -1,17 +1,36 @@
 # -*- coding: utf-8 -*-
+import threading
+from datetime import datetime, timedelta
 from unittest.mock import Mock, patch
 
-from kubernetes_task_runner.models import BatchJobStatus
-from kubernetes_task_runner.tasks import Action, apply_changes
+from dotmap import DotMap
+from kubernetes.client.rest import ApiException
+
+from kubernetes_task_runner.models import BatchJob, BatchJobStatus
+from kubernetes_task_runner.tasks import (STALE_CREATED_SECONDS, Action,
+                                          apply_changes,
+                                          start_cluster_caches,
+                                          synchronize_batch_jobs,
+                                          synchronize_cluster,
+                                          synchronize_job)
 
 from .base import BaseTestCase
-from .utilities import create_cluster_manager_mock
+from .utilities import create_cluster_manager_mock, mock_job
 
 
 GCLOUD_PATCH_PATH = 'kubernetes_task_runner.tasks.get_gcloud_client'
 CLEANER_JOB_PATCH_PATH = 'kubernetes_task_runner.tasks.launch_cleaner_job'
 CLEANUP_DEPENDENCIES_PATCH_PATH = ('kubernetes_task_runner.tasks.'
                                    'cleanup_job_dependencies')
+ARCHIVE_LOGS_PATCH_PATH = 'kubernetes_task_runner.tasks.archive_job_logs'
+CLUSTER_PATCH_PATH = ('kubernetes_task_runner.tasks.'
+                      'get_cluster_manager_instance')
+CLUSTER_SYNC_WAIT_PATCH_PATH = 'kubernetes_task_runner.tasks.CLUSTER_SYNC_WAIT'
+DISPATCH_PATCH_PATH = 'kubernetes_task_runner.tasks.dispatch_queued_jobs'
+STATUS_COUNTS_PATCH_PATH = ('kubernetes_task_runner.tasks.'
+                            'update_batch_job_status_counts')
+NOTIFY_PATCH_PATH = ('kubernetes_task_runner.tasks.webhooks.'
+                     'notify_batch_job_finished')
 
 
 class SynchronizeBatchJobsTestCase(BaseTestCase):
@@ -33,6 +52,96 @@ class SynchronizeBatchJobsTestCase(BaseTestCase):
         # the new status was set
         self.assertEqual(batch_job.status, new_status)
 
+    def test_apply_changes_notifies_terminal_status(self):
+        """
+        `apply_changes` should notify the job's callback URL only when moving
+        it to a terminal status.
+        """
+        cluster_manager = create_cluster_manager_mock()
+        notify = Mock()
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+
+        with patch(NOTIFY_PATCH_PATH, notify):
+            with patch(CLEANER_JOB_PATCH_PATH):
+                apply_changes(batch_job, BatchJobStatus.CLEANING.value,
+                              Action.CLEAN, cluster_manager)
+            self.assertEqual(notify.call_count, 0)
+            with patch(CLEANUP_DEPENDENCIES_PATCH_PATH):
+                apply_changes(batch_job, BatchJobStatus.FAILED.value,
+                              Action.DELETE, cluster_manager)
+
+        notify.assert_called_once_with(batch_job)
+        self.assertEqual(notify.call_args[0][0].status,
+                         BatchJobStatus.FAILED.value)
+
+    def test_retry_failed_job(self):
+        """
+        Jobs failing on the cluster should be queued again, recording the
+        attempt, until they run out of attempts.
+        """
+        cluster_manager = create_cluster_manager_mock()
+        batch_job = self.create_batch_job(
+            status=BatchJobStatus.RUNNING.value,
+            job_parameters={'docker_image': 'python', 'max_attempts': 2,
+                            'retry_backoff': 30},
+        )
+        cluster_job = mock_job(name=batch_job.name, failed=1)
+        cluster_job.status.conditions = [DotMap({
+            'type': 'Failed', 'reason': 'BackoffLimitExceeded',
+            'message': 'Job has reached the specified backoff limit',
+        })]
+        notify = Mock()
+
+        with patch(NOTIFY_PATCH_PATH, notify):
+            with patch(ARCHIVE_LOGS_PATCH_PATH):
+                new_status, action = synchronize_job(batch_job, cluster_job)
+                apply_changes(batch_job, new_status, action, cluster_manager,
+                              cluster_job=cluster_job)
+
+                batch_job.reload()
+                self.assertEqual(batch_job.status,
+                                 BatchJobStatus.QUEUED.value)
+                self.assertGreater(batch_job.retry_at, datetime.utcnow())
+                self.assertEqual(batch_job.attempts[0].reason,
+                                 'BackoffLimitExceeded: Job has reached the '
+                                 'specified backoff limit')
+                cluster_manager.delete_job.assert_called_once_with(
+                    batch_job.name, namespace=None,
+                )
+                self.assertEqual(notify.call_count, 0)
+
+                # the second attempt fails too
+                batch_job.transition(BatchJobStatus.CREATED.value)
+                batch_job.set_running()
+                new_status, action = synchronize_job(batch_job, cluster_job)
+                apply_changes(batch_job, new_status, action, cluster_manager,
+                              cluster_job=cluster_job)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.FAILED.value)
+        self.assertEqual([attempt.number for attempt in batch_job.attempts],
+                         [1, 2])
+        notify.assert_called_once_with(batch_job)
+
+    def test_apply_changes_concurrent_change(self):
+        """
+        If the job's status changed since it was loaded, `apply_changes`
+        shouldn't overwrite it nor apply the action.
+        """
+        cluster_manager = create_cluster_manager_mock()
+        launch_cleaner_job = Mock()
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        # killed through the API meanwhile
+        BatchJob.objects.get(id=batch_job.id).set_killed()
+
+        with patch(CLEANER_JOB_PATCH_PATH, launch_cleaner_job):
+            apply_changes(batch_job, BatchJobStatus.CLEANING.value,
+                          Action.CLEAN, cluster_manager)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.KILLED.value)
+        self.assertEqual(launch_cleaner_job.call_count, 0)
+
     def test_apply_changes_launch_cleanup_job(self):
         """
         When applying the CLEAN action, `apply_changes` should launch a cleanup
@@ -41,15 +150,18 @@ class SynchronizeBatchJobsTestCase(BaseTestCase):
         cluster_manager = create_cluster_manager_mock()
         launch_cleaner_job = Mock()
         batch_job = self.create_batch_job()
+        cluster_job = mock_job(name=batch_job.name, succeeded=1)
 
         action = Action.CLEAN
         new_status = batch_job.status
 
         with patch(CLEANER_JOB_PATCH_PATH, launch_cleaner_job):
-            apply_changes(batch_job, new_status, action, cluster_manager)
+            apply_changes(batch_job, new_status, action, cluster_manager,
+                          cluster_job=cluster_job)
 
-        # the cleanup job was launched
-        launch_cleaner_job.assert_called_once_with(batch_job)
+        # the cleanup job was launched, owned by the regular job
+        launch_cleaner_job.assert_called_once_with(batch_job,
+                                                   owner=cluster_job)
 
     def test_apply_changes_launch_cleanup_job_skip_if_running(self):
         """
@@ -80,6 +192,8 @@ class SynchronizeBatchJobsTestCase(BaseTestCase):
         """
         cluster_manager = create_cluster_manager_mock()
         batch_job = self.create_batch_job()
+        with self.app.app_context():
+            batch_job.modify(set__namespace='tenant-a')
         cleanup_job_dependencies = Mock()
 
         action = Action.DELETE
@@ -87,15 +201,53 @@ class SynchronizeBatchJobsTestCase(BaseTestCase):
         # a cleanup job is already running
         # cleanup job is already running
 
+        # logs must be archived before the job (and its pods) is deleted
+        archive_job_logs = Mock(
+            side_effect=lambda *args: self.assertEqual(
+                cluster_manager.delete_job.call_count, 0,
+            ),
+        )
+
         with patch(CLEANUP_DEPENDENCIES_PATCH_PATH, cleanup_job_dependencies):
-            apply_changes(batch_job, new_status, action, cluster_manager)
+            with patch(ARCHIVE_LOGS_PATCH_PATH, archive_job_logs):
+                apply_changes(batch_job, new_status, action, cluster_manager)
 
-        # job was deleted
-        cluster_manager.delete_job.assert_called_once_with(batch_job.name)
+        archive_job_logs.assert_called_once_with(cluster_manager,
+                                                 batch_job.name, 'tenant-a')
+        # job was deleted, in its namespace
+        cluster_manager.delete_job.assert_called_once_with(
+            batch_job.name, namespace='tenant-a',
+        )
         # job's dependencies were deleted
         cleanup_job_dependencies.assert_called_once_with(cluster_manager,
                                                          batch_job)
 
+    def test_apply_changes_delete_owned(self):
+        """
+        Resources owned by the regular job should be left to the cluster's
+        garbage collector.
+        """
+        cluster_manager = create_cluster_manager_mock()
+        batch_job = self.create_batch_job()
+        with self.app.app_context():
+            batch_job.modify(set__dependencies_owned=True)
+        cleanup_job = mock_job(name=batch_job.cleanup_job_name, failed=1)
+        cleanup_job.metadata.owner_references = [{'uid': 'job-uid'}]
+        cleanup_job_dependencies = Mock()
+
+        with patch(CLEANUP_DEPENDENCIES_PATCH_PATH, cleanup_job_dependencies):
+            with patch(ARCHIVE_LOGS_PATCH_PATH):
+                apply_changes(batch_job, None, Action.DELETE,
+                              cluster_manager, is_cleanup=True,
+                              cluster_job=cleanup_job)
+                apply_changes(batch_job, None, Action.DELETE,
+                              cluster_manager)
+
+        # only the regular job was deleted
+        cluster_manager.delete_job.assert_called_once_with(batch_job.name,
+                                                           namespace=None)
+        self.assertEqual(cleanup_job_dependencies.call_count, 0)
+
     def test_apply_changes_delete_cleanup(self):
         """
         When applying a DELETE action to a cleanup job, only the job should be
@@ -114,11 +266,30 @@ class SynchronizeBatchJobsTestCase(BaseTestCase):
 
         # cleanup job was deleted
         cluster_manager.delete_job.assert_called_once_with(
-            batch_job.cleanup_job_name,
+            batch_job.cleanup_job_name, namespace=None,
         )
         # job's dependencies were not deleted (cleanup jobs don't have deps)
         self.assertEqual(cleanup_job_dependencies.call_count, 0)
 
+    def test_apply_changes_cleanup_failure_attempt(self):
+        """
+        A failing cleanup job shouldn't be recorded as an attempt of its job.
+        """
+        cluster_manager = create_cluster_manager_mock()
+        batch_job = self.create_batch_job(
+            status=BatchJobStatus.CLEANING.value,
+        )
+        cleanup_job = mock_job(name=batch_job.cleanup_job_name, failed=1)
+
+        with patch(ARCHIVE_LOGS_PATCH_PATH):
+            apply_changes(batch_job, BatchJobStatus.FAILED.value,
+                          Action.DELETE, cluster_manager, is_cleanup=True,
+                          cluster_job=cleanup_job)
+
+        batch_job.reload()
+        self.assertEqual(batch_job.status, BatchJobStatus.FAILED.value)
+        self.assertEqual(batch_job.attempts, [])
+
     def test_apply_changes_cleanup_succeed(self):
         """
         Whn applying a SUCCEED action, the cleanup job should be deleted and
@@ -143,6 +314,152 @@ class SynchronizeBatchJobsTestCase(BaseTestCase):
         batch_job.reload()
         self.assertEqual(batch_job.output_file_url, expected_url)
         cluster_manager.delete_job.assert_called_once_with(
-            batch_job.cleanup_job_name,
+            batch_job.cleanup_job_name, namespace=None,
         )
         self.assertEqual(cleanup_job_dependencies.call_count, 0)
+
+    def test_synchronize_slow_cluster(self):
+        """
+        A slow cluster shouldn't hold up the synchronization of the others,
+        nor be synchronized again until it's done.
+        """
+        self.app.config['KUBERNETES_SETTINGS'] = {
+            'slow': {'host': 'slow.localhost'},
+            'fast': {'host': 'fast.localhost'},
+        }
+        unblock = threading.Event()
+        slow_cluster = create_cluster_manager_mock()
+        slow_cluster.list_managed_jobs = Mock(
+            side_effect=lambda: unblock.wait(5) and {},
+        )
+        fast_cluster = create_cluster_manager_mock()
+        cluster_managers = {'slow': slow_cluster, 'fast': fast_cluster}
+
+        with patch(CLUSTER_PATCH_PATH, side_effect=cluster_managers.get):
+            with patch(CLUSTER_SYNC_WAIT_PATCH_PATH, 0.5):
+                with self.app.app_context():
+                    synchronize_batch_jobs()
+                    synchronize_batch_jobs()
+                unblock.set()
+
+        self.assertEqual(fast_cluster.list_managed_jobs.call_count, 2)
+        self.assertEqual(slow_cluster.list_managed_jobs.call_count, 1)
+
+    def test_synchronize_failing_cluster(self):
+        """
+        A failing cluster shouldn't keep queued jobs from being admitted.
+        """
+        self.app.config['KUBERNETES_SETTINGS'] = {
+            'broken': {'host': 'broken.localhost'},
+        }
+        broken_cluster = create_cluster_manager_mock()
+        broken_cluster.list_managed_jobs = Mock(side_effect=Exception())
+
+        with patch(CLUSTER_PATCH_PATH, return_value=broken_cluster):
+            with patch(DISPATCH_PATCH_PATH) as dispatch_queued_jobs:
+                with patch(STATUS_COUNTS_PATCH_PATH) as update_counts:
+                    with self.app.app_context():
+                        synchronize_batch_jobs()
+
+        dispatch_queued_jobs.assert_called_once_with()
+        update_counts.assert_called_once_with()
+
+    def test_synchronize_unlabelled_jobs(self):
+        """
+        Running jobs missing from the labelled Jobs should be read by name,
+        e.g. those deployed before the Jobs were labelled.
+        """
+        listed_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        unlabelled_job = self.create_batch_job(
+            status=BatchJobStatus.RUNNING.value,
+        )
+        cluster_manager = create_cluster_manager_mock(list_managed_jobs={
+            'default': [mock_job(name=listed_job.name, active=1)],
+        })
+        cluster_manager.get_job = Mock(
+            return_value=mock_job(name=unlabelled_job.name, succeeded=1),
+        )
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            with patch(CLEANER_JOB_PATCH_PATH) as launch_cleaner_job:
+                synchronize_cluster('default')
+
+        cluster_manager.get_job.assert_called_once_with(unlabelled_job.name,
+                                                        namespace=None)
+        unlabelled_job.reload()
+        self.assertEqual(unlabelled_job.status, BatchJobStatus.CLEANING.value)
+        self.assertEqual(launch_cleaner_job.call_count, 1)
+
+    def test_synchronize_vanished_jobs(self):
+        """
+        Running jobs whose Job is gone from the cluster should fail, e.g.
+        deleted after its TTL before being synchronized.
+        """
+        vanished_job = self.create_batch_job(
+            status=BatchJobStatus.RUNNING.value,
+        )
+        cluster_manager = create_cluster_manager_mock(list_managed_jobs={
+            'default': [],
+        })
+        cluster_manager.get_job = Mock(side_effect=ApiException(status=404))
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            with patch(NOTIFY_PATCH_PATH) as notify:
+                synchronize_cluster('default')
+
+        vanished_job.reload()
+        self.assertEqual(vanished_job.status, BatchJobStatus.FAILED.value)
+        self.assertEqual(notify.call_count, 1)
+
+    def test_recover_stale_created_jobs(self):
+        """
+        Jobs admitted long ago but never marked as running should be queued
+        again if never deployed, and synchronized as running otherwise.
+        """
+        stale_time = datetime.utcnow() - timedelta(
+            seconds=STALE_CREATED_SECONDS + 1,
+        )
+        lost_job = self.create_batch_job(status=BatchJobStatus.CREATED.value)
+        deployed_job = self.create_batch_job(
+            status=BatchJobStatus.CREATED.value,
+        )
+        deploying_job = self.create_batch_job(
+            status=BatchJobStatus.CREATED.value,
+        )
+        for batch_job in (lost_job, deployed_job):
+            batch_job.update(set__updated=stale_time)
+        cluster_manager = create_cluster_manager_mock(list_managed_jobs={
+            'default': [mock_job(name=deployed_job.name, active=1)],
+        }, get_job=None)
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            synchronize_cluster('default')
+
+        cluster_manager.get_job.assert_called_once_with(
+            lost_job.name, ignore_404=True, namespace=None,
+        )
+        for batch_job, status in ((lost_job, BatchJobStatus.QUEUED),
+                                  (deployed_job, BatchJobStatus.RUNNING),
+                                  (deploying_job, BatchJobStatus.CREATED)):
+            batch_job.reload()
+            self.assertEqual(batch_job.status, status.value)
+
+    def test_start_cluster_caches(self):
+        """
+        Only workers consuming the default or the jobs queue should keep
+        the clusters' caches.
+        """
+        cluster_manager = create_cluster_manager_mock()
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            for queues, started in ((['webhooks'], 0),
+                                    (['celery'], 1),
+                                    (['jobs', 'webhooks'], 2)):
+                consumer = Mock()
+                consumer.app.conf.task_default_queue = 'celery'
+                consumer.app.amqp.queues.consume_from = {
+                    queue: Mock() for queue in queues
+                }
+                start_cluster_caches(sender=consumer)
+                self.assertEqual(cluster_manager.cache.start.call_count,
+                                 started)
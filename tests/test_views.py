@@ -1,21 +1,31 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
 from unittest.mock import Mock, patch
 from uuid import uuid4
 import json
 
+from kubernetes import client
+
+from kubernetes_task_runner.cluster import NodeCapacity
+from kubernetes_task_runner.exceptions import (BackendUnavailable,
+                                               InvalidTransitionError)
 from kubernetes_task_runner.models import BatchJob, BatchJobStatus
 from kubernetes_task_runner.serializers import BatchJobSchema
 
 from .base import BaseTestCase
+from .utilities import create_cluster_manager_mock, mock_pod_list
 
 
 BatchJobSerializer = BatchJobSchema()
 
 
-CREATE_BATCH_JOB_PATCH_PATH = ('kubernetes_task_runner.views.'
-                               'cluster_create_batch_job')
 STOP_BATCH_JOB_PATCH_PATH = ('kubernetes_task_runner.views.'
                              'cluster_stop_batch_job')
+CLUSTER_PATCH_PATH = ('kubernetes_task_runner.views.'
+                      'get_cluster_manager_instance')
+GCLOUD_PATCH_PATH = 'kubernetes_task_runner.views.get_gcloud_client'
+LATENCY_STATS_PATCH_PATH = ('kubernetes_task_runner.views.'
+                            'phase_latency_percentiles')
 
 
 class APITestCase(BaseTestCase):
@@ -64,17 +74,112 @@ class APITestCase(BaseTestCase):
         self.assertEqual(response.json['data'][1],
                          BatchJobSerializer.dump(batch_job_2).data)
 
+    def test_get_single_batch_job_etag(self):
+        """ Should answer 304 until the job is updated. """
+        batch_job = self.create_batch_job(
+            status=BatchJobStatus.CREATED.value,
+        )
+        url = f'{self.batch_jobs_url}{batch_job.id}'
+        response = self._json_response(url)
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        with self.app.app_context():
+            batch_job.set_running()
+        self.assertEqual(batch_job.version, 1)
+        response = self._json_response(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.json['data']['version'], 1)
+
+    def test_get_single_batch_job_live(self):
+        """
+        Should include the state of the job's pods from the cluster's cache,
+        without an ETag, and none until the cache is synced.
+        """
+        batch_job = self.create_batch_job(
+            status=BatchJobStatus.RUNNING.value,
+        )
+        started_at = datetime(2018, 5, 24, 10, 0)
+        pod = client.V1Pod(
+            metadata=client.V1ObjectMeta(name='pod-1'),
+            spec=client.V1PodSpec(containers=[], node_name='node-1'),
+            status=client.V1PodStatus(phase='Running', container_statuses=[
+                client.V1ContainerStatus(
+                    name='job', ready=True, restart_count=2, image='python',
+                    image_id='', state=client.V1ContainerState(
+                        running=client.V1ContainerStateRunning(
+                            started_at=started_at,
+                        ),
+                    ),
+                ),
+            ]),
+        )
+        cache = Mock(synced=True)
+        cache.get_job.return_value = client.V1Job(
+            status=client.V1JobStatus(active=1),
+        )
+        cache.list_pods.return_value = client.V1PodList(items=[pod])
+        cluster_manager = create_cluster_manager_mock(cache=cache)
+        url = f'{self.batch_jobs_url}{batch_job.id}?live=true'
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            response = self._json_response(url)
+            cache.synced = False
+            unsynced_response = self._json_response(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertEqual(response.json['data']['live'], {
+            'job': {'active': 1, 'succeeded': 0, 'failed': 0},
+            'pods': [{
+                'name': 'pod-1',
+                'phase': 'Running',
+                'node': 'node-1',
+                'restarts': 2,
+                'containers': [{
+                    'name': 'job',
+                    'ready': True,
+                    'restart_count': 2,
+                    'state': 'running',
+                    'started_at': 1527156000000,
+                }],
+            }],
+        })
+        cache.get_job.assert_called_once_with(batch_job.name,
+                                              batch_job.namespace)
+        cluster_manager.list_pods.assert_not_called()
+        self.assertIsNone(unsynced_response.json['data']['live'])
+
+    def test_get_batch_jobs_etag(self):
+        """ The list's ETag should change when the listed jobs change. """
+        self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        etag = self._json_response(self.batch_jobs_url).headers['ETag']
+
+        response = self.client.get(self.batch_jobs_url,
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        response = self._json_response(self.batch_jobs_url,
+                                       headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['data']), 2)
+
     def test_create_batch_job_happy_path(self):
         """
-        Should allow the creation of new batch jobs and call the cluster to
-        start them.
+        Should allow the creation of new batch jobs and queue them.
         """
         batch_job_data = self.create_batch_job(save=False)
+        batch_job_data['status'] = BatchJobStatus.RUNNING.value
 
-        mock_cluster_create_job = Mock(return_value=(None, None))
-        with patch(CREATE_BATCH_JOB_PATCH_PATH, mock_cluster_create_job):
-            response = self._json_response(self.batch_jobs_url, method='post',
-                                           data=json.dumps(batch_job_data))
+        response = self._json_response(self.batch_jobs_url, method='post',
+                                       data=json.dumps(batch_job_data))
 
         # a new batch job should be created
         self.assertEqual(BatchJob.objects.count(), 1)
@@ -83,8 +188,43 @@ class APITestCase(BaseTestCase):
                          BatchJobSerializer.dump(new_job).data)
 
         self.assertEqual(response.status_code, 200)
-        # the task processing function should've been called
-        mock_cluster_create_job.assert_called_once_with(new_job)
+        # the dispatcher deploys it once admitted
+        self.assertEqual(new_job.status, BatchJobStatus.QUEUED.value)
+
+    def test_create_batch_job_idempotency_key(self):
+        """
+        Repeated requests with the same `Idempotency-Key` should return the
+        same job, until the key expires.
+        """
+        batch_job_data = json.dumps(self.create_batch_job(save=False))
+
+        def post():
+            return self._json_response(
+                self.batch_jobs_url, method='post', data=batch_job_data,
+                headers={'Idempotency-Key': 'request-1'},
+            )
+
+        first_response = post()
+        repeated_response = post()
+
+        self.assertEqual(BatchJob.objects.count(), 1)
+        self.assertEqual(repeated_response.status_code, 200)
+        self.assertEqual(repeated_response.headers['Idempotent-Replayed'],
+                         'true')
+        self.assertEqual(repeated_response.json['data']['id'],
+                         first_response.json['data']['id'])
+
+        # the key expires
+        BatchJob.objects.update(
+            set__created=datetime.utcnow() - timedelta(days=2),
+        )
+        expired_response = post()
+
+        self.assertEqual(expired_response.status_code, 200)
+        self.assertNotEqual(expired_response.json['data']['id'],
+                            first_response.json['data']['id'])
+        self.assertEqual(BatchJob.objects(idempotency_key='request-1').count(),
+                         1)
 
     def test_create_batch_job_invalid_parameters(self):
         """
@@ -93,13 +233,99 @@ class APITestCase(BaseTestCase):
         """
         batch_job_data = self.create_batch_job(save=False)
         batch_job_data['job_parameters'] = 'not parameters'
-        mock_cluster_create_job = Mock(return_value=(None, None))
-        with patch(CREATE_BATCH_JOB_PATCH_PATH, mock_cluster_create_job):
+        response = self._json_response(self.batch_jobs_url, method='post',
+                                       data=json.dumps(batch_job_data))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'InvalidParameters')
+        self.assertEqual(BatchJob.objects.count(), 0)
+
+    def test_create_batch_job_without_retry_backoff(self):
+        """ Should reject retrying jobs right away. """
+        batch_job_data = self.create_batch_job(save=False, job_parameters={
+            'docker_image': 'python', 'max_attempts': 2, 'retry_backoff': 0,
+        })
+        response = self._json_response(self.batch_jobs_url, method='post',
+                                       data=json.dumps(batch_job_data))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'InvalidParameters')
+        self.assertEqual(BatchJob.objects.count(), 0)
+
+    def test_create_batch_job_exceeding_limits(self):
+        """ Should reject jobs which could never be admitted. """
+        self.app.config['ADMISSION_SETTINGS'] = {'max_cpu_per_owner': '2'}
+        batch_job_data = self.create_batch_job(save=False, job_parameters={
+            'docker_image': 'python',
+            'resources': {'requests': {'cpu': '4'}},
+        })
+        response = self._json_response(self.batch_jobs_url, method='post',
+                                       data=json.dumps(batch_job_data))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'InvalidParameters')
+        self.assertEqual(BatchJob.objects.count(), 0)
+
+    def test_create_batch_job_exceeding_nodes(self):
+        """ Should reject jobs which don't fit on any node. """
+        node_capacity = NodeCapacity(allocatable={'node-0': (2, 2 ** 34)},
+                                     free={'node-0': (0, 0)})
+        cluster_manager = create_cluster_manager_mock(
+            node_capacity=node_capacity,
+        )
+        batch_job_data = self.create_batch_job(save=False, job_parameters={
+            'docker_image': 'python',
+            'resources': {'requests': {'cpu': '4'}},
+        })
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
             response = self._json_response(self.batch_jobs_url, method='post',
                                            data=json.dumps(batch_job_data))
         self.assertEqual(response.status_code, 400)
-        self.assertEqual(response.json['error'], 'InvalidParameters')
-        self.assertEqual(mock_cluster_create_job.call_count, 0)
+        # only the cached capacity is used
+        cluster_manager.node_capacity.assert_called_once_with(refresh=False)
+
+    def test_create_batch_job_cluster_selector(self):
+        """ Should place jobs on a cluster matching their selector. """
+        self.app.config['KUBERNETES_SETTINGS'] = {
+            'eu': {'host': 'eu.localhost', 'labels': {'region': 'eu'}},
+            'us': {'host': 'us.localhost', 'labels': {'region': 'us'}},
+        }
+        batch_job_data = self.create_batch_job(save=False, job_parameters={
+            'docker_image': 'python',
+            'cluster_selector': {'region': 'us'},
+        })
+        with patch(CLUSTER_PATCH_PATH,
+                   return_value=create_cluster_manager_mock()):
+            response = self._json_response(self.batch_jobs_url, method='post',
+                                           data=json.dumps(batch_job_data))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['data']['cluster'], 'us')
+
+            batch_job_data['job_parameters']['cluster_selector'] = {
+                'region': 'asia',
+            }
+            response = self._json_response(self.batch_jobs_url, method='post',
+                                           data=json.dumps(batch_job_data))
+            self.assertEqual(response.status_code, 400)
+
+    def test_create_batch_job_namespace(self):
+        """
+        Should run jobs in the cluster's default namespace, or in the one
+        requested if the cluster manages it.
+        """
+        cluster_manager = create_cluster_manager_mock(
+            namespaces=['default', 'tenant-a'],
+        )
+
+        def create(namespace=None):
+            batch_job_data = self.create_batch_job(save=False)
+            if namespace is not None:
+                batch_job_data['namespace'] = namespace
+            return self._json_response(self.batch_jobs_url, method='post',
+                                       data=json.dumps(batch_job_data))
+
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            self.assertEqual(create().json['data']['namespace'], 'default')
+            self.assertEqual(create('tenant-a').json['data']['namespace'],
+                             'tenant-a')
+            self.assertEqual(create('tenant-b').status_code, 400)
 
     def test_stop_batch_job(self):
         """ Should call the cluster for stopping a batch job."""
@@ -121,6 +347,112 @@ class APITestCase(BaseTestCase):
                          BatchJobSerializer.dump(updated_batch_job).data)
         mock_cluster_stop_job.assert_called_once_with(batch_job)
 
+    def test_stop_batch_job_concurrently_finished(self):
+        """
+        Should return a conflict when the job reaches a final status while
+        being stopped.
+        """
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+
+        mock_cluster_stop_job = Mock(side_effect=InvalidTransitionError(
+            'Batch job can\'t move to killed: its status changed to failed.'
+        ))
+        url = f'{self.batch_jobs_url}{batch_job.id}'
+        with patch(STOP_BATCH_JOB_PATCH_PATH, mock_cluster_stop_job):
+            response = self._json_response(url, method='delete')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json['error'], 'InvalidTransition')
+
+    def test_stop_queued_batch_job(self):
+        """ Queued jobs should be killed without calling the cluster. """
+        batch_job = self.create_batch_job(status=BatchJobStatus.QUEUED.value)
+
+        mock_get_cluster_manager = Mock()
+        url = f'{self.batch_jobs_url}{batch_job.id}'
+        with patch('kubernetes_task_runner.batch_jobs.'
+                   'get_cluster_manager_instance', mock_get_cluster_manager):
+            response = self._json_response(url, method='delete')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data']['status'],
+                         BatchJobStatus.KILLED.value)
+        self.assertEqual(mock_get_cluster_manager.call_count, 0)
+
+    def test_stop_created_batch_job(self):
+        """
+        Jobs admitted but not deployed yet should be killed, deleting their
+        Job if it exists already.
+        """
+        batch_job = self.create_batch_job(status=BatchJobStatus.CREATED.value)
+        cluster_manager = create_cluster_manager_mock()
+
+        url = f'{self.batch_jobs_url}{batch_job.id}'
+        with patch('kubernetes_task_runner.batch_jobs.'
+                   'get_cluster_manager_instance',
+                   return_value=cluster_manager):
+            response = self._json_response(url, method='delete')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data']['status'],
+                         BatchJobStatus.KILLED.value)
+        cluster_manager.delete_job.assert_called_once_with(
+            batch_job.name, ignore_404=True, namespace=None,
+        )
+
+    def test_stream_batch_job_logs(self):
+        """ Should stream the logs of the job's pod. """
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        pods = mock_pod_list(['Running'])
+        cluster_manager = create_cluster_manager_mock(list_pods=pods)
+        cluster_manager.stream_pod_log = Mock(
+            return_value=iter([b'hello ', b'world\n']),
+        )
+
+        url = f'{self.batch_jobs_url}{batch_job.id}/logs?follow=true'
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'hello world\n')
+        cluster_manager.stream_pod_log.assert_called_once_with(
+            pods.items[0].metadata.name, follow=True, namespace=None,
+        )
+
+    def test_archived_batch_job_logs(self):
+        """ Should redirect to the archived logs once the pod is gone. """
+        batch_job = self.create_batch_job(status=BatchJobStatus.FAILED.value)
+        gcs_client = Mock()
+        gcs_client.get_output_file_url = Mock(return_value='https://logs')
+
+        url = f'{self.batch_jobs_url}{batch_job.id}/logs'
+        with patch(CLUSTER_PATCH_PATH,
+                   return_value=create_cluster_manager_mock()):
+            with patch(GCLOUD_PATCH_PATH, return_value=gcs_client):
+                response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.headers['Location'], 'https://logs')
+        gcs_client.get_output_file_url.assert_called_once_with(
+            f'{batch_job.name}-logs.txt.gz',
+        )
+
+    def test_batch_job_logs_backend_unavailable(self):
+        """ Should fail fast with a 503 while the cluster is unavailable. """
+        batch_job = self.create_batch_job(status=BatchJobStatus.RUNNING.value)
+        cluster_manager = create_cluster_manager_mock()
+        cluster_manager.list_pods.side_effect = BackendUnavailable(
+            'Kubernetes API is unavailable.', retry_after=10,
+        )
+
+        url = f'{self.batch_jobs_url}{batch_job.id}/logs'
+        with patch(CLUSTER_PATCH_PATH, return_value=cluster_manager):
+            response = self._json_response(url)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json['error'], 'BackendUnavailable')
+        self.assertEqual(response.headers['Retry-After'], '10')
+
     def test_duplicate_name_batch_job(self):
         """
         Should return an appropriate error response when attempting to create
@@ -128,17 +460,35 @@ class APITestCase(BaseTestCase):
         """
         batch_job_data = {**self.create_batch_job(save=False),
                           'name': 'duplicate-name'}
-        mock_cluster_create_job = Mock(return_value=(None, None))
-        with patch(CREATE_BATCH_JOB_PATCH_PATH, mock_cluster_create_job):
-            response_0 = self._json_response(
-                self.batch_jobs_url, method='post',
-                data=json.dumps(batch_job_data),
-            )
-            response_1 = self._json_response(
-                self.batch_jobs_url, method='post',
-                data=json.dumps(batch_job_data),
-            )
+        response_0 = self._json_response(
+            self.batch_jobs_url, method='post',
+            data=json.dumps(batch_job_data),
+        )
+        response_1 = self._json_response(
+            self.batch_jobs_url, method='post',
+            data=json.dumps(batch_job_data),
+        )
         # only one BatchJob was created
         self.assertEqual(response_0.status_code, 200)
         self.assertEqual(response_1.status_code, 400)
         self.assertEqual(BatchJob.objects.count(), 1)
+
+    def test_latency_stats(self):
+        """ Should return the percentiles for the requested window. """
+        stats = {'queue': {'count': 1, 'p50': 10, 'p95': 10, 'p99': 10}}
+        mock_percentiles = Mock(return_value=stats)
+        url = f'{self.batch_jobs_url}stats/latency?since=0&until=60000'
+        with patch(LATENCY_STATS_PATCH_PATH, mock_percentiles):
+            response = self._json_response(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data'], stats)
+        since, until = mock_percentiles.call_args[0]
+        self.assertEqual((until - since).total_seconds(), 60)
+
+    def test_latency_stats_invalid_window(self):
+        """ Should reject windows that end before they start. """
+        url = f'{self.batch_jobs_url}stats/latency?since=60000&until=0'
+        response = self._json_response(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'InvalidParameters')
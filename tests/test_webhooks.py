@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from unittest.mock import Mock, patch
+
+import requests
+
+from kubernetes_task_runner.models import (BatchJobStatus,
+                                           WebhookNotification,
+                                           WebhookNotificationStatus)
+from kubernetes_task_runner.webhooks import (BACKOFF_BASE, deliver_pending,
+                                             notify_batch_job_finished)
+
+from .base import BaseTestCase
+
+
+CALLBACK_URL = 'https://orchestrator.example.com/jobs'
+ENQUEUE_PATCH_PATH = 'kubernetes_task_runner.webhooks.enqueue_delivery'
+POST_PATCH_PATH = 'kubernetes_task_runner.webhooks.requests.post'
+
+
+class WebhooksTestCase(BaseTestCase):
+    """
+    Test cases for completion webhooks.
+    """
+
+    def _finished_job(self, status=BatchJobStatus.SUCCEEDED.value):
+        batch_job = self.create_batch_job(status=status)
+        with self.app.app_context():
+            batch_job.modify(set__callback_url=CALLBACK_URL)
+        return batch_job
+
+    def test_notify_batch_job_finished(self):
+        """
+        Should store a notification and schedule its delivery for jobs with
+        a callback URL only.
+        """
+        batch_job = self._finished_job()
+        enqueue_delivery = Mock()
+
+        with patch(ENQUEUE_PATCH_PATH, enqueue_delivery):
+            notify_batch_job_finished(batch_job)
+            # no callback URL
+            notify_batch_job_finished(self.create_batch_job(
+                status=BatchJobStatus.FAILED.value,
+            ))
+
+        notification = WebhookNotification.objects.get()
+        self.assertEqual(notification.job_id, batch_job.id)
+        self.assertEqual(notification.payload['status'],
+                         BatchJobStatus.SUCCEEDED.value)
+        enqueue_delivery.assert_called_once_with(CALLBACK_URL)
+
+    def test_deliver_pending_batches(self):
+        """ Should deliver every due notification in a single request. """
+        with patch(ENQUEUE_PATCH_PATH):
+            notify_batch_job_finished(self._finished_job())
+            notify_batch_job_finished(self._finished_job(
+                status=BatchJobStatus.KILLED.value,
+            ))
+        post = Mock(return_value=Mock(status_code=200))
+
+        with patch(POST_PATCH_PATH, post):
+            retry_in = deliver_pending(CALLBACK_URL)
+
+        self.assertIsNone(retry_in)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(len(post.call_args[1]['json']['events']), 2)
+        self.assertEqual(
+            WebhookNotification.objects(
+                status=WebhookNotificationStatus.DELIVERED.value,
+            ).count(),
+            2,
+        )
+
+    def test_deliver_pending_failure(self):
+        """ Failed deliveries should be retried with backoff. """
+        with patch(ENQUEUE_PATCH_PATH):
+            notify_batch_job_finished(self._finished_job())
+        post = Mock(side_effect=requests.ConnectionError('refused'))
+
+        with patch(POST_PATCH_PATH, post):
+            retry_in = deliver_pending(CALLBACK_URL)
+            # not due yet
+            deliver_pending(CALLBACK_URL)
+
+        self.assertEqual(post.call_count, 1)
+        self.assertAlmostEqual(retry_in, BACKOFF_BASE, delta=1)
+        notification = WebhookNotification.objects.get()
+        self.assertEqual(notification.status,
+                         WebhookNotificationStatus.PENDING.value)
+        self.assertEqual(notification.attempts, 1)
+        self.assertEqual(notification.last_error, 'refused')
+        self.assertGreater(notification.next_attempt_at, datetime.utcnow())
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+from .base import BaseTestCase
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# import the worker as when running it, and tell whether sockets got patched
+CHECK_PATCHING = (
+    'import sys; sys.argv = ["worker.py"] + sys.argv[1:]; import worker; '
+    'from gevent import monkey; print(monkey.is_module_patched("socket"))'
+)
+
+
+def sockets_patched(*arguments, **environment):
+    env = {name: value for name, value in os.environ.items()
+           if name != 'WORKER_CONCURRENCY'}
+    env.update(environment)
+    output = subprocess.check_output(
+        [sys.executable, '-c', CHECK_PATCHING] + list(arguments),
+        cwd=PACKAGE_ROOT, env=env,
+    )
+    return output.decode().strip() == 'True'
+
+
+class WorkerTestCase(BaseTestCase):
+    """
+    Test cases for the Celery worker's startup.
+    """
+
+    def test_gevent_pool_patches_sockets(self):
+        """
+        Workers using the gevent pool should patch the standard library
+        before importing anything else, the others not at all.
+        """
+        self.assertTrue(sockets_patched('--concurrency', '20'))
+        self.assertTrue(sockets_patched('--concurrency=10'))
+        self.assertTrue(sockets_patched(WORKER_CONCURRENCY='2'))
+        self.assertFalse(sockets_patched())
+        self.assertFalse(sockets_patched('--concurrency', '1'))
@@ -17,12 +17,23 @@ def create_cluster_manager_mock(**config):
         }),
         'get_pod': {},
         'list_jobs': DotMap({'items': []}),
+        'list_managed_jobs': {},
+        'list_managed_pvcs': {},
         'delete_job': None,
         'create_job': None,
         'get_job': {},
-        'list_pods': DotMap({'items': []}),
+        'get_pvc': None,
+        'list_pods': mock_pod_list([]),
+        'watch_job': [],
+        'watch_pods': [],
+        'node_capacity': None,
     }
     cluster_manager = Mock()
+    # read from the cluster, unless a cache is given
+    cluster_manager.cache = config.get('cache', Mock(synced=False))
+    cluster_manager.namespace = config.get('namespace', 'default')
+    cluster_manager.namespaces = config.get('namespaces',
+                                            [cluster_manager.namespace])
     for method_name, default_value in methods.items():
         setattr(cluster_manager, method_name,
                 Mock(return_value=config.get(method_name, default_value)))
@@ -30,7 +41,7 @@ def create_cluster_manager_mock(**config):
 
 
 def mock_job(name=None, active=None, failed=None, succeeded=None,
-             start_time=None):
+             start_time=None, completion_time=None):
     """
     Helper function to create a Kubernetes API Job response mock.
     """
@@ -44,6 +55,7 @@ def mock_job(name=None, active=None, failed=None, succeeded=None,
         'to_dict': {},
     })
     job.status.start_time = start_time if start_time else datetime.utcnow()
+    job.status.completion_time = completion_time
     job.to_dict = lambda: job
     return job
 
@@ -53,9 +65,21 @@ def mock_pod_list(phases=None):
     class PodList:
         pass
     pod_list = PodList()
-    pod_list.items = [
-        DotMap({'status': {'phase': phase}, 'to_dict': lambda: {}})
-        for phase in phases
-    ]
+    pod_list.metadata = DotMap({'resource_version': '1'})
+    pod_list.items = [mock_pod(phase) for phase in phases]
     setattr(pod_list, 'to_dict', lambda: {})
     return pod_list
+
+
+def mock_pod(phase, name=None):
+    """ Helper function to create a Kubernetes API pod response mock. """
+    return DotMap({
+        'metadata': {'name': name or str(uuid4())},
+        'status': {'phase': phase},
+        'to_dict': lambda: {},
+    })
+
+
+def watch_event(event_type, resource):
+    """ Helper function to create a Kubernetes API watch event. """
+    return {'type': event_type, 'object': resource}
@@ -1,5 +1,31 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
+
+
+def uses_gevent_pool(argv, environ):
+    """ Whether the worker runs with `--concurrency` above 1. """
+    concurrency = environ.get('WORKER_CONCURRENCY', '1')
+    for index, argument in enumerate(argv):
+        if argument == '--concurrency' and index + 1 < len(argv):
+            concurrency = argv[index + 1]
+        elif argument.startswith('--concurrency='):
+            concurrency = argument.split('=', 1)[1]
+    try:
+        return int(concurrency) > 1
+    except ValueError:
+        # left for click to report
+        return False
+
+
+# the gevent pool needs blocking I/O (MongoDB, the Kubernetes and GCS APIs,
+# `time.sleep`) cooperative before anything else imports it, like `main.py`
+if uses_gevent_pool(sys.argv[1:], os.environ):
+    from gevent import monkey
+    monkey.patch_all()
+
 import click
+from prometheus_client import start_http_server
 
 from kubernetes_task_runner.app import create_app
 from kubernetes_task_runner.tasks import celery
@@ -8,21 +34,53 @@ from kubernetes_task_runner.extensions import app_config_reader
 
 
 @click.command()
+@click.option('--metrics-port', envvar='WORKER_METRICS_PORT', type=click.INT,
+              default=4899)
+@click.option('--queues', envvar='WORKER_QUEUES', default='celery',
+              help='Comma separated queues to consume, e.g. `jobs`.')
+@click.option('--beat/--no-beat', envvar='WORKER_BEAT', default=True,
+              help='Also schedule the periodic tasks.')
+@click.option('--concurrency', envvar='WORKER_CONCURRENCY', type=click.INT,
+              default=1, help='Tasks run at a time, using gevent if > 1.')
 @app_config_reader
-def run_worker(app_config):
+def run_worker(metrics_port, queues, beat, concurrency, app_config):
     logger_pick(app_config['LOG_LEVEL'])
     app = create_app(app_config)
 
+    # expose Prometheus metrics collected by the worker
+    start_http_server(metrics_port)
+
     celery.conf.beat_schedule = {
         'synchronize-jobs-with-cluster': {
             'task': 'kubernetes_task_runner.tasks.synchronize_batch_jobs',
             'schedule': app_config['JOB_SYNCHRONIZATION_INTERVAL'],
         },
+        # admit queued jobs between synchronizations too
+        'dispatch-queued-jobs': {
+            'task': 'kubernetes_task_runner.tasks.dispatch_queued_jobs',
+            'schedule': 5,
+        },
+        'enqueue-pending-webhooks': {
+            'task': 'kubernetes_task_runner.tasks.enqueue_pending_webhooks',
+            'schedule': 60,
+        },
+        'sweep-orphans': {
+            'task': 'kubernetes_task_runner.tasks.sweep_orphans',
+            'schedule': 3600,
+        },
+        'expire-batch-jobs': {
+            'task': 'kubernetes_task_runner.tasks.expire_batch_jobs',
+            'schedule': 3600,
+        },
     }
 
+    pool = 'solo' if concurrency == 1 else 'gevent'
+    arguments = ['', '-c', str(concurrency), '-P', pool, '-Q', queues,
+                 '--loglevel', app_config['LOG_LEVEL']]
+    if beat:
+        arguments.append('-B')
     with app.app_context():
-        celery.worker_main(['', '-c', '1', '-P', 'solo', '-B', '--loglevel',
-                            app_config['LOG_LEVEL']])
+        celery.worker_main(arguments)
 
 
 if __name__ == '__main__':